@@ -0,0 +1,71 @@
+# Compare the memory and time used by the VQGAN decoder with and without gradient checkpointing (config.gradient_checkpointing).
+# The decoder has the architecture of the vqgan_imagenet_f16_16384 model, with random weights, so no model download is needed.
+# Memory is reported as the total size of the activations saved for the backward pass, and as the peak allocated memory on CUDA devices.
+# Run with: python benchmarks/checkpointing.py
+# Use --device cuda:0 to benchmark on a GPU.
+
+import argparse
+import time
+import torch
+from taming.modules.diffusionmodules.model import Decoder
+from vqgan_clip import _functional as VF
+
+
+class VQGANDecoder(torch.nn.Module):
+    # the decode path of a taming VQModel
+    def __init__(self):
+        super().__init__()
+        self.post_quant_conv = torch.nn.Conv2d(256, 256, 1)
+        self.decoder = Decoder(ch=128, out_ch=3, ch_mult=[1,1,2,2,4], num_res_blocks=2, attn_resolutions=[16], in_channels=3,
+                               resolution=256, z_channels=256, dropout=0.0)
+
+    def decode(self, quant):
+        return self.decoder(self.post_quant_conv(quant))
+
+
+def saved_activation_bytes(decode, quant):
+    # total size of the tensors autograd keeps for the backward pass, excluding recomputation
+    saved = {}
+    def pack(tensor):
+        saved[id(tensor)] = tensor.numel() * tensor.element_size()
+        return tensor
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        output = decode(quant)
+    del output
+    return sum(saved.values())
+
+
+def timed(decode, quant, repeats):
+    decode(quant).square().mean().backward()
+    if quant.is_cuda:
+        torch.cuda.synchronize(quant.device)
+        torch.cuda.reset_peak_memory_stats(quant.device)
+        base = torch.cuda.memory_allocated(quant.device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        decode(quant).square().mean().backward()
+    if quant.is_cuda:
+        torch.cuda.synchronize(quant.device)
+    peak = torch.cuda.max_memory_allocated(quant.device) - base if quant.is_cuda else None
+    return (time.perf_counter() - start) / repeats, peak
+
+
+parser = argparse.ArgumentParser(description='Benchmark gradient checkpointing of the VQGAN decoder.')
+parser.add_argument('--device', default='cpu')
+parser.add_argument('--sizes', type=int, nargs='+', default=[128, 256, 384])
+parser.add_argument('--repeats', type=int, default=2)
+args = parser.parse_args()
+
+device = torch.device(args.device)
+torch.manual_seed(0)
+model = VQGANDecoder().eval().requires_grad_(False).to(device)
+methods = {'decode': model.decode, 'checkpointed': lambda quant: VF.checkpointed_decode(model, quant)}
+
+print(f'{"size":>6} {"method":>13} {"saved (MB)":>11} {"peak (MB)":>10} {"time (s)":>9}')
+for size in args.sizes:
+    quant = torch.randn([1, 256, size // 16, size // 16], device=device, requires_grad=True)
+    for name, decode in methods.items():
+        saved = saved_activation_bytes(decode, quant)
+        seconds, peak = timed(decode, quant, args.repeats)
+        peak = f'{peak / 2**20:>10.1f}' if peak is not None else f'{"-":>10}'
+        print(f'{size:>6} {name:>13} {saved / 2**20:>11.1f} {peak} {seconds:>9.3f}')
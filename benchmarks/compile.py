@@ -0,0 +1,50 @@
+# Compare steady-state training iterations per second with and without config.compile.
+# Random-weight stand-ins for the VQGAN and CLIP models (benchmarks/stand_in_models.py) are registered with model_registry.put(), so no
+# model download is needed. The first iterations of the compiled engine, which include compiling, are reported separately.
+# Run with: python benchmarks/compile.py
+# Use --device cuda:0 to benchmark on a GPU.
+
+import argparse
+import time
+import torch
+from vqgan_clip.engine import Engine, VQGAN_CLIP_Config
+from stand_in_models import register
+
+
+def iterations_per_second(eng, iterations, device):
+    start = time.perf_counter()
+    for iteration_num in range(iterations):
+        eng.train(iteration_num)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return iterations / (time.perf_counter() - start)
+
+
+parser = argparse.ArgumentParser(description='Benchmark training with and without torch.compile.')
+parser.add_argument('--device', default='cpu')
+parser.add_argument('--image_size', type=int, nargs=2, default=[128, 128])
+parser.add_argument('--num_cuts', type=int, default=8)
+parser.add_argument('--cut_method', default='original')
+parser.add_argument('--warmup', type=int, default=3)
+parser.add_argument('--iterations', type=int, default=10)
+args = parser.parse_args()
+
+device = torch.device(args.device)
+results = {}
+for compile in [False, True]:
+    config = VQGAN_CLIP_Config()
+    config.cuda_device = args.device
+    config.output_image_size = args.image_size
+    config.num_cuts = args.num_cuts
+    config.cut_method = args.cut_method
+    config.seed = 1
+    config.compile = compile
+    register(config)
+    eng = Engine(config)
+    eng.initialize_VQGAN_CLIP()
+    eng.encode_and_append_text_prompt('A red sailboat')
+    eng.configure_optimizer()
+    warmup = iterations_per_second(eng, args.warmup, device)
+    results[compile] = iterations_per_second(eng, args.iterations, device)
+    print(f'compile={compile}: first {args.warmup} iterations {args.warmup / warmup:.1f} s, then {results[compile]:.2f} it/s')
+print(f'speedup {results[True] / results[False]:.2f}x')
@@ -0,0 +1,44 @@
+# Compare the original per-cutout loop with the batched cutout path for each cut_method.
+# Both forward and backward passes are timed, since train() runs both every iteration.
+# Run with: python benchmarks/cutouts.py
+# Use --device cuda:0 to benchmark on a GPU.
+
+import argparse
+import time
+import torch
+from vqgan_clip import _functional as VF
+
+CUTOUT_CLASSES = {'original': VF.MakeCutoutsOrig,
+                  'kornia': VF.MakeCutoutsKornia,
+                  'sg3': VF.MakeCutoutsSG3}
+
+
+def time_cutouts(make_cutouts, input, repeats):
+    # warm up once so that lazy initialization is not counted
+    make_cutouts(input).sum().backward()
+    if input.is_cuda:
+        torch.cuda.synchronize(input.device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        make_cutouts(input).sum().backward()
+    if input.is_cuda:
+        torch.cuda.synchronize(input.device)
+    return (time.perf_counter() - start) / repeats
+
+
+parser = argparse.ArgumentParser(description='Benchmark MakeCutouts with and without batching.')
+parser.add_argument('--device', default='cpu')
+parser.add_argument('--image_size', type=int, nargs=2, default=[512, 512])
+parser.add_argument('--cut_size', type=int, default=224)
+parser.add_argument('--num_cuts', type=int, nargs='+', default=[16, 32, 64])
+parser.add_argument('--repeats', type=int, default=5)
+args = parser.parse_args()
+
+torch.manual_seed(0)
+input = torch.rand([1, 3, args.image_size[1], args.image_size[0]], device=args.device, requires_grad=True)
+print(f'{"cut_method":>10} {"num_cuts":>8} {"loop (s)":>10} {"batched (s)":>12} {"speedup":>8}')
+for cut_method, cutout_class in CUTOUT_CLASSES.items():
+    for num_cuts in args.num_cuts:
+        loop_time = time_cutouts(cutout_class(args.cut_size, num_cuts, batched=False), input, args.repeats)
+        batched_time = time_cutouts(cutout_class(args.cut_size, num_cuts, batched=True), input, args.repeats)
+        print(f'{cut_method:>10} {num_cuts:>8} {loop_time:>10.4f} {batched_time:>12.4f} {loop_time/batched_time:>7.1f}x')
@@ -0,0 +1,132 @@
+# Benchmark Engine.train() across cut methods, cut counts, output sizes and optimizers.
+# Random-weight stand-ins for the VQGAN and CLIP models (benchmarks/stand_in_models.py) are used, so no model download is needed
+# and the suite can run in CI or without network access.
+# For each configuration this reports iterations per second, peak memory, and the mean time of each stage of train() from
+# config.stage_timing. Stage times are measured in separate iterations, after iterations per second, because timing stages
+# synchronizes CUDA devices. Each configuration runs in a new process, so that peak memory is measured for that configuration alone.
+# On CUDA devices peak memory is the peak allocated by torch. On the CPU it is the peak resident memory of the process, including the models.
+# Results are saved as JSON with --output, and compared with the results of another commit with --compare.
+# Run with: python benchmarks/engine_suite.py --output results.json
+#           python benchmarks/engine_suite.py --output new.json --compare results.json
+# Use --device cuda:0 to benchmark on a GPU.
+
+import argparse
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import platform
+import subprocess
+import time
+import torch
+
+
+def run_case(case, device, warmup, iterations, stage_iterations):
+    from vqgan_clip.engine import Engine, VQGAN_CLIP_Config
+    from stand_in_models import register
+
+    config = VQGAN_CLIP_Config()
+    config.cuda_device = device
+    config.output_image_size = [case['size'], case['size']]
+    config.cut_method = case['cut_method']
+    config.num_cuts = case['num_cuts']
+    config.optimizer = case['optimizer']
+    config.seed = 1
+    register(config)
+    eng = Engine(config)
+    eng.initialize_VQGAN_CLIP()
+    eng.encode_and_append_text_prompt('A red sailboat')
+    eng.configure_optimizer()
+    device = torch.device(device)
+
+    for iteration_num in range(warmup):
+        eng.train(iteration_num)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    start = time.perf_counter()
+    for iteration_num in range(warmup, warmup + iterations):
+        eng.train(iteration_num)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    seconds = time.perf_counter() - start
+
+    eng.conf.stage_timing = True
+    for iteration_num in range(warmup + iterations, warmup + iterations + stage_iterations):
+        eng.train(iteration_num)
+    stages = {name: 1000 * eng.stage_timings.mean(name) for name in eng.stage_timings.totals}
+
+    return dict(case, iterations_per_second=iterations / seconds, peak_memory_mb=peak_memory_mb(device), stage_ms=stages)
+
+
+def peak_memory_mb(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in kilobytes on Linux, and bytes on macOS
+    scale = 1 if platform.system() == 'Darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2**20
+
+
+def case_key(case):
+    return (case['cut_method'], case['num_cuts'], case['size'], case['optimizer'])
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(results, baseline):
+    previous = {case_key(result): result for result in baseline['results']}
+    print(f'\ncompared with {baseline.get("commit")}:')
+    print(f'{"cut_method":>10} {"cuts":>5} {"size":>5} {"optimizer":>9} {"it/s":>7} {"speedup":>8} {"memory (MB)":>12}')
+    for result in results:
+        old = previous.get(case_key(result))
+        if old is None:
+            continue
+        speedup = result['iterations_per_second'] / old['iterations_per_second']
+        memory = result['peak_memory_mb'] - old['peak_memory_mb'] if result['peak_memory_mb'] is not None and old['peak_memory_mb'] is not None else float('nan')
+        print(f'{result["cut_method"]:>10} {result["num_cuts"]:>5} {result["size"]:>5} {result["optimizer"]:>9} '
+              f'{result["iterations_per_second"]:>7.2f} {speedup:>7.2f}x {memory:>+12.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark Engine.train() with random-weight stand-in models.')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--cut_methods', nargs='+', default=['original', 'kornia', 'sg3'])
+    parser.add_argument('--num_cuts', type=int, nargs='+', default=[8, 32])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[128, 256])
+    parser.add_argument('--optimizers', nargs='+', default=['Adam'])
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--stage_iterations', type=int, default=3)
+    parser.add_argument('--output', help='JSON file to save the results to.')
+    parser.add_argument('--compare', help='JSON file saved by an earlier run, to compare the results with.')
+    args = parser.parse_args()
+
+    cases = [dict(cut_method=cut_method, num_cuts=num_cuts, size=size, optimizer=optimizer)
+             for cut_method, num_cuts, size, optimizer in itertools.product(args.cut_methods, args.num_cuts, args.sizes, args.optimizers)]
+    results = []
+    print(f'{"cut_method":>10} {"cuts":>5} {"size":>5} {"optimizer":>9} {"it/s":>7} {"peak (MB)":>10}  slowest stages')
+    for case in cases:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            result = executor.submit(run_case, case, args.device, args.warmup, args.iterations, args.stage_iterations).result()
+        results.append(result)
+        peak = f'{result["peak_memory_mb"]:>10.1f}' if result['peak_memory_mb'] is not None else f'{"-":>10}'
+        slowest = ', '.join(f'{name} {ms:.1f} ms' for name, ms in sorted(result['stage_ms'].items(), key=lambda item: -item[1])[:3])
+        print(f'{case["cut_method"]:>10} {case["num_cuts"]:>5} {case["size"]:>5} {case["optimizer"]:>9} '
+              f'{result["iterations_per_second"]:>7.2f} {peak}  {slowest}')
+
+    report = dict(commit=git_commit(), torch=torch.__version__, device=args.device, warmup=args.warmup, iterations=args.iterations, results=results)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            print_comparison(results, json.load(file))
@@ -0,0 +1,58 @@
+# Measure how long it takes to import each vqgan_clip module, and which slow optional dependencies each import loads.
+# Dependencies such as kornia, taming-transformers, CLIP and torch_optimizer are only imported when the feature that needs them is
+# used, so that programs which only use video_tools, or only show help, start quickly. A dependency listed under "loaded" for a
+# module that doesn't need it is an import time regression.
+# Each import is timed in a new Python process, and the median of the repeats is reported.
+# Results are saved as JSON with --output, and compared with the results of another commit with --compare.
+# Run with: python benchmarks/import_time.py
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+SLOW_DEPENDENCIES = ['torch', 'torchvision', 'kornia', 'taming', 'omegaconf', 'pytorch_lightning', 'clip', 'torch_optimizer', 'piexif', 'cv2', 'imageio']
+
+TIMING_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'loaded': [name for name in {dependencies} if name in sys.modules]}}))
+'''
+
+
+def time_import(module, repeats):
+    runs = []
+    for _ in range(repeats):
+        script = TIMING_SCRIPT.format(module=module, dependencies=SLOW_DEPENDENCIES)
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return {'module': module, 'seconds': statistics.median(run['seconds'] for run in runs), 'loaded': runs[-1]['loaded']}
+
+
+parser = argparse.ArgumentParser(description='Benchmark the time taken to import vqgan_clip modules.')
+parser.add_argument('--modules', nargs='+', default=['vqgan_clip', 'vqgan_clip.video_tools', 'vqgan_clip._functional',
+                                                     'vqgan_clip.engine', 'vqgan_clip.generate'])
+parser.add_argument('--repeats', type=int, default=3)
+parser.add_argument('--output', help='JSON file to save the results to.')
+parser.add_argument('--compare', help='JSON file saved by an earlier run, to compare the results with.')
+args = parser.parse_args()
+
+previous = {}
+if args.compare:
+    with open(args.compare) as file:
+        previous = {result['module']: result for result in json.load(file)['results']}
+
+results = []
+print(f'{"module":>24} {"time (s)":>9} {"before (s)":>11}  loaded')
+for module in args.modules:
+    result = time_import(module, args.repeats)
+    results.append(result)
+    before = f'{previous[module]["seconds"]:>11.2f}' if module in previous else f'{"-":>11}'
+    print(f'{module:>24} {result["seconds"]:>9.2f} {before}  {", ".join(result["loaded"])}')
+
+if args.output:
+    with open(args.output, 'w') as file:
+        json.dump({'python': sys.version.split()[0], 'results': results}, file, indent=2)
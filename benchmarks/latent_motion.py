@@ -0,0 +1,58 @@
+# Compare the per-frame cost of camera motion in generate.video_frames with and without latent_motion.
+# Without latent_motion each frame is transformed as an image (VF.affine_transform) and encoded again by the VQGAN encoder.
+# With latent_motion the latent vector and the optimizer state are warped directly (VF.warp_latent).
+# The VQGAN model has the architecture of vqgan_imagenet_f16_16384, with random weights, so no model download is needed.
+# Run with: python benchmarks/latent_motion.py
+# Use --device cuda:0 to benchmark on a GPU.
+
+import argparse
+import time
+import torch
+from taming.modules.diffusionmodules.model import Encoder
+from vqgan_clip import _functional as VF
+
+
+def timed(function, device, repeats):
+    function()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / repeats
+
+
+parser = argparse.ArgumentParser(description='Benchmark latent space camera motion against transforming and encoding the image.')
+parser.add_argument('--device', default='cpu')
+parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512])
+parser.add_argument('--zoom_scale', type=float, default=1.02)
+parser.add_argument('--shift', type=float, default=1)
+parser.add_argument('--repeats', type=int, default=3)
+args = parser.parse_args()
+
+device = torch.device(args.device)
+torch.manual_seed(0)
+# the encode path of a taming VQModel, without the codebook lookup that Engine discards
+encoder = Encoder(ch=128, out_ch=3, ch_mult=[1,1,2,2,4], num_res_blocks=2, attn_resolutions=[16], in_channels=3,
+                  resolution=256, z_channels=256, double_z=False, dropout=0.0)
+quant_conv = torch.nn.Conv2d(256, 256, 1)
+encode = torch.nn.Sequential(encoder, quant_conv).eval().requires_grad_(False).to(device)
+
+print(f'{"size":>6} {"re-encode (ms)":>15} {"latent (ms)":>12} {"speedup":>8}')
+for size in args.sizes:
+    image = torch.rand([1, 3, size, size], device=device)
+    z = torch.randn([1, 256, size // 16, size // 16], device=device)
+    # Adam keeps two moment estimates per element of z
+    optimizer_state = [torch.randn_like(z), torch.rand_like(z)]
+    def reencode():
+        with torch.no_grad():
+            return encode(VF.affine_transform(image, args.zoom_scale, args.shift, args.shift) * 2 - 1)
+    def latent():
+        with torch.no_grad():
+            for tensor in [z] + optimizer_state:
+                tensor.copy_(VF.warp_latent(tensor, args.zoom_scale, args.shift / 16, args.shift / 16))
+    reencode_time = timed(reencode, device, args.repeats)
+    latent_time = timed(latent, device, args.repeats)
+    print(f'{size:>6} {reencode_time * 1000:>15.1f} {latent_time * 1000:>12.2f} {reencode_time / latent_time:>7.0f}x')
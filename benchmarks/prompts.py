@@ -0,0 +1,41 @@
+# Compare evaluating each Prompt module in a loop, as Engine.ascend_txt() used to, with a single PromptStack.
+# Forward and backward passes are timed, since train() runs both every iteration.
+# Run with: python benchmarks/prompts.py
+# Use --device cuda:0 to benchmark on a GPU.
+
+import argparse
+import time
+import torch
+from vqgan_clip import _functional as VF
+
+
+def timed(function, input, repeats):
+    function(input).sum().backward()
+    if input.is_cuda:
+        torch.cuda.synchronize(input.device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function(input).sum().backward()
+    if input.is_cuda:
+        torch.cuda.synchronize(input.device)
+    return (time.perf_counter() - start) / repeats
+
+
+parser = argparse.ArgumentParser(description='Benchmark the CLIP prompt loss with many prompts.')
+parser.add_argument('--device', default='cpu')
+parser.add_argument('--embed_dim', type=int, default=512)
+parser.add_argument('--num_cuts', type=int, default=32)
+parser.add_argument('--num_prompts', type=int, nargs='+', default=[1, 5, 10, 20])
+parser.add_argument('--repeats', type=int, default=50)
+args = parser.parse_args()
+
+torch.manual_seed(0)
+input = torch.randn([args.num_cuts, args.embed_dim], device=args.device, requires_grad=True)
+print(f'{"prompts":>8} {"loop (ms)":>10} {"stack (ms)":>11} {"speedup":>8}')
+for num_prompts in args.num_prompts:
+    prompts = [VF.Prompt(torch.randn([1, args.embed_dim]), torch.rand([]).item()).to(args.device) for _ in range(num_prompts)]
+    stack = VF.PromptStack(prompts).to(args.device)
+    assert torch.allclose(stack(input), torch.stack([prompt(input) for prompt in prompts]), atol=1e-5)
+    loop_time = timed(lambda input: sum(prompt(input) for prompt in prompts), input, args.repeats)
+    stack_time = timed(stack, input, args.repeats)
+    print(f'{num_prompts:>8} {loop_time*1e3:>10.3f} {stack_time*1e3:>11.3f} {loop_time/stack_time:>7.1f}x')
@@ -0,0 +1,71 @@
+# Compare the original vector_quantize (codebook norms recomputed and a one-hot matrix product on every call)
+# with VectorQuantizer, which precomputes the codebook state and looks codes up by index.
+# Forward and backward passes are timed, since synth() runs both every iteration. On a GPU the peak memory
+# allocated during a call is also reported. The chunked and approximate nearest-code searches are then compared
+# with the exact search, with latent vectors drawn near codebook entries as they are during training.
+# Run with: python benchmarks/quantize.py
+# Use --device cuda:0 to benchmark on a GPU.
+
+import argparse
+import time
+import torch
+from torch.nn import functional as F
+from vqgan_clip import _functional as VF
+
+
+def original_vector_quantize(x, codebook):
+    d = x.pow(2).sum(dim=-1, keepdim=True) + codebook.pow(2).sum(dim=1) - 2 * x @ codebook.T
+    indices = d.argmin(-1)
+    x_q = F.one_hot(indices, codebook.shape[0]).to(d.dtype) @ codebook
+    replace_grad = VF.ReplaceGrad.apply
+    return replace_grad(x_q, x)
+
+
+def timed(function, x, repeats):
+    function(x).sum().backward()
+    if x.is_cuda:
+        torch.cuda.synchronize(x.device)
+        torch.cuda.reset_peak_memory_stats(x.device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function(x).sum().backward()
+    if x.is_cuda:
+        torch.cuda.synchronize(x.device)
+    peak = torch.cuda.max_memory_allocated(x.device) / 2**20 if x.is_cuda else float('nan')
+    return (time.perf_counter() - start) / repeats, peak
+
+
+parser = argparse.ArgumentParser(description='Benchmark vector quantization of the latent vector.')
+parser.add_argument('--device', default='cpu')
+parser.add_argument('--codebook_size', type=int, default=16384)
+parser.add_argument('--embed_dim', type=int, default=256)
+parser.add_argument('--latent_sizes', type=int, nargs='+', default=[16, 32, 48])
+parser.add_argument('--repeats', type=int, default=5)
+parser.add_argument('--chunk_size', type=int, default=256)
+parser.add_argument('--num_probes', type=int, default=8)
+args = parser.parse_args()
+
+torch.manual_seed(0)
+codebook = torch.randn([args.codebook_size, args.embed_dim], device=args.device)
+quantizer = VF.VectorQuantizer(codebook)
+print(f'{"latent":>8} {"original (s)":>13} {"quantizer (s)":>14} {"speedup":>8} {"original (MB)":>14} {"quantizer (MB)":>15}')
+for latent_size in args.latent_sizes:
+    x = torch.randn([1, latent_size, latent_size, args.embed_dim], device=args.device, requires_grad=True)
+    assert torch.equal(quantizer(x), original_vector_quantize(x, codebook))
+    original_time, original_peak = timed(lambda x: original_vector_quantize(x, codebook), x, args.repeats)
+    quantizer_time, quantizer_peak = timed(quantizer, x, args.repeats)
+    print(f'{f"{latent_size}x{latent_size}":>8} {original_time:>13.4f} {quantizer_time:>14.4f} {original_time/quantizer_time:>7.1f}x {original_peak:>14.1f} {quantizer_peak:>15.1f}')
+
+print()
+chunked = VF.VectorQuantizer(codebook, chunk_size=args.chunk_size)
+start = time.perf_counter()
+approximate = VF.VectorQuantizer(codebook, approximate=True, num_probes=args.num_probes)
+print(f'coarse index built in {time.perf_counter() - start:.2f} s')
+print(f'{"latent":>8} {"exact (s)":>10} {"chunked (s)":>12} {"approx (s)":>11} {"speedup":>8} {"disagreement":>13} {"exact (MB)":>11} {"chunked (MB)":>13} {"approx (MB)":>12}')
+for latent_size in args.latent_sizes:
+    x = codebook[torch.randint(args.codebook_size, [1, latent_size, latent_size], device=args.device)]
+    x = (x + 0.3 * codebook.std() * torch.randn_like(x)).requires_grad_()
+    exact_time, exact_peak = timed(quantizer, x, args.repeats)
+    chunked_time, chunked_peak = timed(chunked, x, args.repeats)
+    approximate_time, approximate_peak = timed(approximate, x, args.repeats)
+    print(f'{f"{latent_size}x{latent_size}":>8} {exact_time:>10.4f} {chunked_time:>12.4f} {approximate_time:>11.4f} {exact_time/approximate_time:>7.1f}x {approximate.disagreement_rate(x):>13.1%} {exact_peak:>11.1f} {chunked_peak:>13.1f} {approximate_peak:>12.1f}')
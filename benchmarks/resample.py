@@ -0,0 +1,94 @@
+# Micro-benchmark for _functional.resample, as used by the per-cutout loop (config.batched_cutouts = False).
+# Compares the original resample (kernel rebuilt with a Python loop on every call, one single-channel conv2d
+# batch per cutout) with the current resample, with and without the kernel cache, and with resample_cutouts(),
+# which resamples all cutouts of the same size in one call. The results must be numerically equivalent.
+# Run with: python benchmarks/resample.py
+# Use --device cuda:0 to benchmark on a GPU.
+
+import argparse
+import math
+import time
+import torch
+from torch.nn import functional as F
+from vqgan_clip import _functional as VF
+
+
+def timed(function, device, repeats):
+    function()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / repeats
+
+
+def original_ramp(ratio, width):
+    n = math.ceil(width / ratio + 1)
+    out = torch.empty([n])
+    cur = 0
+    for i in range(out.shape[0]):
+        out[i] = cur
+        cur += ratio
+    return torch.cat([-out[1:].flip([0]), out])[1:-1]
+
+
+def original_resample(input, size, align_corners=True):
+    n, c, h, w = input.shape
+    dh, dw = size
+    input = input.reshape([n * c, 1, h, w])
+    if dh < h:
+        kernel_h = VF.lanczos(original_ramp(dh / h, 2), 2).to(input.device, input.dtype)
+        pad_h = (kernel_h.shape[0] - 1) // 2
+        input = F.pad(input, (0, 0, pad_h, pad_h), 'reflect')
+        input = F.conv2d(input, kernel_h[None, None, :, None])
+    if dw < w:
+        kernel_w = VF.lanczos(original_ramp(dw / w, 2), 2).to(input.device, input.dtype)
+        pad_w = (kernel_w.shape[0] - 1) // 2
+        input = F.pad(input, (pad_w, pad_w, 0, 0), 'reflect')
+        input = F.conv2d(input, kernel_w[None, None, None, :])
+    input = input.view([n, c, h, w])
+    return F.interpolate(input, size, mode='bicubic', align_corners=align_corners)
+
+
+def resample_each(input, offsets, sizes, cut_size, resample=VF.resample):
+    return torch.cat([resample(input[:, :, y:y + size, x:x + size], (cut_size, cut_size)) for (x, y), size in zip(offsets, sizes)])
+
+
+parser = argparse.ArgumentParser(description='Benchmark Lanczos resampling of cutouts.')
+parser.add_argument('--device', default='cpu')
+parser.add_argument('--image_size', type=int, nargs=2, default=[256, 256])
+parser.add_argument('--cut_size', type=int, default=224)
+parser.add_argument('--num_cuts', type=int, default=32)
+parser.add_argument('--repeats', type=int, default=5)
+args = parser.parse_args()
+
+device = torch.device(args.device)
+torch.manual_seed(0)
+input = torch.rand([1, 3, args.image_size[1], args.image_size[0]], device=device)
+offsets, sizes = [], []
+max_size = min(args.image_size)
+for _ in range(args.num_cuts):
+    size = int(torch.randint(min(args.cut_size, max_size), max_size + 1, ()))
+    offsets.append((int(torch.randint(0, args.image_size[0] - size + 1, ())), int(torch.randint(0, args.image_size[1] - size + 1, ()))))
+    sizes.append(size)
+print(f'{args.num_cuts} cutouts with {len(set(sizes))} distinct sizes from a {args.image_size[0]}x{args.image_size[1]} image')
+
+original_time = timed(lambda: resample_each(input, offsets, sizes, args.cut_size, original_resample), device, args.repeats)
+max_entries = VF.lanczos_kernel_cache.max_entries
+VF.lanczos_kernel_cache.max_entries = 0
+VF.lanczos_kernel_cache.clear()
+uncached_time = timed(lambda: resample_each(input, offsets, sizes, args.cut_size), device, args.repeats)
+VF.lanczos_kernel_cache.max_entries = max_entries
+cached_time = timed(lambda: resample_each(input, offsets, sizes, args.cut_size), device, args.repeats)
+grouped_time = timed(lambda: VF.resample_cutouts(input, offsets, sizes, args.cut_size), device, args.repeats)
+expected = resample_each(input, offsets, sizes, args.cut_size, original_resample)
+print(f'max difference from the original resample: {(VF.resample_cutouts(input, offsets, sizes, args.cut_size) - expected).abs().max().item():.2e}')
+
+print(f'{"method":>30} {"time (s)":>10} {"speedup":>8}')
+print(f'{"original resample":>30} {original_time:>10.4f} {1.0:>7.1f}x')
+print(f'{"kernel rebuilt every call":>30} {uncached_time:>10.4f} {original_time/uncached_time:>7.1f}x')
+print(f'{"cached kernel":>30} {cached_time:>10.4f} {original_time/cached_time:>7.1f}x')
+print(f'{"cached kernel, grouped sizes":>30} {grouped_time:>10.4f} {original_time/grouped_time:>7.1f}x')
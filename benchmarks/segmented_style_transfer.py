@@ -0,0 +1,63 @@
+# Compare the time taken to restyle a video with generate.style_transfer, and with generate.segmented_style_transfer using several worker processes.
+# Random-weight stand-ins for the VQGAN and CLIP models (benchmarks/stand_in_models.py) are used, so no model download is needed.
+# The source video is a set of generated frames with a scene cut halfway through.
+# Throughput should scale with the number of workers, up to the number of CPU cores or GPUs available.
+# Run with: python benchmarks/segmented_style_transfer.py
+# Use --device cuda:0 to benchmark on a GPU.
+
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+from PIL import Image
+from vqgan_clip import generate
+from vqgan_clip.engine import VQGAN_CLIP_Config
+from stand_in_models import register
+
+
+def make_frames(path, num_frames, size):
+    rng = np.random.default_rng(0)
+    frames = []
+    for frame_num in range(num_frames):
+        color = np.array([200, 60, 40]) if frame_num < num_frames // 2 else np.array([40, 80, 200])
+        pixels = np.clip(color + rng.normal(0, 10, (size, size, 3)) + frame_num, 0, 255).astype(np.uint8)
+        frames.append(os.path.join(path, f'frame_{frame_num:05d}.jpg'))
+        Image.fromarray(pixels).save(frames[-1])
+    return frames
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark segmented style transfer with several worker processes.')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--num_frames', type=int, default=16)
+    parser.add_argument('--image_size', type=int, default=128)
+    parser.add_argument('--iterations_per_frame', type=int, default=5)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--overlap', type=int, default=2)
+    args = parser.parse_args()
+
+    def config():
+        config = VQGAN_CLIP_Config()
+        config.cuda_device = args.device
+        config.output_image_size = [args.image_size, args.image_size]
+        config.cut_method = 'original'
+        config.num_cuts = 8
+        config.seed = 1
+        register(config)
+        return config
+
+    with tempfile.TemporaryDirectory() as path:
+        frames = make_frames(path, args.num_frames, args.image_size)
+        settings = dict(text_prompts='A red sailboat', iterations_per_frame=args.iterations_per_frame, iterations_for_first_frame=args.iterations_per_frame,
+                        generated_video_frames_path=os.path.join(path, 'output'), leave_progress_bar=False)
+        start = time.perf_counter()
+        generate.style_transfer(frames, eng_config=config(), init_image_filename=os.path.join(path, 'init_image.jpg'), **settings)
+        baseline = time.perf_counter() - start
+        print(f'{"method":>22} {"time (s)":>9} {"frames/s":>9} {"speedup":>8}')
+        print(f'{"style_transfer":>22} {baseline:>9.1f} {args.num_frames / baseline:>9.2f} {1:>7.2f}x')
+        for num_workers in args.workers:
+            start = time.perf_counter()
+            generate.segmented_style_transfer(frames, eng_config=config(), num_workers=num_workers, overlap=args.overlap, **settings)
+            seconds = time.perf_counter() - start
+            print(f'{f"segmented, {num_workers} workers":>22} {seconds:>9.1f} {args.num_frames / seconds:>9.2f} {baseline / seconds:>7.2f}x')
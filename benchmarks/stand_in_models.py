@@ -0,0 +1,41 @@
+# Random-weight stand-ins for the VQGAN model and CLIP perceptor, so that Engine can be benchmarked without downloading checkpoints.
+# The stand-ins are built from the same taming-transformers and CLIP classes as the real models, so they have the interfaces Engine
+# uses (quantize.embedding, decoder.num_resolutions, encode_image, encode_text), but they are narrower and shallower. Absolute
+# timings are lower than with the real models, but comparisons between commits, and between configurations, are meaningful.
+# Use register() to make Engine.initialize_VQGAN_CLIP() load them in place of the models named in a VQGAN_CLIP_Config.
+
+import torch
+import clip.model
+from taming.models.vqgan import VQModel
+from taming.modules.diffusionmodules.model import Encoder, Decoder
+from taming.modules.vqvae.quantize import VectorQuantizer
+from vqgan_clip import model_registry
+
+
+def random_vqgan(n_embed=1024, embed_dim=64, ch=32):
+    """A VQModel with the downsampling factor (16) of vqgan_imagenet_f16_16384, and random weights."""
+    ddconfig = dict(double_z=False, z_channels=embed_dim, resolution=256, in_channels=3, out_ch=3, ch=ch,
+                    ch_mult=[1,1,2,2,4], num_res_blocks=1, attn_resolutions=[16], dropout=0.0)
+    # VQModel.__init__ builds a training loss from a config, which isn't needed for generating images
+    model = VQModel.__new__(VQModel)
+    torch.nn.Module.__init__(model)
+    model.encoder = Encoder(**ddconfig)
+    model.decoder = Decoder(**ddconfig)
+    model.quantize = VectorQuantizer(n_embed, embed_dim, beta=0.25)
+    model.quant_conv = torch.nn.Conv2d(embed_dim, embed_dim, 1)
+    model.post_quant_conv = torch.nn.Conv2d(embed_dim, embed_dim, 1)
+    return model
+
+
+def random_clip(width=128, layers=2):
+    """A CLIP model with the input resolution and patch size of ViT-B/32, and random weights."""
+    return clip.model.CLIP(embed_dim=width, image_resolution=224, vision_layers=layers, vision_width=width, vision_patch_size=32,
+                           context_length=77, vocab_size=49408, transformer_width=width, transformer_heads=2, transformer_layers=layers).float()
+
+
+def register(config, seed=0):
+    """Register stand-in models under the model registry key of config, unless models are already registered for it."""
+    if config not in model_registry.default_registry:
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(seed)
+            model_registry.put(config, random_vqgan(), random_clip())
@@ -0,0 +1,74 @@
+# Show how the memory used by the VQGAN decoder grows with the output size, with and without tiled decoding (config.decode_tile_size).
+# The decoder has the architecture of the vqgan_imagenet_f16_16384 model, with random weights, so no model download is needed.
+# For each size the forward and backward pass is timed. Memory is reported as the activations saved for backward by the whole decode,
+# plus the activations of the largest block that is recomputed at once during backward. On CUDA devices the peak allocated memory is also reported.
+# Run with: python benchmarks/tiled_decode.py
+# Use --device cuda:0 to benchmark on a GPU.
+
+import argparse
+import time
+import torch
+from taming.modules.diffusionmodules.model import Decoder
+from vqgan_clip import _functional as VF
+
+
+class VQGANDecoder(torch.nn.Module):
+    # the decode path of a taming VQModel
+    def __init__(self):
+        super().__init__()
+        self.post_quant_conv = torch.nn.Conv2d(256, 256, 1)
+        self.decoder = Decoder(ch=128, out_ch=3, ch_mult=[1,1,2,2,4], num_res_blocks=2, attn_resolutions=[16], in_channels=3,
+                               resolution=256, z_channels=256, dropout=0.0)
+
+    def decode(self, quant):
+        return self.decoder(self.post_quant_conv(quant))
+
+
+def saved_activation_bytes(decode, quant):
+    saved = {}
+    def pack(tensor):
+        saved[id(tensor)] = tensor.numel() * tensor.element_size()
+        return tensor
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        output = decode(quant)
+    del output
+    return sum(saved.values())
+
+
+def timed(decode, quant):
+    if quant.is_cuda:
+        torch.cuda.synchronize(quant.device)
+        torch.cuda.reset_peak_memory_stats(quant.device)
+        base = torch.cuda.memory_allocated(quant.device)
+    start = time.perf_counter()
+    decode(quant).square().mean().backward()
+    if quant.is_cuda:
+        torch.cuda.synchronize(quant.device)
+    peak = torch.cuda.max_memory_allocated(quant.device) - base if quant.is_cuda else None
+    return time.perf_counter() - start, peak
+
+
+parser = argparse.ArgumentParser(description='Benchmark tiled decoding of the VQGAN latent.')
+parser.add_argument('--device', default='cpu')
+parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512])
+parser.add_argument('--tile_size', type=int, default=8)
+parser.add_argument('--overlap', type=int, default=2)
+args = parser.parse_args()
+
+device = torch.device(args.device)
+torch.manual_seed(0)
+model = VQGANDecoder().eval().requires_grad_(False).to(device)
+memory_per_latent = VF.decode_memory_per_latent(model)
+print(f'{memory_per_latent / 2**20:.2f} MB of activations per latent vector')
+
+print(f'{"size":>6} {"method":>8} {"memory (MB)":>12} {"peak (MB)":>10} {"time (s)":>9}')
+for size in args.sizes:
+    latent_size = size // 16
+    quant = torch.randn([1, 256, latent_size, latent_size], device=device, requires_grad=True)
+    methods = {'decode': (model.decode, 0),
+               'tiled': (lambda quant: VF.tiled_decode(model, quant, args.tile_size, args.overlap), memory_per_latent * args.tile_size**2 if latent_size > args.tile_size else 0)}
+    for name, (decode, recomputed) in methods.items():
+        memory = saved_activation_bytes(decode, quant) + recomputed
+        seconds, peak = timed(decode, quant)
+        peak = f'{peak / 2**20:>10.1f}' if peak is not None else f'{"-":>10}'
+        print(f'{size:>6} {name:>8} {memory / 2**20:>12.1f} {peak} {seconds:>9.3f}')
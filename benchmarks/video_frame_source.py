@@ -0,0 +1,47 @@
+# Compare two ways of reading the source frames of a style transfer: extracting every frame to JPEG files with
+# video_tools.extract_video_frames() and opening them, and decoding them from an ffmpeg pipe with video_tools.VideoFrameSource.
+# Each frame is resized to the output size, as style_transfer() does, and the time to the first frame, the total time, and the
+# disk space used by the frames are reported. ffmpeg must be on the PATH.
+# Run with: python benchmarks/video_frame_source.py input.mp4 --framerate 30 --size 512 288
+
+import argparse
+import os
+import tempfile
+import time
+from PIL import Image
+from vqgan_clip import video_tools
+
+
+def extracted(path, args):
+    frames = video_tools.extract_video_frames(args.input_video, args.framerate, os.path.join(path, 'extracted'))
+    for frame in frames:
+        yield Image.open(frame).convert('RGB').resize(args.size, resample=Image.LANCZOS)
+
+
+def streamed(path, args):
+    yield from video_tools.VideoFrameSource(args.input_video, extraction_framerate=args.framerate, size=args.size)
+
+
+def disk_usage_mb(path):
+    return sum(os.path.getsize(os.path.join(folder, file)) for folder, _, files in os.walk(path) for file in files) / 1024**2
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark reading source video frames.')
+    parser.add_argument('input_video')
+    parser.add_argument('--framerate', type=int, default=30)
+    parser.add_argument('--size', type=int, nargs=2, default=[512, 288])
+    args = parser.parse_args()
+
+    print(f'{"source":>20} {"frames":>6} {"first frame (s)":>15} {"total (s)":>9} {"disk (MB)":>9}')
+    for name, method in [('extract_video_frames', extracted), ('VideoFrameSource', streamed)]:
+        with tempfile.TemporaryDirectory() as path:
+            start = time.perf_counter()
+            first_frame = None
+            num_frames = 0
+            for frame in method(path, args):
+                first_frame = first_frame or time.perf_counter() - start
+                num_frames += 1
+            seconds = time.perf_counter() - start
+            disk = disk_usage_mb(path)
+        print(f'{name:>20} {num_frames:>6} {first_frame:>15.2f} {seconds:>9.2f} {disk:>9.1f}')
@@ -0,0 +1,56 @@
+# Compare two ways of turning generated frames into a video: saving each frame as a JPEG with AsyncImageWriter and then encoding the
+# folder with video_tools.encode_video(), and piping the frames straight to ffmpeg with video_tools.FFmpegVideoWriter.
+# The frames are random tensors submitted as fast as possible, so this measures the cost of the sink alone, from the first frame
+# submitted to the finished video. ffmpeg must be on the PATH.
+# Run with: python benchmarks/video_sink.py --num_frames 300 --size 512
+
+import argparse
+import os
+import tempfile
+import time
+import torch
+from vqgan_clip import video_tools
+from vqgan_clip.image_writer import AsyncImageWriter
+
+
+def frames(num_frames, size):
+    generator = torch.Generator().manual_seed(0)
+    base = torch.rand([1, 3, size, size], generator=generator)
+    for frame_num in range(num_frames):
+        yield base.roll(frame_num, dims=3)
+
+
+def jpeg_folder(path, num_frames, size, framerate):
+    stills_path = os.path.join(path, 'stills')
+    os.makedirs(stills_path)
+    with AsyncImageWriter() as writer:
+        for frame_num, frame in enumerate(frames(num_frames, size), start=1):
+            writer.submit(frame, os.path.join(stills_path, f'frame_{frame_num:012d}.jpg'), [('text_prompts', 'A red sailboat'), ('frame', frame_num)])
+    video_tools.encode_video(os.path.join(path, 'jpeg_folder.mp4'), framerate, path_to_stills=stills_path)
+
+
+def stream(path, num_frames, size, framerate, save_stills):
+    stills_path = os.path.join(path, 'streamed_stills')
+    os.makedirs(stills_path)
+    with video_tools.FFmpegVideoWriter(os.path.join(path, 'stream.mp4'), framerate, save_stills=save_stills) as writer:
+        for frame_num, frame in enumerate(frames(num_frames, size), start=1):
+            writer.submit(frame, os.path.join(stills_path, f'frame_{frame_num:012d}.jpg'), [('text_prompts', 'A red sailboat'), ('frame', frame_num)])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark encoding generated frames to a video.')
+    parser.add_argument('--num_frames', type=int, default=300)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--framerate', type=int, default=30)
+    args = parser.parse_args()
+
+    print(f'{"sink":>28} {"time (s)":>9} {"frames/s":>9}')
+    methods = [('JPEG folder + encode_video', lambda path: jpeg_folder(path, args.num_frames, args.size, args.framerate)),
+               ('FFmpegVideoWriter', lambda path: stream(path, args.num_frames, args.size, args.framerate, False)),
+               ('FFmpegVideoWriter + stills', lambda path: stream(path, args.num_frames, args.size, args.framerate, True))]
+    for name, method in methods:
+        with tempfile.TemporaryDirectory() as path:
+            start = time.perf_counter()
+            method(path)
+            seconds = time.perf_counter() - start
+        print(f'{name:>28} {seconds:>9.2f} {args.num_frames / seconds:>9.1f}')
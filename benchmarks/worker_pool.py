@@ -0,0 +1,71 @@
+# Measure how images per hour and memory use scale with the number of workers in a vqgan_clip.worker_pool.ImageWorkerPool.
+# Random-weight stand-ins for the VQGAN and CLIP models (benchmarks/stand_in_models.py) are used, so no model download is needed.
+# Memory is the total proportional set size (PSS) of this process and its workers, read from /proc, so memory that is shared by
+# several processes (such as the model weights) is only counted once. It is only reported on Linux.
+# Images per hour should scale with the number of workers, up to the number of CPU cores, while memory grows by much less than
+# one copy of the models per worker.
+# Run with: python benchmarks/worker_pool.py --workers 1 2 4 8
+
+import argparse
+import os
+import tempfile
+import time
+from vqgan_clip.engine import VQGAN_CLIP_Config
+from vqgan_clip.worker_pool import ImageWorkerPool
+from stand_in_models import register
+
+
+def total_pss_mb():
+    pids = [os.getpid()] + child_pids(os.getpid())
+    total = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/smaps_rollup') as file:
+                total += sum(int(line.split()[1]) for line in file if line.startswith('Pss:'))
+        except OSError:
+            return None
+    return total / 1024
+
+
+def child_pids(parent):
+    try:
+        with open(f'/proc/{parent}/task/{parent}/children') as file:
+            return [int(pid) for pid in file.read().split()]
+    except OSError:
+        return []
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark ImageWorkerPool with random-weight stand-in models.')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--images_per_worker', type=int, default=2)
+    parser.add_argument('--image_size', type=int, default=128)
+    parser.add_argument('--iterations', type=int, default=10)
+    args = parser.parse_args()
+
+    config = VQGAN_CLIP_Config()
+    config.cuda_device = args.device
+    config.output_image_size = [args.image_size, args.image_size]
+    config.cut_method = 'original'
+    config.num_cuts = 8
+    register(config)
+
+    print(f'{"workers":>7} {"images":>6} {"images/hour":>12} {"speedup":>8} {"memory (MB)":>12}')
+    baseline = None
+    for num_workers in args.workers:
+        num_images = num_workers * args.images_per_worker
+        with tempfile.TemporaryDirectory() as path, ImageWorkerPool(config, num_workers=num_workers) as pool:
+            # start the workers, and load them with the models, before timing
+            list(pool.map([dict(output_filename=os.path.join(path, f'warmup_{worker_num}.jpg'), text_prompts='A red sailboat', iterations=1)
+                           for worker_num in range(num_workers)]))
+            jobs = [dict(output_filename=os.path.join(path, f'{image_num}.jpg'), text_prompts='A red sailboat', iterations=args.iterations, seed=image_num)
+                    for image_num in range(num_images)]
+            start = time.perf_counter()
+            list(pool.map(jobs))
+            seconds = time.perf_counter() - start
+            memory = total_pss_mb()
+        images_per_hour = 3600 * num_images / seconds
+        baseline = baseline or images_per_hour
+        memory = f'{memory:>12.0f}' if memory is not None else f'{"-":>12}'
+        print(f'{num_workers:>7} {num_images:>6} {images_per_hour:>12.0f} {images_per_hour / baseline:>7.2f}x {memory}')
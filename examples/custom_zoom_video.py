@@ -5,15 +5,15 @@
 # Note that any input images or video are not provided for example scripts, you will have to provide your own.
 
 import contextlib
+import torch
 from vqgan_clip import _functional as VF
-from torchvision.transforms import functional as TF
 import vqgan_clip
 from vqgan_clip.engine import Engine, VQGAN_CLIP_Config
 from vqgan_clip import video_tools
 from vqgan_clip.z_smoother import Z_Smoother
 from tqdm.auto import tqdm
 import os
-from PIL import ImageFile, ImageChops
+from PIL import ImageFile
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 # EXAMPLE HERE: you can set your parameters up to change with each frame of video.
@@ -78,7 +78,6 @@ else:
 # Smooth the latent vector z with recent results. Maintain a list of recent latent vectors.
 smoothed_z = Z_Smoother(
     buffer_len=z_smoother_buffer_len, alpha=z_smoother_alpha)
-output_image_size_x, output_image_size_y = eng.calculate_output_image_size()
 # generate images
 try:
     for video_frame_num in tqdm(range(1, num_video_frames+1), unit='frame', desc='video frames'):
@@ -95,19 +94,11 @@ try:
 
         shift_x, shift_y, zoom_scale = parameters_by_frame(video_frame_num)
 
-        # Zoom / shift the generated image
-        pil_image = TF.to_pil_image(eng.output_tensor[0].cpu())
-        if zoom_scale != 1.0:
-            new_pil_image = VF.zoom_at(
-                pil_image, output_image_size_x/2, output_image_size_y/2, zoom_scale)
-        else:
-            new_pil_image = pil_image
-
-        if shift_x or shift_y:
-            new_pil_image = ImageChops.offset(new_pil_image, shift_x, shift_y)
-
-        # Re-encode and use this as the new initial image for the next iteration
-        eng.convert_image_to_init_image(new_pil_image)
+        # Zoom / shift the generated image on the GPU
+        with torch.no_grad():
+            new_image = VF.affine_transform(eng.output_tensor, zoom_scale, shift_x, shift_y)
+            # Re-encode and use this as the new initial image for the next iteration
+            eng.convert_tensor_to_init_image(new_image)
 
         eng.configure_optimizer()
 
@@ -1,8 +1,10 @@
 # Generate a folder of multiple images based on a text prompt.
 # This might be useful if you want to try different random number generator seeds.
+# The images are generated in parallel by several worker processes.
 # Note that any input images or video are not provided for example scripts, you will have to provide your own.
-from vqgan_clip import generate, esrgan
+from vqgan_clip import esrgan
 from vqgan_clip.engine import VQGAN_CLIP_Config
+from vqgan_clip.worker_pool import ImageWorkerPool
 from vqgan_clip import _functional as VF
 import os
 from tqdm.auto import tqdm
@@ -47,23 +49,25 @@ art_types = ["8k resolution", "pencil sketch", "8K 3D", "deviantart", "CryEngine
              "trending on artstation", "instax", "ilford HPS", "matte drawing", "by Ed Hopper",
              "Kodak Portra", "Rococo", "by James Gurney", "by Thomas Kinkade", "by Paul Cezanne"]
 
-for art_type in tqdm(art_types, unit='style', desc='art type'):
-    metadata_comment = generate.image(eng_config=config,
-                                      text_prompts=text_prompts + ' ' + art_type,
-                                      #image_prompts='input image.jpg',
-                                      iterations=1000,
-                                      save_every=None,
-                                      output_filename=f'{generated_images_path}{os.sep}{art_type}.jpg',
-                                      leave_progress_bar=False)
+if __name__ == '__main__':
+    # The art types are independent images, so they are generated several at a time by a pool of worker processes that share the models.
+    with ImageWorkerPool(config, num_workers=4) as pool:
+        jobs = [dict(output_filename=f'{generated_images_path}{os.sep}{art_type}.jpg',
+                     text_prompts=text_prompts + ' ' + art_type,
+                     #image_prompts='input image.jpg',
+                     iterations=1000,
+                     save_every=None) for art_type in art_types]
+        for metadata_comment in tqdm(pool.map(jobs), total=len(jobs), unit='style', desc='art type'):
+            pass
 
-# Upscale the image
-if upscale_images:
-    esrgan.inference_realesrgan(input=generated_images_path,
-                                output_images_path=upscaled_video_frames_path,
-                                face_enhance=face_enhance,
-                                purge_existing_files=True,
-                                netscale=4,
-                                outscale=4)
-    # copy metadata from generated images to upscaled images.
-    VF.copy_image_metadata(generated_images_path, upscaled_video_frames_path)
-print(f'generation parameters: {metadata_comment}')
+    # Upscale the image
+    if upscale_images:
+        esrgan.inference_realesrgan(input=generated_images_path,
+                                    output_images_path=upscaled_video_frames_path,
+                                    face_enhance=face_enhance,
+                                    purge_existing_files=True,
+                                    netscale=4,
+                                    outscale=4)
+        # copy metadata from generated images to upscaled images.
+        VF.copy_image_metadata(generated_images_path, upscaled_video_frames_path)
+    print(f'generation parameters: {metadata_comment}')
@@ -6,7 +6,6 @@ from vqgan_clip import generate, esrgan
 from vqgan_clip.engine import VQGAN_CLIP_Config
 from vqgan_clip import _functional as VF
 import os
-from tqdm.auto import tqdm
 
 config = VQGAN_CLIP_Config()
 config.output_image_size = [256, 144]
@@ -20,13 +19,14 @@ number_images_to_generate = 5
 upscale_images = True
 face_enhance = False
 
-for image_number in tqdm(range(1, number_images_to_generate+1), unit='image', desc='random seeds'):
-    metadata_comment = generate.image(eng_config=config,
-                                      text_prompts=text_prompts,
-                                      iterations=200,
-                                      save_every=50,
-                                      output_filename=f'{generated_images_path}{os.sep}frame_{image_number:012d}.jpg',
-                                      leave_progress_bar=False)
+# All of the seeds are optimized together in a single batch
+seeds = list(range(1, number_images_to_generate+1))
+metadata_comment = generate.images(eng_config=config,
+                                   text_prompts=text_prompts,
+                                   seeds=seeds,
+                                   iterations=200,
+                                   save_every=50,
+                                   output_filenames=[f'{generated_images_path}{os.sep}frame_{seed:012d}.jpg' for seed in seeds])
 
 # Upscale the image
 if upscale_images:
@@ -19,7 +19,7 @@ text_prompts = 'portrait on deviantart'
 input_video_path = '20211004 132008000_iOS.MOV'
 # all folders will be created within the output_root_dir
 output_root_dir = 'example media'
-# Generated video framerate. Images will be extracted from the source video at this framerate, using interpolation if needed.
+# Generated video framerate. Images will be decoded from the source video at this framerate, using interpolation if needed.
 video_framerate = 30
 # number of frames of video to process before stopping. If using z_smoothing, suggest at least 10 frames.
 frames_to_process = 10
@@ -27,7 +27,6 @@ frames_to_process = 10
 # Set some paths
 generated_video_frames_path = os.path.join(output_root_dir, 'generated video frames')
 final_output_images_path = os.path.join(output_root_dir, 'parameter tests')
-extracted_video_frames_path = os.path.join(output_root_dir, 'extracted video frames')
 
 # ensure the output folder exists and is empty.
 os.makedirs(final_output_images_path, exist_ok=True)
@@ -36,13 +35,10 @@ for f in glob.glob(os.path.join(generated_video_frames_path, '*.jpg')):
 for f in glob.glob(os.path.join(final_output_images_path, '*.jpg')):
     os.remove(f)
 
-# Use a wrapper for FFMPEG to extract stills from the original video.
-original_video_frames = video_tools.extract_video_frames(input_video_path,
-                                                         extraction_framerate=video_framerate,
-                                                         extracted_video_frames_path=extracted_video_frames_path)
-
-# Truncate to only the desired number of frames.
-del original_video_frames[frames_to_process:]
+# Decode only the desired number of frames from the original video, as they are needed, instead of extracting every frame to disk.
+original_video_frames = video_tools.VideoFrameSource(input_video_path,
+                                                     extraction_framerate=video_framerate,
+                                                     end_frame=frames_to_process)
 
 # set the parameters below to lists of values that you would like to explore. All combinations will be tested.
 # For parameters you want to stay fixed, use lists with one element, e.g. [0.2]
@@ -61,7 +57,7 @@ for current_source_frame_image_weight, iterations_per_frame, current_source_fram
     config.seed = 1
     config.cudnn_determinism = True
     config.output_image_size = [256, 256]
-    # Apply a style to the extracted video frames.
+    # Apply a style to the video frames.
     metadata_comment = generate.style_transfer(original_video_frames,
                                                eng_config=config,
                                                current_source_frame_image_weight=current_source_frame_image_weight,
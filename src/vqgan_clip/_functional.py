@@ -6,15 +6,14 @@ from PIL import ImageFile, Image, PngImagePlugin, ImageChops
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 import numpy as np
 from torch.nn import functional as F
-import kornia.augmentation as K
-from torchvision.transforms import functional as TF
-from torchvision import transforms
-from omegaconf import OmegaConf
-from taming.models import cond_transformer, vqgan
+from torchvision.ops import roi_align
+from torch.utils import checkpoint as torch_checkpoint
+import inspect
 import glob, os
 import subprocess
 import contextlib
-import piexif
+import collections
+import warnings
 
 def sinc(x):
     return torch.where(x != 0, torch.sin(math.pi * x) / (math.pi * x), x.new_ones([]))
@@ -28,14 +27,45 @@ def lanczos(x, a):
 
 def ramp(ratio, width):
     n = math.ceil(width / ratio + 1)
-    out = torch.empty([n])
-    cur = 0
-    for i in range(out.shape[0]):
-        out[i] = cur
-        cur += ratio
+    out = (torch.arange(n, dtype=torch.float64) * ratio).float()
     return torch.cat([-out[1:].flip([0]), out])[1:-1]
 
 
+class LanczosKernelCache:
+    """Least recently used cache of the 1D Lanczos kernels used by resample(). Cutout sizes repeat from one
+    iteration to the next, so after a few iterations every kernel is read from the cache instead of being rebuilt.
+
+    Args:
+        max_entries (int, optional): Maximum number of kernels to keep. 0 disables caching. Defaults to 1024.
+    """
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._kernels = collections.OrderedDict()
+
+    def get(self, ratio, device, dtype):
+        """Return the Lanczos kernel for a downsampling ratio, on the requested device and dtype.
+        """
+        key = (ratio, device, dtype)
+        kernel = self._kernels.get(key)
+        if kernel is not None:
+            self._kernels.move_to_end(key)
+            return kernel
+        kernel = lanczos(ramp(ratio, 2), 2).to(device, dtype)
+        if self.max_entries > 0:
+            self._kernels[key] = kernel
+            if len(self._kernels) > self.max_entries:
+                self._kernels.popitem(last=False)
+        return kernel
+
+    def clear(self):
+        self._kernels.clear()
+
+    def __len__(self):
+        return len(self._kernels)
+
+lanczos_kernel_cache = LanczosKernelCache()
+
+
 # For zoom video
 def zoom_at(img, x, y, zoom):
     w, h = img.size
@@ -44,6 +74,67 @@ def zoom_at(img, x, y, zoom):
                     x + w / zoom2, y + h / zoom2))
     return img.resize((w, h), Image.LANCZOS)
 
+def affine_transform(image, zoom=1.0, shift_x=0, shift_y=0, rotation=0.0):
+    """Zoom, rotate and shift a batch of images on the device where they already are. With no rotation this is equivalent to zoom_at()
+    around the center of the image followed by ImageChops.offset(). Pixels shifted off one edge wrap around to the other edge, and areas
+    that have no source pixels after zooming out or rotating are black.
+
+    Args:
+        image (tensor): Images with values between 0 and 1, [N, C, H, W].
+        zoom (float, optional): Zoom ratio around the center of the image. Values above 1 zoom in. Defaults to 1.0.
+        shift_x (float, optional): Number of pixels to shift the image to the right. Defaults to 0.
+        shift_y (float, optional): Number of pixels to shift the image down. Defaults to 0.
+        rotation (float, optional): Angle in degrees to rotate the image counterclockwise around its center. Defaults to 0.0.
+
+    Returns:
+        tensor: The transformed images, [N, C, H, W].
+    """
+    n, _, h, w = image.shape
+    if zoom == 1.0 and rotation == 0.0 and float(shift_x).is_integer() and float(shift_y).is_integer():
+        # a whole pixel shift is exact, and does not need resampling
+        return torch.roll(image, (int(shift_y), int(shift_x)), dims=(2, 3))
+    grid = _affine_source_grid(n, h, w, zoom, shift_x, shift_y, rotation, image.device, image.dtype)
+    return F.grid_sample(_wrap_pad(image), grid, mode='bicubic', padding_mode='zeros', align_corners=False).clamp(0, 1)
+
+def warp_latent(z, zoom=1.0, shift_x=0, shift_y=0, rotation=0.0):
+    """Zoom, rotate and shift a latent vector in the same way as affine_transform(), but in units of latent vectors instead of pixels, so shifts
+    can be fractions of a latent vector. Latent vectors are interpolated bilinearly, and areas without a source after zooming out or rotating
+    are filled by reflection instead of with black.
+
+    Args:
+        z (tensor): Latent vectors, or tensors of the same shape such as optimizer state, [N, C, H, W].
+        zoom (float, optional): Zoom ratio around the center. Values above 1 zoom in. Defaults to 1.0.
+        shift_x (float, optional): Number of latent vectors to shift to the right. Defaults to 0.
+        shift_y (float, optional): Number of latent vectors to shift down. Defaults to 0.
+        rotation (float, optional): Angle in degrees to rotate counterclockwise around the center. Defaults to 0.0.
+
+    Returns:
+        tensor: The transformed latent vectors, [N, C, H, W].
+    """
+    n, _, h, w = z.shape
+    if zoom == 1.0 and rotation == 0.0 and float(shift_x).is_integer() and float(shift_y).is_integer():
+        return torch.roll(z, (int(shift_y), int(shift_x)), dims=(2, 3))
+    grid = _affine_source_grid(n, h, w, zoom, shift_x, shift_y, rotation, z.device, z.dtype)
+    return F.grid_sample(_wrap_pad(z), grid, mode='bilinear', padding_mode='reflection', align_corners=False)
+
+# number of pixels added around each edge by _wrap_pad(), enough for bicubic interpolation
+_WRAP_PAD = 2
+
+def _wrap_pad(input):
+    # pad with the pixels from the opposite edge, so that interpolation across an edge that a shift has wrapped around blends both sides
+    return F.pad(input, (_WRAP_PAD,) * 4, mode='circular')
+
+def _affine_source_grid(n, h, w, zoom, shift_x, shift_y, rotation, device, dtype):
+    # grid_sample grid, for an input padded by _wrap_pad(), that maps each output pixel to its source pixel. The wrapped shift is undone first,
+    # then the rotation and zoom around the image center. Units are pixels from the center until the grid is normalized.
+    ys = torch.remainder(torch.arange(h, device=device, dtype=dtype) + 0.5 - shift_y, h) - h / 2
+    xs = torch.remainder(torch.arange(w, device=device, dtype=dtype) + 0.5 - shift_x, w) - w / 2
+    y, x = ys[:, None].expand(h, w), xs[None, :].expand(h, w)
+    angle = math.radians(rotation)
+    source_x = (x * math.cos(angle) - y * math.sin(angle)) / zoom
+    source_y = (x * math.sin(angle) + y * math.cos(angle)) / zoom
+    return torch.stack([source_x * 2 / (w + 2 * _WRAP_PAD), source_y * 2 / (h + 2 * _WRAP_PAD)], dim=-1).expand(n, h, w, 2)
+
 
 # NR: Testing with different intital images
 def make_random_noise_image(w,h):
@@ -80,24 +171,50 @@ def resample(input, size, align_corners=True):
     n, c, h, w = input.shape
     dh, dw = size
 
-    input = input.view([n * c, 1, h, w])
+    # every channel of every image is filtered independently, as one depthwise convolution
+    input = input.reshape([1, n * c, h, w])
 
     if dh < h:
-        kernel_h = lanczos(ramp(dh / h, 2), 2).to(input.device, input.dtype)
+        kernel_h = lanczos_kernel_cache.get(dh / h, input.device, input.dtype)
         pad_h = (kernel_h.shape[0] - 1) // 2
         input = F.pad(input, (0, 0, pad_h, pad_h), 'reflect')
-        input = F.conv2d(input, kernel_h[None, None, :, None])
+        input = F.conv2d(input, kernel_h[None, None, :, None].expand(n * c, 1, -1, 1), groups=n * c)
 
     if dw < w:
-        kernel_w = lanczos(ramp(dw / w, 2), 2).to(input.device, input.dtype)
+        kernel_w = lanczos_kernel_cache.get(dw / w, input.device, input.dtype)
         pad_w = (kernel_w.shape[0] - 1) // 2
         input = F.pad(input, (pad_w, pad_w, 0, 0), 'reflect')
-        input = F.conv2d(input, kernel_w[None, None, None, :])
+        input = F.conv2d(input, kernel_w[None, None, None, :].expand(n * c, 1, 1, -1), groups=n * c)
 
     input = input.view([n, c, h, w])
     return F.interpolate(input, size, mode='bicubic', align_corners=align_corners)
 
 
+def resample_cutouts(input, offsets, sizes, cut_size):
+    """Crop square cutouts from input and resample them all to cut_size. Cutouts that share a size are
+    stacked and resampled together in a single resample() call, which gives the same result as resampling
+    each cutout on its own.
+
+    Args:
+        input (tensor): Images of shape [batch, C, H, W]
+        offsets (list of (int, int)): (x, y) offset of each cutout.
+        sizes (list of int): Width and height of each cutout.
+        cut_size (int): Width and height of the resampled cutouts.
+
+    Returns:
+        tensor: Cutouts of shape [len(sizes) * batch, C, cut_size, cut_size], in the order they were given.
+    """
+    batch_size = input.shape[0]
+    cutouts = [None] * len(sizes)
+    for size in set(sizes):
+        indices = [i for i, cut in enumerate(sizes) if cut == size]
+        crops = torch.cat([input[:, :, offsets[i][1]:offsets[i][1] + size, offsets[i][0]:offsets[i][0] + size] for i in indices])
+        resampled = resample(crops, (cut_size, cut_size))
+        for group_index, i in enumerate(indices):
+            cutouts[i] = resampled[group_index * batch_size:(group_index + 1) * batch_size]
+    return torch.cat(cutouts, dim=0)
+
+
 class ReplaceGrad(torch.autograd.Function):
     @staticmethod
     def forward(ctx, x_forward, x_backward):
@@ -123,12 +240,267 @@ class ClampWithGrad(torch.autograd.Function):
         return grad_in * (grad_in * (input - input.clamp(ctx.min, ctx.max)) >= 0), None, None
 
 
+class VectorQuantizer(nn.Module):
+    """Snap latent vectors to their nearest entry in a fixed VQGAN codebook, with a straight-through gradient.
+    The codebook norms and transposed codebook are computed once, rather than on every forward pass, and codes
+    are looked up by index instead of through a one-hot matrix product.
+
+    The distance matrix between latent vectors and codebook entries is [H*W, n_e]. Setting chunk_size bounds
+    its memory by searching chunk_size latent vectors at a time. With approximate=True, the codebook is
+    clustered once with k-means, and each latent vector is only compared to the entries of its num_probes
+    nearest clusters. This is faster and uses less memory, but does not always find the exact nearest entry.
+    Use disagreement_rate() to measure how often it differs from an exact search.
+
+    Args:
+        codebook (tensor): VQGAN codebook, [n_e, e_dim]. It is treated as constant.
+        chunk_size (int, optional): Maximum number of latent vectors searched at a time. None searches all of them at once. Defaults to None.
+        approximate (bool, optional): Search only the codebook clusters nearest to each latent vector. Defaults to False.
+        num_probes (int, optional): Number of codebook clusters searched for each latent vector when approximate is True. Defaults to 8.
+        num_clusters (int, optional): Number of k-means clusters in the coarse index. None uses the square root of the codebook size. Defaults to None.
+    """
+    def __init__(self, codebook, chunk_size=None, approximate=False, num_probes=8, num_clusters=None):
+        super().__init__()
+        if chunk_size is not None and chunk_size < 1:
+            raise ValueError('chunk_size must be a positive integer or None.')
+        if num_probes < 1:
+            raise ValueError('num_probes must be a positive integer.')
+        codebook = codebook.detach()
+        self.chunk_size = chunk_size
+        self.approximate = approximate
+        self.num_probes = num_probes
+        self.register_buffer('codebook', codebook)
+        self.register_buffer('codebook_t', codebook.t().contiguous())
+        self.register_buffer('codebook_norms', codebook.pow(2).sum(dim=1))
+        if approximate:
+            self._build_coarse_index(num_clusters or max(1, round(codebook.shape[0]**0.5)))
+
+    def _build_coarse_index(self, num_clusters, iterations=20):
+        # k-means over the codebook, with a fixed seed so that the index does not depend on, or change, the global random state
+        codebook = self.codebook.float()
+        num_clusters = min(num_clusters, codebook.shape[0])
+        gen = torch.Generator().manual_seed(0)
+        centroids = codebook[torch.randperm(codebook.shape[0], generator=gen)[:num_clusters].to(codebook.device)]
+        for _ in range(iterations):
+            assignments = torch.addmm(centroids.pow(2).sum(dim=1), codebook, centroids.t(), alpha=-2).argmin(-1)
+            counts = torch.bincount(assignments, minlength=num_clusters)
+            centroids = torch.zeros_like(centroids).index_add_(0, assignments, codebook) / counts.clamp(min=1)[:, None]
+            empty = counts == 0
+            if empty.any():
+                # restart empty clusters from random codebook entries
+                centroids[empty] = codebook[torch.randint(codebook.shape[0], [int(empty.sum())], generator=gen).to(codebook.device)]
+        assignments = torch.addmm(centroids.pow(2).sum(dim=1), codebook, centroids.t(), alpha=-2).argmin(-1)
+        counts = torch.bincount(assignments, minlength=num_clusters)
+        # store the codebook sorted by cluster, so that each cluster is a contiguous block of entries
+        order = assignments.argsort()
+        centroids = centroids.to(self.codebook.dtype)
+        self.register_buffer('cluster_centroids_t', centroids.t().contiguous())
+        self.register_buffer('cluster_centroid_norms', centroids.pow(2).sum(dim=1))
+        self.register_buffer('cluster_order', order)
+        self.register_buffer('cluster_codebook_t', self.codebook[order].t().contiguous())
+        self.register_buffer('cluster_codebook_norms', self.codebook_norms[order])
+        ends = counts.cumsum(0).tolist()
+        self._cluster_bounds = list(zip([0] + ends[:-1], ends))
+
+    def _exact_indices(self, chunk):
+        # |x|^2 is the same for every codebook entry of a latent vector, so it does not change the argmin
+        return torch.addmm(self.codebook_norms, chunk, self.codebook_t, alpha=-2).argmin(-1)
+
+    def _approximate_indices(self, chunk):
+        num_probes = min(self.num_probes, len(self._cluster_bounds))
+        probes = torch.addmm(self.cluster_centroid_norms, chunk, self.cluster_centroids_t, alpha=-2).topk(num_probes, dim=-1, largest=False).indices
+        best_distances = torch.full([chunk.shape[0]], float('inf'), device=chunk.device, dtype=chunk.dtype)
+        best_indices = torch.zeros([chunk.shape[0]], device=chunk.device, dtype=torch.long)
+        for cluster in probes.unique().tolist():
+            start, end = self._cluster_bounds[cluster]
+            if start == end:
+                continue
+            rows = (probes == cluster).any(-1).nonzero().squeeze(1)
+            distances, indices = torch.addmm(self.cluster_codebook_norms[start:end], chunk[rows], self.cluster_codebook_t[:, start:end], alpha=-2).min(-1)
+            closer = distances < best_distances[rows]
+            best_distances[rows] = torch.where(closer, distances, best_distances[rows])
+            best_indices[rows] = torch.where(closer, indices + start, best_indices[rows])
+        return self.cluster_order[best_indices]
+
+    def nearest_indices(self, x, approximate=None):
+        """Index of the nearest codebook entry for each latent vector.
+
+        Args:
+            x (tensor): Latent vectors, [..., e_dim].
+            approximate (bool, optional): Override the search mode chosen when the quantizer was created. Defaults to None.
+
+        Returns:
+            tensor: Codebook indices, with the shape of x without its last dimension.
+        """
+        approximate = self.approximate if approximate is None else approximate
+        if approximate and not hasattr(self, '_cluster_bounds'):
+            raise ValueError('This quantizer was created without a coarse index. Use approximate=True when creating it.')
+        search = self._approximate_indices if approximate else self._exact_indices
+        flat = x.detach().reshape(-1, x.shape[-1])
+        indices = [search(chunk) for chunk in flat.split(self.chunk_size or max(flat.shape[0], 1))]
+        return torch.cat(indices).view(x.shape[:-1])
+
+    def disagreement_rate(self, x):
+        """Fraction of latent vectors for which the approximate search picks a different codebook entry than the exact search.
+
+        Args:
+            x (tensor): Latent vectors, [..., e_dim].
+
+        Returns:
+            float: Fraction between 0 and 1. Always 0 for a quantizer that uses exact search.
+        """
+        if not self.approximate:
+            return 0.
+        with torch.no_grad():
+            approximate = self.nearest_indices(x, approximate=True)
+            exact = self.nearest_indices(x, approximate=False)
+        return (approximate != exact).float().mean().item()
+
+    def forward(self, x):
+        x_q = F.embedding(self.nearest_indices(x), self.codebook)
+        replace_grad = ReplaceGrad.apply
+        return replace_grad(x_q, x)
+
+
 def vector_quantize(x, codebook):
-    d = x.pow(2).sum(dim=-1, keepdim=True) + codebook.pow(2).sum(dim=1) - 2 * x @ codebook.T
-    indices = d.argmin(-1)
-    x_q = F.one_hot(indices, codebook.shape[0]).to(d.dtype) @ codebook
-    replace_grad = ReplaceGrad.apply
-    return replace_grad(x_q, x)
+    return VectorQuantizer(codebook)(x)
+
+# non-reentrant checkpointing also works when the input does not require grad, but is only available in newer versions of pytorch
+_CHECKPOINT_KWARGS = {'use_reentrant': False} if 'use_reentrant' in inspect.signature(torch_checkpoint.checkpoint).parameters else {}
+
+def _checkpoint(function, *args):
+    return torch_checkpoint.checkpoint(function, *args, **_CHECKPOINT_KWARGS)
+
+def checkpointed_decode(model, quant):
+    """Equivalent to model.decode(quant), with activation checkpointing of every block of the VQGAN decoder. Only the input of each block is kept
+    for the backward pass, and the activations inside the block are recomputed during backward. This uses much less memory for large images,
+    at the cost of running the decoder forward pass twice.
+
+    Args:
+        model (VQModel): VQGAN model, with post_quant_conv and a taming Decoder.
+        quant (tensor): Quantized latent vector, [batch, e_dim, H, W].
+
+    Returns:
+        tensor: Decoded image, in the range used by the model (approximately -1 to 1).
+    """
+    decoder = model.decoder
+    # mirrors taming.modules.diffusionmodules.model.Decoder.forward, which has no timestep embedding
+    h = decoder.conv_in(model.post_quant_conv(quant))
+    h = _checkpoint(lambda h: decoder.mid.block_2(decoder.mid.attn_1(decoder.mid.block_1(h, None)), None), h)
+    for i_level in reversed(range(decoder.num_resolutions)):
+        up = decoder.up[i_level]
+        for i_block in range(decoder.num_res_blocks+1):
+            if len(up.attn) > 0:
+                h = _checkpoint(lambda h, block=up.block[i_block], attn=up.attn[i_block]: attn(block(h, None)), h)
+            else:
+                h = _checkpoint(lambda h, block=up.block[i_block]: block(h, None), h)
+        if i_level != 0:
+            h = _checkpoint(up.upsample, h)
+    if decoder.give_pre_end:
+        return h
+    return _checkpoint(lambda h: decoder.conv_out(_swish(decoder.norm_out(h))), h)
+
+def _swish(x):
+    # the nonlinearity used by the taming decoder
+    return x * torch.sigmoid(x)
+
+
+def decode_memory_per_latent(model, probe_size=8):
+    """Estimate the memory used to decode one latent vector with model.decode, by measuring the size of the activations saved for
+    the backward pass while decoding a small probe tile on the model's device. This is an upper bound on the memory used to decode without gradients.
+
+    Args:
+        model (VQModel): VQGAN model, with post_quant_conv and a taming Decoder.
+        probe_size (int, optional): Width and height of the probe tile, in latent vectors. Defaults to 8.
+
+    Returns:
+        int: Bytes per latent vector.
+    """
+    parameter = next(model.parameters())
+    quant = torch.zeros([1, model.post_quant_conv.in_channels, probe_size, probe_size], device=parameter.device, dtype=parameter.dtype, requires_grad=True)
+    saved = {}
+    def pack(tensor):
+        saved[id(tensor)] = tensor.numel() * tensor.element_size()
+        return tensor
+    with torch.enable_grad(), torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        output = model.decode(quant)
+    del output
+    return math.ceil(sum(saved.values()) / probe_size**2)
+
+def decode_tile_size(memory_per_latent, memory_budget, overlap=2):
+    """Largest tile size for tiled_decode() whose decoder activations fit in memory_budget.
+
+    Args:
+        memory_per_latent (int): Bytes used to decode one latent vector, from decode_memory_per_latent().
+        memory_budget (int): Memory available for decoding one tile, in bytes.
+        overlap (int, optional): Overlap between tiles, in latent vectors. The tile is always larger than the overlap. Defaults to 2.
+
+    Returns:
+        int: Width and height of a tile, in latent vectors.
+    """
+    return max(int(math.sqrt(memory_budget / memory_per_latent)), overlap + 1)
+
+def _tile_starts(length, tile_size, overlap):
+    # start of each tile along one axis, with the last tile ending at length
+    if length <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    starts = list(range(0, length - tile_size, stride))
+    return starts + [length - tile_size]
+
+def _blend_ramp(length, overlap, ramp_start, ramp_end, device, dtype):
+    # blending weight along one axis of a decoded tile. The weight ramps up over the overlap on each side that borders another tile.
+    weight = torch.ones([length], device=device, dtype=dtype)
+    ramp = (torch.arange(overlap, device=device, dtype=dtype) + 0.5) / overlap
+    if ramp_start and overlap:
+        weight[:overlap] = ramp
+    if ramp_end and overlap:
+        weight[-overlap:] = ramp.flip(0)
+    return weight
+
+def tiled_decode(model, quant, tile_size, overlap=2, decode=None):
+    """Equivalent to model.decode(quant), decoding overlapping square tiles of the latent one at a time and blending the decoded tiles
+    with linear weights where they overlap. The memory used by the decoder is bounded by the tile size instead of the size of the image.
+    When gradients are enabled, each tile is checkpointed, so only one tile's activations are held at once during backward as well.
+
+    Each tile is normalized on its own by the decoder, so the result can differ slightly from decoding the whole latent at once. A larger
+    overlap hides the seams better, at the cost of decoding more tiles.
+
+    Args:
+        model (VQModel): VQGAN model, with post_quant_conv and a taming Decoder.
+        quant (tensor): Quantized latent vector, [batch, e_dim, H, W].
+        tile_size (int): Width and height of each tile, in latent vectors.
+        overlap (int, optional): Overlap between neighbouring tiles, in latent vectors. Defaults to 2.
+        decode (function, optional): Function decode(model, quant_tile) used to decode each tile. Defaults to model.decode.
+
+    Returns:
+        tensor: Decoded image, in the range used by the model (approximately -1 to 1).
+    """
+    if tile_size <= overlap:
+        raise ValueError('tile_size must be larger than overlap.')
+    decode = decode or (lambda model, quant: model.decode(quant))
+    f = 2**(model.decoder.num_resolutions - 1)
+    _, _, height, width = quant.shape
+    row_starts = _tile_starts(height, tile_size, overlap)
+    column_starts = _tile_starts(width, tile_size, overlap)
+    if len(row_starts) == 1 and len(column_starts) == 1:
+        return decode(model, quant)
+    output = None
+    weight_sum = torch.zeros([height * f, width * f], device=quant.device, dtype=quant.dtype)
+    for y in row_starts:
+        for x in column_starts:
+            tile = quant[:, :, y:y + tile_size, x:x + tile_size]
+            if torch.is_grad_enabled():
+                decoded = _checkpoint(lambda tile: decode(model, tile), tile)
+            else:
+                decoded = decode(model, tile)
+            if output is None:
+                output = decoded.new_zeros([quant.shape[0], decoded.shape[1], height * f, width * f])
+            tile_height, tile_width = decoded.shape[2:]
+            weight = torch.outer(_blend_ramp(tile_height, overlap * f, y > 0, y + tile_size < height, quant.device, decoded.dtype),
+                                 _blend_ramp(tile_width, overlap * f, x > 0, x + tile_size < width, quant.device, decoded.dtype))
+            output[:, :, y * f:y * f + tile_height, x * f:x * f + tile_width] += decoded * weight
+            weight_sum[y * f:y * f + tile_height, x * f:x * f + tile_width] += weight
+    return output / weight_sum
 
 def resize_image(image, out_size):
     ratio = image.size[0] / image.size[1]
@@ -145,21 +517,142 @@ class Prompt(nn.Module):
         self.register_buffer('stop', torch.as_tensor(stop))
 
     def forward(self, input):
-        input_normed = F.normalize(input.unsqueeze(1), dim=2)
-        embed_normed = F.normalize(self.embed.unsqueeze(0), dim=2)
-        dists = input_normed.sub(embed_normed).norm(dim=2).div(2).arcsin().pow(2).mul(2)
+        """Spherical distance loss between encoded cutouts and this prompt.
+
+        Args:
+            input (tensor): CLIP encoded cutouts. Either [cutn, D], or [batch, cutn, D] when several images are optimized together.
+
+        Returns:
+            tensor: A scalar loss for [cutn, D] input, or one loss per image ([batch]) for batched input.
+        """
+        input_normed = F.normalize(input.unsqueeze(-2), dim=-1)
+        embed_normed = F.normalize(self.embed, dim=-1)
+        dists = input_normed.sub(embed_normed).norm(dim=-1).div(2).arcsin().pow(2).mul(2)
         dists = dists * self.weight.sign()
         replace_grad = ReplaceGrad.apply
-        return self.weight.abs() * replace_grad(dists, torch.maximum(dists, self.stop)).mean()
+        dists = replace_grad(dists, torch.maximum(dists, self.stop))
+        # average over cutouts and embeddings, keeping any leading batch dimension
+        return self.weight.abs() * dists.flatten(-2).mean(-1)
 
 
+class PromptStack(nn.Module):
+    """All of the prompts used by an Engine, packed together so that every prompt's loss is computed in one batched operation.
+    The embeddings are normalized once when the stack is built, and the loss is the same spherical distance loss as Prompt.
+
+    Args:
+        prompts (list of Prompt): Prompts to pack. Each prompt may have one or more embeddings (e.g. one per cutout of an image prompt).
+    """
+    def __init__(self, prompts):
+        super().__init__()
+        embeds = [prompt.embed.reshape(-1, prompt.embed.shape[-1]) for prompt in prompts]
+        counts = torch.tensor([embed.shape[0] for embed in embeds])
+        prompt_index = torch.repeat_interleave(torch.arange(len(prompts)), counts)
+        self.register_buffer('embed_normed_t', F.normalize(torch.cat(embeds), dim=-1).t().contiguous())
+        # the sign of each prompt's weight, and its stop, repeated for each of its embeddings
+        self.register_buffer('sign', torch.stack([prompt.weight.sign() for prompt in prompts])[prompt_index])
+        self.register_buffer('stop', torch.stack([prompt.stop for prompt in prompts])[prompt_index])
+        self.register_buffer('weight', torch.stack([prompt.weight.abs() for prompt in prompts]))
+        # averages the per-embedding losses of each prompt, [n_embeds, n_prompts]
+        self.register_buffer('segment_mean', F.one_hot(prompt_index, len(prompts)).float() / counts.float())
+
+    def forward(self, input):
+        """Spherical distance loss between encoded cutouts and every prompt in the stack.
+
+        Args:
+            input (tensor): CLIP encoded cutouts. Either [cutn, D], or [batch, cutn, D] when several images are optimized together.
+
+        Returns:
+            tensor: One loss per prompt, [n_prompts], or [batch, n_prompts] for batched input.
+        """
+        cos_sim = F.normalize(input, dim=-1) @ self.embed_normed_t
+        # for unit vectors |a - b| = sqrt(2 - 2 a.b), so this equals the distance computed by Prompt
+        dists = (2 - 2 * cos_sim).clamp(min=0).sqrt().div(2).clamp(max=1).arcsin().pow(2).mul(2)
+        dists = dists * self.sign
+        replace_grad = ReplaceGrad.apply
+        dists = replace_grad(dists, torch.maximum(dists, self.stop))
+        return self.weight * (dists.mean(-2) @ self.segment_mean)
+
+
+def _sample_cutout_boxes(input, cut_size, cutn, cut_pow):
+    # Draw the size and offset of every cutout at once, with the same distribution as the per-cutout loops below
+    sideY, sideX = input.shape[2:4]
+    max_size = min(sideX, sideY)
+    min_size = min(sideX, sideY, cut_size)
+    sizes = (torch.rand([cutn])**cut_pow * (max_size - min_size) + min_size).long()
+    offsetx = (torch.rand([cutn]) * (sideX - sizes + 1)).long()
+    offsety = (torch.rand([cutn]) * (sideY - sizes + 1)).long()
+    return offsetx, offsety, sizes
+
+
+def batched_cutouts(input, cut_size, cutn, cut_pow=1.):
+    """Extract cutn random square cutouts from every image in input, resized to cut_size, in a single operation.
+    Sizes and offsets are drawn with the same distribution as the per-cutout loop in the MakeCutouts classes,
+    but all at once as tensors. The cutouts are then extracted and resized together with ROI-align, which
+    averages several samples per output pixel so that large cutouts are not aliased.
+
+    Args:
+        input (tensor): Images of shape [batch, C, H, W]
+        cut_size (int): Width and height of each cutout in pixels.
+        cutn (int): Number of cutouts per image.
+        cut_pow (float, optional): Exponent applied to the random cutout size. Defaults to 1.0.
+
+    Returns:
+        tensor: Cutouts of shape [cutn * batch, C, cut_size, cut_size], ordered cut-major like the per-cutout loop.
+    """
+    batch_size = input.shape[0]
+    offsetx, offsety, sizes = _sample_cutout_boxes(input, cut_size, cutn, cut_pow)
+    boxes = torch.stack([offsetx, offsety, offsetx + sizes, offsety + sizes], dim=1).float()
+    # ROI-align boxes are (batch index, x1, y1, x2, y2). Every image in the batch gets the same set of cutouts.
+    batch_index = torch.arange(batch_size, dtype=boxes.dtype).repeat(cutn)
+    boxes = torch.cat([batch_index[:, None], boxes.repeat_interleave(batch_size, dim=0)], dim=1)
+    return roi_align(input, boxes.to(input.device, input.dtype), output_size=cut_size, sampling_ratio=-1, aligned=True)
+
+
+def batched_pooled_cutouts(input, cut_size, cutn, cut_pow=1.):
+    """Batched equivalent of the MakeCutoutsSG3 loop. Each cutout is average pooled to cut_size exactly like
+    F.adaptive_avg_pool2d, but every pooling window of every cutout is read from a single summed-area table.
+
+    Args:
+        input (tensor): Images of shape [batch, C, H, W]
+        cut_size (int): Width and height of each cutout in pixels.
+        cutn (int): Number of cutouts per image.
+        cut_pow (float, optional): Exponent applied to the random cutout size. Defaults to 1.0.
+
+    Returns:
+        tensor: Cutouts of shape [cutn * batch, C, cut_size, cut_size], ordered cut-major like the per-cutout loop.
+    """
+    offsetx, offsety, sizes = _sample_cutout_boxes(input, cut_size, cutn, cut_pow)
+    # double precision keeps the differences of large sums exact enough for small pooling windows
+    integral = F.pad(input.double().cumsum(2).cumsum(3), (1, 0, 1, 0))
+    # adaptive_avg_pool2d windows are [floor(i * size / cut_size), ceil((i + 1) * size / cut_size))
+    steps = torch.arange(cut_size)
+    window_start = (steps * sizes[:, None]) // cut_size
+    window_end = -((-(steps + 1) * sizes[:, None]) // cut_size)
+    y0 = (offsety[:, None] + window_start)[:, :, None].to(input.device)
+    y1 = (offsety[:, None] + window_end)[:, :, None].to(input.device)
+    x0 = (offsetx[:, None] + window_start)[:, None, :].to(input.device)
+    x1 = (offsetx[:, None] + window_end)[:, None, :].to(input.device)
+    sums = integral[:, :, y1, x1] - integral[:, :, y0, x1] - integral[:, :, y1, x0] + integral[:, :, y0, x0]
+    cutouts = (sums / ((y1 - y0) * (x1 - x0))).to(input.dtype)
+    # [batch, C, cutn, cut_size, cut_size] -> [cutn * batch, C, cut_size, cut_size]
+    return cutouts.permute(2, 0, 1, 3, 4).reshape(-1, input.shape[1], cut_size, cut_size)
+
+
+def _not_compiled(function):
+    # exclude function from torch.compile, for code that can't be captured in a graph, such as the kornia augmentations
+    disable = getattr(getattr(torch, 'compiler', None), 'disable', None)
+    return disable(function) if disable else function
+
 # An updated version with Kornia augments, but no pooling:
 class MakeCutoutsKornia(nn.Module):
-    def __init__(self, cut_size, cutn, cut_pow=1.):
+    def __init__(self, cut_size, cutn, cut_pow=1., batched=False):
         super().__init__()
         self.cut_size = cut_size
         self.cutn = cutn
         self.cut_pow = cut_pow
+        self.batched = batched
+        # kornia is slow to import, so it is only imported when these cutouts are used
+        import kornia.augmentation as K
         self.augs = nn.Sequential(
             K.RandomHorizontalFlip(p=0.5),
             K.ColorJitter(hue=0.01, saturation=0.01, p=0.7),
@@ -170,30 +663,44 @@ class MakeCutoutsKornia(nn.Module):
 
 
     def forward(self, input):
+        if self.batched:
+            batch = self._augment(batched_cutouts(input, self.cut_size, self.cutn, self.cut_pow))
+        else:
+            batch = self._augment(self._cutouts_loop(input))
+        if self.noise_fac:
+            facs = batch.new_empty([batch.shape[0], 1, 1, 1]).uniform_(0, self.noise_fac)
+            batch = batch + facs * torch.randn_like(batch)
+        return batch
+
+    @_not_compiled
+    def _augment(self, batch):
+        # the kornia augmentations branch on random values, which would split a compiled graph into many small pieces
+        return self.augs(batch)
+
+    def _cutouts_loop(self, input):
         sideY, sideX = input.shape[2:4]
         max_size = min(sideX, sideY)
         min_size = min(sideX, sideY, self.cut_size)
-        cutouts = []
+        offsets, sizes = [], []
         for _ in range(self.cutn):
             size = int(torch.rand([])**self.cut_pow * (max_size - min_size) + min_size)
             offsetx = torch.randint(0, sideX - size + 1, ())
             offsety = torch.randint(0, sideY - size + 1, ())
-            cutout = input[:, :, offsety:offsety + size, offsetx:offsetx + size]
-            cutouts.append(resample(cutout, (self.cut_size, self.cut_size)))
-        batch = self.augs(torch.cat(cutouts, dim=0))
-        if self.noise_fac:
-            facs = batch.new_empty([self.cutn, 1, 1, 1]).uniform_(0, self.noise_fac)
-            batch = batch + facs * torch.randn_like(batch)
-        return batch
+            offsets.append((int(offsetx), int(offsety)))
+            sizes.append(size)
+        return resample_cutouts(input, offsets, sizes, self.cut_size)
 
 class MakeCutoutsSG3(torch.nn.Module):
-    def __init__(self, cut_size, cutn, cut_pow=1.):
+    def __init__(self, cut_size, cutn, cut_pow=1., batched=False):
         super().__init__()
         self.cut_size = cut_size
         self.cutn = cutn
         self.cut_pow = cut_pow
+        self.batched = batched
 
     def forward(self, input):
+        if self.batched:
+            return batched_pooled_cutouts(input, self.cut_size, self.cutn, self.cut_pow)
         sideY, sideX = input.shape[2:4]
         max_size = min(sideX, sideY)
         min_size = min(sideX, sideY, self.cut_size)
@@ -209,30 +716,79 @@ class MakeCutoutsSG3(torch.nn.Module):
 
 # This is the original version (No pooling)
 class MakeCutoutsOrig(nn.Module):
-    def __init__(self, cut_size, cutn, cut_pow=1.):
+    def __init__(self, cut_size, cutn, cut_pow=1., batched=False):
         super().__init__()
         self.cut_size = cut_size
         self.cutn = cutn
         self.cut_pow = cut_pow
+        self.batched = batched
 
     def forward(self, input):
+        clamp_with_grad = ClampWithGrad.apply
+        if self.batched:
+            return clamp_with_grad(batched_cutouts(input, self.cut_size, self.cutn, self.cut_pow), 0, 1)
         sideY, sideX = input.shape[2:4]
         max_size = min(sideX, sideY)
         min_size = min(sideX, sideY, self.cut_size)
-        cutouts = []
+        offsets, sizes = [], []
         for _ in range(self.cutn):
             size = int(torch.rand([])**self.cut_pow * (max_size - min_size) + min_size)
             offsetx = torch.randint(0, sideX - size + 1, ())
             offsety = torch.randint(0, sideY - size + 1, ())
-            cutout = input[:, :, offsety:offsety + size, offsetx:offsetx + size]
-            cutouts.append(resample(cutout, (self.cut_size, self.cut_size)))
-        clamp_with_grad = ClampWithGrad.apply
-        return clamp_with_grad(torch.cat(cutouts, dim=0), 0, 1)
+            offsets.append((int(offsetx), int(offsety)))
+            sizes.append(size)
+        return clamp_with_grad(resample_cutouts(input, offsets, sizes, self.cut_size), 0, 1)
+
+_CLIP_MEAN = [0.48145466, 0.4578275, 0.40821073]
+_CLIP_STD = [0.26862954, 0.26130258, 0.27577711]
+
+def normalize(input):
+    # the input normalization used by CLIP. Same result as transforms.Normalize, without its data-dependent check of std, which stops torch.compile
+    mean = torch.tensor(_CLIP_MEAN, device=input.device, dtype=input.dtype).view(-1, 1, 1)
+    std = torch.tensor(_CLIP_STD, device=input.device, dtype=input.dtype).view(-1, 1, 1)
+    return (input - mean) / std
+
+def compile_function(function, **compile_kwargs):
+    """Compile a function with torch.compile, so that its operations, and their backward pass, run as optimized graphs. Graph breaks are allowed,
+    and run eagerly. If torch.compile is not available in this version of pytorch, or the compiler fails, a warning is shown and the function
+    runs eagerly from then on. Any other error raised while running the function is raised as usual.
+
+    Args:
+        function (function): Function to compile.
+        **compile_kwargs: Arguments passed on to torch.compile.
 
-normalize = transforms.Normalize(mean=[0.48145466, 0.4578275, 0.40821073],
-                                        std=[0.26862954, 0.26130258, 0.27577711])
+    Returns:
+        function: A function with the same arguments and result as function.
+    """
+    if not hasattr(torch, 'compile'):
+        warnings.warn('torch.compile requires pytorch 2.0 or later. Running without compiling.')
+        return function
+    compiled = torch.compile(function, **compile_kwargs)
+    compile_errors = _compile_errors()
+    def run(*args, **kwargs):
+        nonlocal compiled
+        if compiled is function:
+            return function(*args, **kwargs)
+        try:
+            return compiled(*args, **kwargs)
+        except compile_errors as error:
+            # only failures of the compiler itself fall back to eager. Errors in the function, such as a shape mismatch or running out
+            # of memory, are raised as they would be without compiling.
+            warnings.warn(f'torch.compile failed, running without compiling: {error}')
+            compiled = function
+            return function(*args, **kwargs)
+    return run
+
+def _compile_errors():
+    # the exceptions raised by torch.compile when a function can't be compiled. Some don't exist in every version of pytorch.
+    import torch._dynamo.exc
+    names = ['BackendCompilerFailed', 'Unsupported', 'InternalTorchDynamoError', 'InvalidBackend', 'TritonUnavailableError']
+    return tuple(getattr(torch._dynamo.exc, name) for name in names if hasattr(torch._dynamo.exc, name))
 
 def load_vqgan_model(config_path, checkpoint_path):
+    # taming imports pytorch lightning, which is slow, so it is only imported when a model is loaded
+    from omegaconf import OmegaConf
+    from taming.models import cond_transformer, vqgan
     config = OmegaConf.load(config_path)
     if config.model.target == 'taming.models.vqgan.VQModel':
         model = vqgan.VQModel(**config.model.params)
@@ -262,6 +818,56 @@ def delete_files(path_to_delete):
     for f in files:
         os.remove(f)
 
+def detect_scene_cuts(image_files, threshold=0.25, thumbnail_size=(32, 18)):
+    """Find the frames of a video that start a new scene. Each frame is shrunk to a small color thumbnail, which ignores
+    detail and small movements, and a cut is detected where the mean absolute difference between consecutive thumbnails is more than threshold.
+
+    Args:
+        image_files (list of str): Paths to the video frames, in order.
+        threshold (float, optional): Mean difference between consecutive frames, from 0 to 1, above which a cut is detected. Defaults to 0.25.
+        thumbnail_size (tuple of int, optional): Size of the thumbnails compared. Defaults to (32, 18).
+
+    Returns:
+        list of int: Indices into image_files of the first frame of each scene after the first.
+    """
+    cuts = []
+    previous = None
+    for index, image_file in enumerate(image_files):
+        with Image.open(image_file) as frame:
+            thumbnail = np.asarray(frame.convert('RGB').resize(thumbnail_size, resample=Image.BILINEAR), dtype=np.float32) / 255
+        if previous is not None and np.abs(thumbnail - previous).mean() > threshold:
+            cuts.append(index)
+        previous = thumbnail
+    return cuts
+
+def split_segments(num_frames, segment_length=None, overlap=0, cuts=()):
+    """Split the frames of a video into segments that can be generated independently. Segments end at each scene cut.
+    Scenes longer than segment_length are split into segments of nearly equal length, each of which also starts with the last
+    overlap frames of the segment before it, so that the two can be cross-faded.
+
+    Args:
+        num_frames (int): Number of frames in the video.
+        segment_length (int, optional): Maximum number of frames in a segment, not counting the overlap. If None, scenes are not split. Defaults to None.
+        overlap (int, optional): Number of frames shared by consecutive segments within a scene. Defaults to 0.
+        cuts (list of int, optional): Indices of the first frame of each scene after the first, e.g. from detect_scene_cuts(). Defaults to ().
+
+    Returns:
+        list of tuple: (start, end, overlap) for each segment. The segment is frames start to end - 1, and its first overlap frames are shared with the previous segment.
+    """
+    if segment_length is not None and segment_length < 1:
+        raise ValueError('segment_length must be a positive int.')
+    if overlap < 0:
+        raise ValueError('overlap must not be negative.')
+    boundaries = [0] + sorted(cut for cut in set(cuts) if 0 < cut < num_frames) + [num_frames]
+    segments = []
+    for scene_start, scene_end in zip(boundaries[:-1], boundaries[1:]):
+        num_segments = -(-(scene_end - scene_start) // segment_length) if segment_length else 1
+        splits = [scene_start + (scene_end - scene_start) * i // num_segments for i in range(num_segments + 1)]
+        for i, (start, end) in enumerate(zip(splits[:-1], splits[1:])):
+            shared = min(overlap, start - splits[i - 1]) if i else 0
+            segments.append((start - shared, end, shared))
+    return segments
+
 def parse_all_prompts(text_prompts, image_prompts, noise_prompts):
     """Split prompt strings into lists of lists of prompts.
     Apply parse_story_prompts() to each of conf.text_prompts, conf.image_prompts, and conf.noise_prompts
@@ -396,6 +1002,7 @@ def info_to_jpg_exif(list_of_info):
 
     xptitle = list_of_info[0][1] if list_of_info[0][1] else ''
     # assemble the structure for piexif to process
+    import piexif
     zeroth_ifd = {
         piexif.ImageIFD.Software: "https://github.com/rkhamilton/vqgan-clip-generator",
         piexif.ImageIFD.XPTitle: xptitle.encode('utf_16_le'),
@@ -458,6 +1065,7 @@ def copy_image_metadata(files_with_metadata_path,files_needing_metadata_path):
                 info.add_text(key, str(value))
             pil_dest.save(dest_file, "png", pnginfo=info)
         elif ext.lower() == '.jpg':
+            import piexif
             try:
                 piexif.transplant(source_file,dest_file)
             except ValueError as excpt:
@@ -0,0 +1,61 @@
+# Saves and loads the state of a video generation run, so that a long run that is interrupted can be resumed from the last
+# frame that was completed instead of starting again. Checkpoints are written atomically: a checkpoint file is either the
+# complete previous checkpoint or the complete new one, even if the process is killed while it is being written.
+
+import inspect
+import os
+import tempfile
+import torch
+
+__all__ = ["save_checkpoint", "load_checkpoint", "check_settings"]
+
+# checkpoints hold optimizer state and random number generator state as well as tensors, so they can't be loaded with weights_only=True
+_LOAD_KWARGS = {'weights_only': False} if 'weights_only' in inspect.signature(torch.load).parameters else {}
+
+
+def save_checkpoint(path, state):
+    """Save a checkpoint to path, replacing any checkpoint that is already there.
+
+    The checkpoint is written to a temporary file in the same folder, flushed to disk, and then renamed to path.
+
+    Args:
+        path (str): Path of the checkpoint file.
+        state (dict): State to save, e.g. from Engine.state_dict(). Tensors may be on any device.
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    file_descriptor, temp_path = tempfile.mkstemp(dir=folder, prefix='.checkpoint', suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+
+
+def load_checkpoint(path):
+    """Load a checkpoint saved by save_checkpoint(). Tensors are loaded onto the CPU.
+
+    Args:
+        path (str): Path of the checkpoint file.
+
+    Returns:
+        dict: The saved state, or None if there is no checkpoint at path.
+    """
+    if not os.path.exists(path):
+        return None
+    return torch.load(path, map_location='cpu', **_LOAD_KWARGS)
+
+
+def check_settings(checkpoint, settings):
+    """Raise a ValueError if a run is being resumed with different settings from the run that saved checkpoint.
+
+    Args:
+        checkpoint (dict): The loaded checkpoint, with the settings of the run that saved it under 'settings'.
+        settings (dict): The settings of the run being resumed.
+    """
+    changed = sorted(name for name in settings if checkpoint['settings'].get(name) != settings[name])
+    if changed:
+        raise ValueError(f'Unable to resume, because these settings are different from the run that saved the checkpoint: {", ".join(changed)}')
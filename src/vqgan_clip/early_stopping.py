@@ -0,0 +1,81 @@
+# Implements a stopping criterion for the training loops in generate.py. Training stops once the loss has stopped improving,
+# instead of always running a fixed number of iterations.
+
+import torch
+
+class EarlyStopping:
+    """Decide when an image has converged, from the losses returned by Engine.train().
+
+    The total loss is compared between the most recent window of iterations and the window before it. Training stops when the
+    improvement between the two windows is less than min_delta, or less than min_relative_improvement times the loss of the older window.
+    Averaging over windows keeps the random cutouts from triggering a stop on a single noisy iteration.
+
+    Losses are kept on the device, and only copied to the host every check_every iterations, so update() does not force a device
+    synchronization on every training step.
+
+    If reset() is given the number of iterations an image will be trained for, and that is too few for the settings below, they are
+    scaled down for that image, so that the same instance can stop short video frames as well as long single images.
+
+    Args:
+        window (int, optional): Number of iterations averaged in each of the two windows that are compared. Defaults to 20.
+        min_relative_improvement (float, optional): Stop when the loss improves by less than this fraction between windows. Defaults to 0.005.
+        min_delta (float, optional): Stop when the loss improves by less than this amount between windows. Defaults to 0.0.
+        min_iterations (int, optional): Never stop before this many iterations. Defaults to 50.
+        check_every (int, optional): Number of iterations between checks. Defaults to 10.
+    """
+    def __init__(self, window=20, min_relative_improvement=0.005, min_delta=0.0, min_iterations=50, check_every=10):
+        if not isinstance(window, int) or window < 1:
+            raise ValueError('window must be a positive int.')
+        if not isinstance(check_every, int) or check_every < 1:
+            raise ValueError('check_every must be a positive int.')
+        self.window = window
+        self.min_relative_improvement = min_relative_improvement
+        self.min_delta = min_delta
+        self.min_iterations = min_iterations
+        self.check_every = check_every
+        self.reset()
+
+    def reset(self, max_iterations=None):
+        """Forget the loss history. Call this before training each new image or video frame.
+
+        Args:
+            max_iterations (int, optional): Number of iterations the image or frame is trained for, if it doesn't stop early. If set,
+                min_iterations is limited to half of max_iterations, window to a quarter, and check_every to window, so that a stop is
+                possible from halfway through. Defaults to None.
+        """
+        self._pending = []
+        self._history = []
+        self.iterations = 0
+        self.stopped = False
+        self._min_iterations = self.min_iterations
+        self._window = self.window
+        self._check_every = self.check_every
+        if max_iterations:
+            self._min_iterations = min(self.min_iterations, max_iterations // 2)
+            self._window = max(1, min(self.window, max_iterations // 4))
+            self._check_every = min(self.check_every, self._window)
+
+    def update(self, lossAll):
+        """Record the losses of one training iteration.
+
+        Args:
+            lossAll (list of tensor): Losses returned by Engine.train().
+
+        Returns:
+            boolean: True if training should stop.
+        """
+        self._pending.append(sum(lossAll).detach().sum())
+        self.iterations += 1
+        if self.iterations < self._min_iterations or self.iterations % self._check_every:
+            return False
+        # a single device to host copy for all of the iterations since the last check
+        self._history.extend(torch.stack(self._pending).tolist())
+        self._pending = []
+        self._history = self._history[-2 * self._window:]
+        if len(self._history) < 2 * self._window:
+            return False
+        previous = sum(self._history[:self._window]) / self._window
+        recent = sum(self._history[self._window:]) / self._window
+        improvement = previous - recent
+        self.stopped = improvement < self.min_delta or improvement < self.min_relative_improvement * abs(previous)
+        return self.stopped
@@ -0,0 +1,289 @@
+# Caches of CLIP prompt embeddings, so that prompts that have been encoded before do not need to be encoded again.
+# Text embeddings are keyed by (CLIP model, prompt text), where Engine identifies the model by its name and a fingerprint of its
+# weights. They are held in an in-memory LRU cache, and optionally in an append-only file per CLIP model that is shared by every
+# process using the same cache folder.
+# Image prompt embeddings are keyed by a hash of the image content, every setting that changes the cutouts that are
+# encoded, and the CLIP model and a fingerprint of its weights. They are held in an in-memory LRU cache with a bounded size.
+
+import collections
+import hashlib
+import os
+import threading
+import numpy as np
+import torch
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+__all__ = ["TextEmbeddingCache", "text_embedding_cache", "ImageEmbeddingCache", "image_embedding_cache", "file_content_hash", "pil_image_content_hash"]
+
+_HEADER = np.dtype([('magic', 'S8'), ('dim', '<u4'), ('reserved', '<u4')])
+_MAGIC = b'VQCEMB01'
+
+
+class _FileLock:
+    # Exclusive lock on a file, held across processes. Used around appends to, and index refreshes of, an embedding file.
+    def __init__(self, path):
+        self._path = path
+
+    def __enter__(self):
+        self._file = open(self._path, 'a+b')
+        if os.name == 'nt':
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if os.name == 'nt':
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._file.close()
+
+
+class _EmbeddingFile:
+    # Append-only file of fixed-size records (sha256 key, float32 embedding), read through a numpy memmap.
+    # Records are only ever appended while holding the lock, so every complete record that has been indexed stays valid.
+    def __init__(self, path):
+        self._path = path
+        self._lock = _FileLock(path + '.lock')
+        self._index = {}
+        self._records = None
+        self._num_indexed = 0
+        self._dim = None
+
+    def _record_dtype(self):
+        return np.dtype([('key', 'S32'), ('embed', '<f4', (self._dim,))])
+
+    def _refresh(self):
+        # index any records appended since the last refresh, by this or another process. Must hold the lock.
+        if not os.path.exists(self._path) or os.path.getsize(self._path) < _HEADER.itemsize:
+            return
+        if self._dim is None:
+            header = np.fromfile(self._path, dtype=_HEADER, count=1)[0]
+            if header['magic'] != _MAGIC:
+                raise ValueError(f'{self._path} is not an embedding cache file.')
+            self._dim = int(header['dim'])
+        record_dtype = self._record_dtype()
+        num_records = (os.path.getsize(self._path) - _HEADER.itemsize) // record_dtype.itemsize
+        if num_records == self._num_indexed:
+            return
+        self._records = np.memmap(self._path, dtype=record_dtype, mode='r', offset=_HEADER.itemsize, shape=(num_records,))
+        for row in range(self._num_indexed, num_records):
+            self._index.setdefault(bytes(self._records[row]['key']), row)
+        self._num_indexed = num_records
+
+    def get(self, key):
+        row = self._index.get(key)
+        if row is None:
+            with self._lock:
+                self._refresh()
+            row = self._index.get(key)
+            if row is None:
+                return None
+        return torch.from_numpy(np.array(self._records[row]['embed']))
+
+    def put(self, key, embed):
+        embed = embed.detach().float().cpu().reshape(-1).numpy()
+        with self._lock:
+            self._refresh()
+            if key in self._index:
+                return
+            if self._dim is None:
+                self._dim = embed.shape[0]
+                header = np.zeros(1, dtype=_HEADER)
+                header['magic'] = _MAGIC
+                header['dim'] = self._dim
+                with open(self._path, 'wb') as f:
+                    f.write(header.tobytes())
+            if embed.shape[0] != self._dim:
+                raise ValueError(f'Embedding has {embed.shape[0]} dimensions, but {self._path} stores {self._dim}.')
+            record = np.zeros(1, dtype=self._record_dtype())
+            record['key'] = key
+            record['embed'] = embed
+            with open(self._path, 'ab') as f:
+                f.write(record.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self._refresh()
+
+
+class TextEmbeddingCache:
+    """Cache of CLIP text embeddings, keyed by the CLIP model name and the prompt text.
+
+    Recently used embeddings are kept in memory. If cache_dir is set, every embedding is also appended to a file in cache_dir, one file per CLIP model,
+    which is shared by every process that uses the same cache_dir. Several processes may read and write the same cache_dir at once.
+
+    Args:
+        cache_dir (str, optional): Folder for the on-disk cache. If None, embeddings are only cached in memory. Defaults to None.
+        max_memory_entries (int, optional): Number of embeddings kept in memory. Defaults to 4096.
+    """
+    def __init__(self, cache_dir=None, max_memory_entries=4096):
+        self.cache_dir = cache_dir
+        self.max_memory_entries = max_memory_entries
+        self._memory = collections.OrderedDict()
+        self._files = {}
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def _key(clip_model, text):
+        return hashlib.sha256(f'{clip_model}\0{text}'.encode('utf-8')).digest()
+
+    def _file(self, clip_model):
+        if clip_model not in self._files:
+            file_name = 'text_' + hashlib.sha256(clip_model.encode('utf-8')).hexdigest()[:16] + '.emb'
+            self._files[clip_model] = _EmbeddingFile(os.path.join(self.cache_dir, file_name))
+        return self._files[clip_model]
+
+    def _remember(self, key, embed):
+        self._memory[key] = embed
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, clip_model, text):
+        """Return the cached embedding of a text prompt.
+
+        Args:
+            clip_model (str): Identifies the CLIP model that encoded the prompt, e.g. 'ViT-B/32'. Engine adds a fingerprint of the model's weights to the name.
+            text (str): Prompt text, without its weight.
+
+        Returns:
+            tensor: The embedding as a float32 CPU tensor, [1, D], or None if it is not in the cache.
+        """
+        key = self._key(clip_model, text)
+        with self._lock:
+            embed = self._memory.get(key)
+            if embed is None and self.cache_dir:
+                embed = self._file(clip_model).get(key)
+                if embed is not None:
+                    embed = embed.unsqueeze(0)
+            if embed is None:
+                return None
+            self._remember(key, embed)
+            return embed.clone()
+
+    def put(self, clip_model, text, embed):
+        """Add the embedding of a text prompt to the cache.
+
+        Args:
+            clip_model (str): Identifies the CLIP model that encoded the prompt, e.g. 'ViT-B/32'. Engine adds a fingerprint of the model's weights to the name.
+            text (str): Prompt text, without its weight.
+            embed (tensor): Embedding returned by CLIP encode_text, [1, D].
+        """
+        key = self._key(clip_model, text)
+        embed = embed.detach().float().cpu().reshape(1, -1).clone()
+        with self._lock:
+            self._remember(key, embed)
+            if self.cache_dir:
+                self._file(clip_model).put(key, embed)
+
+    def clear_memory(self):
+        """Empty the in-memory cache. Embeddings stored on disk are kept.
+        """
+        with self._lock:
+            self._memory.clear()
+
+    def __len__(self):
+        return len(self._memory)
+
+
+_text_caches = {}
+_text_caches_lock = threading.Lock()
+
+def text_embedding_cache(cache_dir=None):
+    """Return the TextEmbeddingCache shared by every Engine in this process that uses cache_dir.
+
+    Args:
+        cache_dir (str, optional): Folder for the on-disk cache. If None, the in-memory only cache is returned. Defaults to None.
+    """
+    key = os.path.abspath(cache_dir) if cache_dir else None
+    with _text_caches_lock:
+        if key not in _text_caches:
+            _text_caches[key] = TextEmbeddingCache(cache_dir)
+        return _text_caches[key]
+
+
+def file_content_hash(path):
+    """sha256 hex digest of the contents of a file.
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def pil_image_content_hash(pil_image):
+    """sha256 hex digest of the mode, size and pixels of a PIL image.
+    """
+    sha = hashlib.sha256(f'{pil_image.mode}{pil_image.size}'.encode('utf-8'))
+    sha.update(pil_image.tobytes())
+    return sha.hexdigest()
+
+
+class ImageEmbeddingCache:
+    """In-memory cache of CLIP image prompt embeddings. Each entry is the batch of embeddings of all cutouts of an image prompt.
+    The least recently used entries are evicted once the cache holds more than max_bytes of embeddings.
+
+    Args:
+        max_bytes (int, optional): Maximum total size of the cached embeddings. Defaults to 256 MB.
+    """
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached embeddings for key, as a float32 CPU tensor, or None if they are not in the cache.
+
+        Args:
+            key (tuple): Hashable key that identifies the image content and every setting used to encode it.
+        """
+        with self._lock:
+            embed = self._entries.get(key)
+            if embed is None:
+                return None
+            self._entries.move_to_end(key)
+            return embed.clone()
+
+    def put(self, key, embed):
+        """Add the embeddings of an image prompt to the cache.
+
+        Args:
+            key (tuple): Hashable key that identifies the image content and every setting used to encode it.
+            embed (tensor): CLIP embeddings of the cutouts of the image, [cutn, D].
+        """
+        embed = embed.detach().float().cpu().clone()
+        with self._lock:
+            if key in self._entries:
+                self._num_bytes -= self._entries.pop(key).nbytes
+            self._entries[key] = embed
+            self._num_bytes += embed.nbytes
+            while self._num_bytes > self.max_bytes and self._entries:
+                self._num_bytes -= self._entries.popitem(last=False)[1].nbytes
+
+    def clear(self):
+        """Empty the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._num_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_image_cache = ImageEmbeddingCache()
+
+def image_embedding_cache():
+    """Return the ImageEmbeddingCache shared by every Engine in this process.
+    """
+    return _image_cache
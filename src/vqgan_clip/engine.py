@@ -1,6 +1,9 @@
 # This contains the original math to generate an image from VQGAN+CLIP. I don't fully understand what it's doing and don't expect to change it.
 from . import _functional as VF
-from .download import load_file_from_url
+from . import model_registry
+from . import embedding_cache
+from . import image_writer
+from . import profiling
 
 import torch
 from torch import optim
@@ -9,21 +12,20 @@ from torchvision.transforms import functional as TF
 from torch.cuda import get_device_properties
 torch.backends.cudnn.benchmark = False		# NR: True is a bit faster, but can lead to OOM. False is more deterministic.
 #torch.use_deterministic_algorithms(True)	# NR: grid_sampler_2d_backward_cuda does not have a deterministic implementation
-from torch_optimizer import DiffGrad, AdamP, RAdam
-import clip
 from PIL import ImageFile, Image, PngImagePlugin
 ImageFile.LOAD_TRUNCATED_IMAGES = True
-import imageio
 from tqdm.auto import tqdm
 
-from urllib.request import urlopen
-
 import numpy as np
 
 import os
+import contextlib
 
 __all__ = ["VQGAN_CLIP_Config", "Engine"]
 
+# shared by every stage of train() that isn't being timed or profiled
+_NO_STAGE = contextlib.nullcontext()
+
 
 class VQGAN_CLIP_Config:
     """A set of attributes used to customize the execution of VQGAN+CLIP
@@ -42,6 +44,19 @@ class VQGAN_CLIP_Config:
     * self.cut_method (str, optional): Cut method used. choices=[\'original\',\'kornia\','sg3'] default=\'original\'.  Defaults to \'original\'
     * self.num_cuts (int, optional): Number of cuts to use. Impacts VRAM use if increased. Defaults to 32 
     * self.cut_power (float, optional): Exponent used in MakeCutouts. Defaults to 1.0  
+    * self.batched_cutouts (boolean, optional): If true, all cutouts are sampled and resized together in a single operation, which is much faster for large num_cuts with cut_method \'original\' or \'kornia\'. The cutouts are resized with bilinear ROI-align sampling instead of Lanczos resampling, so generated images differ from those made with the per-cutout loop. With cut_method \'sg3\' the batched path is slower on the CPU. If false, the original loop over each cutout is used. Defaults to False.
+    * self.quantize_chunk_size (int, optional): If set, the nearest codebook entry is searched for this many latent vectors at a time, which bounds the memory used by the distance matrix on large output_image_size. Defaults to None.
+    * self.quantize_approximate (boolean, optional): If true, each latent vector is only compared to the codebook entries in its nearest clusters of a k-means index built once per model. Faster, but does not always pick the exact nearest entry. Defaults to False.
+    * self.quantize_probes (int, optional): Number of codebook clusters searched for each latent vector when quantize_approximate is True. More probes are slower and closer to the exact search. Defaults to 8.
+    * self.embedding_cache_dir (str, optional): If set to a folder name, CLIP text embeddings are stored there and reused by later runs, including other processes running at the same time. Text embeddings are always cached in memory for the life of the process. Defaults to None.
+    * self.gradient_checkpointing (boolean, optional): If true, the activations of the VQGAN decoder are recomputed during the backward pass instead of being kept in memory. This allows a larger output_image_size with the same memory, but each iteration is slower. Defaults to False.
+    * self.decode_tile_size (int, optional): If set, the latent vector is decoded in overlapping square tiles of this many latent vectors, which are blended together. The memory used by the decoder then stays the same however large output_image_size is. Defaults to None.
+    * self.decode_memory_budget (int, optional): If set, and decode_tile_size is not, the largest decode_tile_size whose decoder activations fit in this many megabytes is used. Defaults to None.
+    * self.decode_tile_overlap (int, optional): Overlap between decoded tiles, in latent vectors. Larger values hide the seams between tiles better, but more tiles are decoded. Defaults to 2.
+    * self.compile (boolean, optional): If true, the forward and backward pass of each training iteration are compiled with torch.compile (pytorch 2.0 or later). The first iterations are slow while compiling, and later iterations are faster. If compiling is not possible, a warning is shown and training runs without it. Defaults to False.
+    * self.stage_timing (boolean, optional): If true, the wall time spent in each stage of train() (decoding, cutouts, CLIP, prompt losses, backward pass, optimizer step and clamping) is accumulated in Engine.stage_timings. On CUDA devices the GPU is synchronized after each stage, which makes training a little slower. Defaults to False.
+    * self.profile_trace_filename (str, optional): If set, a torch.profiler trace of the iterations in profile_iterations is saved to this file, which can be opened in chrome://tracing. Defaults to None.
+    * self.profile_iterations (list of int, optional): First iteration_number, and the iteration_number after the last, of the iterations recorded when profile_trace_filename is set. Defaults to [10, 15].
     * self.cudnn_determinism (boolean, optional): If true, use algorithms that have reproducible, deterministic output. Performance will be lower.  Defaults to False.
     * self.optimizer (str, optional): Optimizer used when training VQGAN. choices=[\'Adam\',\'AdamW\',\'Adagrad\',\'Adamax\',\'DiffGrad\',\'RAdam\',\'RMSprop\']. Defaults to \'Adam\' 
     * self.cuda_device (str, optional): Select your GPU. Default to the first gpu, device 0.  Defaults to \'cuda:0\'
@@ -64,6 +79,19 @@ class VQGAN_CLIP_Config:
         self.cut_method = 'kornia' # choices=['original','kornia','sg3'] default='kornia'
         self.num_cuts = 32
         self.cut_power = 1.0
+        self.batched_cutouts = False # If true, extract all cutouts in a single batched operation. Faster, but resizes with bilinear sampling instead of Lanczos, which changes the output. False uses the original loop over each cutout.
+        self.quantize_chunk_size = None # If set, search for the nearest codebook entry this many latent vectors at a time to bound memory use. None searches all of them at once.
+        self.quantize_approximate = False # If true, only search the codebook clusters nearest to each latent vector. Faster, but not always the exact nearest entry.
+        self.quantize_probes = 8 # Number of codebook clusters searched for each latent vector when quantize_approximate is True.
+        self.embedding_cache_dir = None # If set to a folder name, CLIP text embeddings are cached on disk in that folder and reused across runs and processes.
+        self.gradient_checkpointing = False # If true, recompute VQGAN decoder activations during backward instead of storing them. Uses less memory for large images, but is slower.
+        self.decode_tile_size = None # If set, decode the latent vector in overlapping tiles of this many latent vectors, to bound the memory used by the decoder.
+        self.decode_memory_budget = None # If set (in MB), and decode_tile_size is not, choose the largest tile that fits in this much memory.
+        self.decode_tile_overlap = 2 # Overlap between decoded tiles, in latent vectors.
+        self.compile = False # If true, compile each training iteration with torch.compile. Slow to start, faster afterwards.
+        self.stage_timing = False # If true, accumulate the time spent in each stage of train() in Engine.stage_timings.
+        self.profile_trace_filename = None # If set, save a torch.profiler trace of the iterations in profile_iterations to this file.
+        self.profile_iterations = [10, 15] # First iteration_number, and the iteration_number after the last, recorded in the profiler trace.
         self.cudnn_determinism = False # if true, use algorithms that have reproducible, deterministic output. Performance will be lower.
         self.optimizer = 'Adam' # choices=['Adam','AdamW','Adagrad','Adamax','DiffGrad','RAdam','RMSprop'], default='Adam'
         self.cuda_device = 'cuda:0' # select your GPU. Default to the first gpu, device 0
@@ -77,6 +105,10 @@ class Engine:
         self.apply_configuration(config)
 
         self._gumbel = False
+        self._compiled_ascend_txt = None
+        self.stage_timings = None
+        self._profiler_window = None
+        self._stage_context = None
 
         self.replace_grad = VF.ReplaceGrad.apply
         self.clamp_with_grad = VF.ClampWithGrad.apply
@@ -128,8 +160,10 @@ class Engine:
         elif opt_name == "Adamax":
             self._optimizer = optim.Adamax([self._z], lr=opt_lr)	
         elif opt_name == "DiffGrad":
+            from torch_optimizer import DiffGrad
             self._optimizer = DiffGrad([self._z], lr=opt_lr, eps=1e-9, weight_decay=1e-9) # NR: Playing for reasons
         elif opt_name == "RAdam":
+            from torch_optimizer import RAdam
             self._optimizer = RAdam([self._z], lr=opt_lr)		    
         elif opt_name == "RMSprop":
             self._optimizer = optim.RMSprop([self._z], lr=opt_lr)
@@ -141,6 +175,42 @@ class Engine:
         if self.conf.adaptiveLR:
             self.LR_scheduler = optim.lr_scheduler.ReduceLROnPlateau(self._optimizer)
 
+    def state_dict(self):
+        """Return the training state of this Engine, so that training can be continued later with load_state_dict(). This is the latent vector z,
+        the state of the optimizer and learning rate scheduler, and the state of the random number generators, which are used by the cutouts.
+        Prompts and models are not included.
+
+        Returns:
+            dict: The training state. Its tensors are references to the Engine's own, so save or copy it before training continues.
+        """
+        state = {'z': self._z.detach(),
+                 'z_orig': self._z_orig,
+                 'optimizer': self._optimizer.state_dict(),
+                 'rng_state': torch.get_rng_state()}
+        if self.conf.adaptiveLR:
+            state['lr_scheduler'] = self.LR_scheduler.state_dict()
+        if self._device.type == 'cuda':
+            state['cuda_rng_state'] = torch.cuda.get_rng_state(self._device)
+        return state
+
+    def load_state_dict(self, state):
+        """Restore the training state returned by state_dict(). The Engine must already be initialized, and configure_optimizer() must have been called.
+
+        Args:
+            state (dict): Training state returned by state_dict().
+        """
+        if state['z'].shape != self._z.shape:
+            raise ValueError(f'The saved latent vector has shape {list(state["z"].shape)}, but this Engine\'s has shape {list(self._z.shape)}. Is output_image_size the same?')
+        with torch.no_grad():
+            self._z.copy_(state['z'])
+        self._z_orig = state['z_orig'].to(self._device)
+        self._optimizer.load_state_dict(state['optimizer'])
+        if self.conf.adaptiveLR and 'lr_scheduler' in state:
+            self.LR_scheduler.load_state_dict(state['lr_scheduler'])
+        torch.set_rng_state(state['rng_state'])
+        if self._device.type == 'cuda' and 'cuda_rng_state' in state:
+            torch.cuda.set_rng_state(state['cuda_rng_state'], self._device)
+
     def train(self, iteration_number):
         """Executes training of the already-initialized VQGAN-CLIP model to generate an image. After a user-desired number of calls to train(), use save_current_output() to save the generated image.
 
@@ -148,48 +218,83 @@ class Engine:
             iteration_number (int): Current iteration number, used only to adjust the weight of the inital image if init_weight is used.
 
         Returns:
-            lossAll (tensor): A list of losses from the training process
+            lossAll (tensor): A list of losses from the training process, one per prompt. Each loss has one value per image in the batch.
         """
+        self._begin_stages(iteration_number)
+        stage = self._stage
         self._optimizer.zero_grad(set_to_none=True)
-        lossAll = self.ascend_txt(iteration_number)
-        
-        loss = sum(lossAll)
-        loss.backward()
-        self._optimizer.step()
+        if self.conf.compile:
+            if self._compiled_ascend_txt is None:
+                self._compiled_ascend_txt = VF.compile_function(self.ascend_txt)
+            # build the prompt stack outside of the compiled graph, which only needs to see it change when prompts change
+            if self.pMs:
+                self._stacked_prompts()
+            # the compiled graph can't be split into stages, so it is timed as a whole
+            stage_context, self._stage_context = self._stage_context, None
+            with stage_context('forward') if stage_context else _NO_STAGE:
+                lossAll = self._compiled_ascend_txt(iteration_number)
+            self._stage_context = stage_context
+        else:
+            lossAll = self.ascend_txt(iteration_number)
         
-        if self.conf.adaptiveLR:
-            self.LR_scheduler.step(loss)
-
+        # each image in the batch is independent, so the batch is optimized through the sum of the per-image losses
+        with stage('backward'):
+            loss = sum(lossAll).sum()
+            loss.backward()
+        with stage('optimizer_step'):
+            self._optimizer.step()
+            if self.conf.adaptiveLR:
+                self.LR_scheduler.step(loss)
 
         #with torch.no_grad():
-        with torch.inference_mode():
+        with stage('clamp'), torch.inference_mode():
             self._z.copy_(self._z.maximum(self.z_min).minimum(self.z_max))
         
+        self._end_stages(iteration_number)
         return lossAll
 
-    def save_current_output(self, save_filename, img_metadata=None):
+    def _begin_stages(self, iteration_number):
+        # choose what _stage() does during this iteration: time each stage, label it in a profiler trace, or nothing
+        if self.conf.profile_trace_filename:
+            if self._profiler_window is None or self._profiler_window.filename != self.conf.profile_trace_filename:
+                self._profiler_window = profiling.ProfilerWindow(self.conf.profile_trace_filename, *self.conf.profile_iterations)
+            self._profiler_window.begin_iteration(iteration_number)
+        if self.conf.stage_timing:
+            if self.stage_timings is None:
+                self.stage_timings = profiling.StageTimings(self._device)
+            self.stage_timings.iterations += 1
+            self._stage_context = self.stage_timings.stage
+        elif self._profiler_window is not None and self._profiler_window.active:
+            self._stage_context = torch.profiler.record_function
+        else:
+            self._stage_context = None
+
+    def _end_stages(self, iteration_number):
+        if self._profiler_window is not None:
+            self._profiler_window.end_iteration(iteration_number)
+
+    def _stage(self, name):
+        # context manager around one stage of train(), which costs nothing unless stage timing or profiling is on
+        if self._stage_context is None:
+            return _NO_STAGE
+        return self._stage_context(name)
+
+    def save_current_output(self, save_filename, img_metadata=None, batch_index=0, writer=None):
         """Save the current output from the image generator as a PNG file to location save_filename
 
         Args:
             save_filename (str): string containing the path to save the generated image. e.g. 'output.png' or 'outputs/my_file.png'
+            batch_index (int, optional): When several seeds are optimized together, the index of the image in the batch to save. Defaults to 0.
+            writer (AsyncImageWriter, optional): If set, the image is saved in the background by this writer, and this method returns without waiting for it. Defaults to None.
         """
-        self.save_tensor_as_image(self.output_tensor, save_filename, img_metadata)
+        self.save_tensor_as_image(self.output_tensor[batch_index:batch_index+1], save_filename, img_metadata, writer)
 
     @staticmethod
-    def save_tensor_as_image(image_tensor, save_filename, img_metadata=None):
-        with torch.inference_mode():
-            try:
-                # if we weren't passed any info, generated a blank info object
-                info = img_metadata if img_metadata else PngImagePlugin.PngInfo()
-                if os.path.splitext(save_filename)[1].lower() == '.png':
-                    TF.to_pil_image(image_tensor[0].cpu()).save(save_filename, pnginfo=VF.png_info_chunks(img_metadata))
-                elif os.path.splitext(save_filename)[1].lower() == '.jpg':
-                    TF.to_pil_image(image_tensor[0].cpu()).save(save_filename, quality=75, exif=VF.info_to_jpg_exif(img_metadata))
-                else:
-                    # unknown file extension so we can't include metadata, but if torch supports it try to save in that format.
-                    TF.to_pil_image(image_tensor[0].cpu()).save(save_filename)
-            except:
-                raise NameError('Unable to save image. Unknown file format?')
+    def save_tensor_as_image(image_tensor, save_filename, img_metadata=None, writer=None):
+        if writer is not None:
+            writer.submit(image_tensor, save_filename, img_metadata)
+        else:
+            image_writer.write_image(image_tensor, save_filename, img_metadata)
 
     def ascend_txt(self,iteration_number):
         """Part of the process of training a GAN
@@ -198,54 +303,121 @@ class Engine:
             iteration_number (int): Current iteration number, used only to adjust the weight of the inital image if init_weight is used.
 
         Returns:
-            lossAll (tensor): Parameter describing the performance of the GAN training process
+            lossAll (tensor): Parameter describing the performance of the GAN training process. Each loss has one value per image in the batch.
         """
-        self.output_tensor = self.synth(self._z)
-        encoded_image = self._perceptor.encode_image(VF.normalize(self._make_cutouts(self.output_tensor))).float()
+        stage = self._stage
+        with stage('synth'):
+            self.output_tensor = self.synth(self._z)
+        with stage('cutouts'):
+            cutouts = VF.normalize(self._make_cutouts(self.output_tensor))
+        with stage('encode_image'):
+            encoded_image = self._perceptor.encode_image(cutouts).float()
+        # cutouts are ordered cut-major, [cutn * batch]. Regroup them per image as [batch, cutn, D].
+        batch_size = self._z.shape[0]
+        encoded_image = encoded_image.view(-1, batch_size, encoded_image.shape[-1]).transpose(0, 1)
         
         result = []
 
         if self.conf.init_weight:
             if self.conf.init_image_method == 'original':
-                result.append(F.mse_loss(self._z, self._z_orig) * self.conf.init_weight / 2)
+                result.append(self._per_image_mse(self._z, self._z_orig) * self.conf.init_weight / 2)
             elif self.conf.init_image_method == 'decay':
-                result.append(F.mse_loss(self._z, torch.zeros_like(self._z_orig)) * ((1/torch.tensor(iteration_number*2 + 1))*self.conf.init_weight) / 2)
+                result.append(self._per_image_mse(self._z, torch.zeros_like(self._z_orig)) * ((1/torch.tensor(iteration_number*2 + 1))*self.conf.init_weight) / 2)
             elif self.conf.init_image_method == 'alternate_img_target':
-                result.append(F.mse_loss(self._z, self._alternate_img_target) * self.conf.init_weight / 2)
+                result.append(self._per_image_mse(self._z, self._alternate_img_target) * self.conf.init_weight / 2)
             elif self.conf.init_image_method == 'alternate_img_target_decay':
-                result.append(F.mse_loss(self._z, self._alternate_img_target) * ((self.conf.init_weight * 5 / torch.tensor(iteration_number*2 + 1))))
+                result.append(self._per_image_mse(self._z, self._alternate_img_target) * ((self.conf.init_weight * 5 / torch.tensor(iteration_number*2 + 1))))
             else:
                 raise NameError(f'Invalid init_weight_method {self.conf.init_image_method}')
 
-        for prompt in self.pMs:
-            result.append(prompt(encoded_image))
+        if self.pMs:
+            with stage('prompt_losses'):
+                prompt_losses = self._stacked_prompts()(encoded_image)
+                if self._prompt_mask is not None:
+                    # prompts added for one image of the batch have no loss for the other images
+                    prompt_losses = prompt_losses * self._prompt_mask
+                result.extend(prompt_losses.unbind(-1))
         
         return result
 
+    def _stacked_prompts(self):
+        # pack self.pMs into a single VF.PromptStack, rebuilt only when prompts have been added or cleared
+        if self._prompt_stack_source != self.pMs:
+            self._prompt_stack = VF.PromptStack(self.pMs).to(self._device)
+            self._prompt_stack_source = list(self.pMs)
+            self._prompt_mask = None
+            if self._prompt_batch_index:
+                self._prompt_mask = torch.ones(self._z.shape[0], len(self.pMs), device=self._device)
+                for prompt_position, batch_index in self._prompt_batch_index.items():
+                    self._prompt_mask[:, prompt_position] = 0
+                    self._prompt_mask[batch_index, prompt_position] = 1
+        return self._prompt_stack
+
+    @staticmethod
+    def _per_image_mse(z, target):
+        # mean squared error for each image in the batch. target may have a batch size of 1, and is then shared by every image.
+        return (z - target).pow(2).mean(dim=(1, 2, 3))
+
     # Vector quantize
     def synth(self, z):
-        if self._gumbel:
-            z_q = VF.vector_quantize(z.movedim(1, 3), self._model.quantize.embed.weight).movedim(3, 1)
+        z_q = self._quantizer(z.movedim(1, 3)).movedim(3, 1)
+        if self.conf.gradient_checkpointing and torch.is_grad_enabled():
+            decode = VF.checkpointed_decode
         else:
-            z_q = VF.vector_quantize(z.movedim(1, 3), self._model.quantize.embedding.weight).movedim(3, 1)
+            decode = lambda model, quant: model.decode(quant)
+        tile_size = self.decode_tile_size()
+        if tile_size:
+            decoded = VF.tiled_decode(self._model, z_q, tile_size, self.conf.decode_tile_overlap, decode=decode)
+        else:
+            decoded = decode(self._model, z_q)
         clamp_with_grad = VF.ClampWithGrad.apply
-        return clamp_with_grad(self._model.decode(z_q).add(1).div(2), 0, 1)
+        return clamp_with_grad(decoded.add(1).div(2), 0, 1)
+
+    def decode_tile_size(self):
+        """Size of the latent tiles decoded by synth(), from conf.decode_tile_size or conf.decode_memory_budget.
+
+        Returns:
+            int: Width and height of a tile, in latent vectors, or None if the latent is decoded in one piece.
+        """
+        if self.conf.decode_tile_size:
+            return self.conf.decode_tile_size
+        if self.conf.decode_memory_budget:
+            return VF.decode_tile_size(self._models.decode_memory_per_latent(), self.conf.decode_memory_budget * 2**20, self.conf.decode_tile_overlap)
+        return None
 
-    def initialize_VQGAN_CLIP(self):
+    def initialize_VQGAN_CLIP(self, seeds=None):
         """Prior to using a VGQAN-CLIP engine instance, it must be initialized using this method.
+
+        Args:
+            seeds (list of int, optional): Optimize one image per seed, all in a single batch. If None, a single image is generated using conf.seed. Defaults to None.
         """
         if self.conf.cudnn_determinism:
             torch.backends.cudnn.deterministic = True
 
         self._device = torch.device(self.conf.cuda_device)
         self.load_model()
-        jit = True if float(torch.__version__[:3]) < 1.8 else False
-        self._perceptor = clip.load(self.conf.clip_model, jit=jit)[0].eval().requires_grad_(False).to(self._device)
+        self.initialize_quantizer()
 
         self.set_seed(self.conf.seed)
 
         self.select_make_cutouts()    
-        self.initialize_z()
+        self.initialize_z(seeds)
+
+    def initialize_quantizer(self):
+        """Create the vector quantizer used by synth() from the codebook of the loaded VQGAN model. This must be done again if a different model is loaded.
+        """
+        self._quantizer = self._models.quantizer(self._gumbel,
+                                                 chunk_size=self.conf.quantize_chunk_size,
+                                                 approximate=self.conf.quantize_approximate,
+                                                 num_probes=self.conf.quantize_probes)
+
+    def quantizer_disagreement_rate(self):
+        """Fraction of the latent vectors in the current image for which approximate quantization (conf.quantize_approximate) picks a different codebook entry than an exact search.
+
+        Returns:
+            float: Fraction between 0 and 1. Always 0 when quantize_approximate is False.
+        """
+        return self._quantizer.disagreement_rate(self._z.movedim(1, 3))
 
     def encode_and_append_noise_prompt(self, prompt):
         """Encodes a weighted list of random number generator seeds using CLIP and appends those to the set of prompts being used by this model instance.
@@ -262,41 +434,64 @@ class Engine:
         embed = torch.empty([1, self._perceptor.visual.output_dim]).normal_(generator=gen)
         self.pMs.append(VF.Prompt(embed, weight).to(self._device))
 
-    def initialize_z(self):
+    def initialize_z(self, seeds=None):
+        """Create the latent vector z that is optimized by train().
+
+        Args:
+            seeds (list of int, optional): Create one latent vector per seed, stacked into a single batch. Each seed sets the random number generator before its latent vector is drawn. If None, a single latent vector is drawn from the current random state. Defaults to None.
+        """
         # Gumbel or not?
         if self._gumbel:
-            e_dim = 256
-            n_toks = self._model.quantize.n_embed
             self.z_min = self._model.quantize.embed.weight.min(dim=0).values[None, :, None, None]
             self.z_max = self._model.quantize.embed.weight.max(dim=0).values[None, :, None, None]
         else:
-            e_dim = self._model.quantize.e_dim
-            n_toks = self._model.quantize.n_e
             self.z_min = self._model.quantize.embedding.weight.min(dim=0).values[None, :, None, None]
             self.z_max = self._model.quantize.embedding.weight.max(dim=0).values[None, :, None, None]
 
+        if seeds is None:
+            self._z = self._initial_latent_vector()
+        elif self.conf.init_image:
+            # every seed starts from the same init_image, so only encode it once
+            torch.manual_seed(seeds[0])
+            self._z = self._initial_latent_vector().repeat(len(seeds), 1, 1, 1)
+        else:
+            latent_vectors = []
+            for seed in seeds:
+                torch.manual_seed(seed)
+                latent_vectors.append(self._initial_latent_vector())
+            self._z = torch.cat(latent_vectors)
+        self._z_orig = self._z.clone()
+        self._z.requires_grad_(True)
+
+    def _initial_latent_vector(self):
+        # Returns a latent vector with a batch size of 1, based on the configured init_image or init_noise
         if self.conf.init_image:
-            self.convert_image_to_init_image(Image.open(self.conf.init_image))
+            return self.pil_image_to_latent_vector(Image.open(self.conf.init_image))
         elif self.conf.init_noise == 'pixels':
-            self.convert_image_to_init_image(VF.make_random_noise_image(self.conf.image_size[0], self.conf.image_size[1]))
+            return self.pil_image_to_latent_vector(VF.make_random_noise_image(self.conf.image_size[0], self.conf.image_size[1]))
         elif self.conf.init_noise == 'gradient':
-            self.convert_image_to_init_image(VF.make_random_gradient_image(self.conf.image_size[0], self.conf.image_size[1]))
+            return self.pil_image_to_latent_vector(VF.make_random_gradient_image(self.conf.image_size[0], self.conf.image_size[1]))
+
+        # this is the default that happens if no initialization image options are specified
+        if self._gumbel:
+            e_dim = 256
+            n_toks = self._model.quantize.n_embed
         else:
-            # this is the default that happens if no initialization image options are specified
-            f = 2**(self._model.decoder.num_resolutions - 1)
-            toksX = self.conf.output_image_size[0] // f
-            toksY = self.conf.output_image_size[1] // f
-            one_hot = F.one_hot(torch.randint(n_toks, [toksY * toksX], device=self._device), n_toks).float()
-            # self._z = one_hot @ self._model.quantize.embedding.weight
-            if self._gumbel:
-                self._z = one_hot @ self._model.quantize.embed.weight
-            else:
-                self._z = one_hot @ self._model.quantize.embedding.weight
+            e_dim = self._model.quantize.e_dim
+            n_toks = self._model.quantize.n_e
+        f = 2**(self._model.decoder.num_resolutions - 1)
+        toksX = self.conf.output_image_size[0] // f
+        toksY = self.conf.output_image_size[1] // f
+        one_hot = F.one_hot(torch.randint(n_toks, [toksY * toksX], device=self._device), n_toks).float()
+        # z = one_hot @ self._model.quantize.embedding.weight
+        if self._gumbel:
+            z = one_hot @ self._model.quantize.embed.weight
+        else:
+            z = one_hot @ self._model.quantize.embedding.weight
 
-            self._z = self._z.view([-1, toksY, toksX, e_dim]).permute(0, 3, 1, 2) 
-            #self._z = torch.rand_like(self._z)*2						# NR: check
-            self._z_orig = self._z.clone()
-            self._z.requires_grad_(True)
+        z = z.view([-1, toksY, toksX, e_dim]).permute(0, 3, 1, 2) 
+        #z = torch.rand_like(z)*2						# NR: check
+        return z
 
     def calculate_output_image_size(self):
         """The size of the VQGAN output image is constrained by the CLIP model. This function returns the appropriate output image size, given what was requested, and what CLIP delivers.
@@ -311,26 +506,62 @@ class Engine:
 
     def select_make_cutouts(self):
         # Cutout class options:
+        cut_size = self._perceptor.visual.input_resolution
         if self.conf.cut_method == 'original':
-            self._make_cutouts = VF.MakeCutoutsOrig(self._perceptor.visual.input_resolution, self.conf.num_cuts, cut_pow=self.conf.cut_power)
+            self._make_cutouts = VF.MakeCutoutsOrig(cut_size, self.conf.num_cuts, cut_pow=self.conf.cut_power, batched=self.conf.batched_cutouts)
         elif self.conf.cut_method == 'kornia':
-            self._make_cutouts = VF.MakeCutoutsKornia(self._perceptor.visual.input_resolution, self.conf.num_cuts, cut_pow=self.conf.cut_power)
+            self._make_cutouts = VF.MakeCutoutsKornia(cut_size, self.conf.num_cuts, cut_pow=self.conf.cut_power, batched=self.conf.batched_cutouts)
         elif self.conf.cut_method == 'sg3':
-            self._make_cutouts = VF.MakeCutoutsSG3(self._perceptor.visual.input_resolution, self.conf.num_cuts, cut_pow=self.conf.cut_power)
+            self._make_cutouts = VF.MakeCutoutsSG3(cut_size, self.conf.num_cuts, cut_pow=self.conf.cut_power, batched=self.conf.batched_cutouts)
         else:
-            self._make_cutouts = VF.MakeCutoutsOrig(self._perceptor.visual.input_resolution, self.conf.num_cuts, cut_pow=self.conf.cut_power)
+            self._make_cutouts = VF.MakeCutoutsOrig(cut_size, self.conf.num_cuts, cut_pow=self.conf.cut_power, batched=self.conf.batched_cutouts)
 
     def convert_image_to_init_image(self, pil_image):
         self._z = self.pil_image_to_latent_vector(pil_image)
         self._z_orig = self._z.clone()
         self._z.requires_grad_(True)
 
+    def convert_tensor_to_init_image(self, image_tensor):
+        """Use an image tensor, such as a transformed output_tensor, as the initial image. Unlike convert_image_to_init_image(), the image is not
+        copied to a PIL image and back, and stays on the device where it is.
+
+        Args:
+            image_tensor (tensor): Images with values between 0 and 1, at the size returned by calculate_output_image_size(), [N, 3, H, W].
+        """
+        self._z = self.tensor_to_latent_vector(image_tensor.detach())
+        self._z_orig = self._z.clone()
+        self._z.requires_grad_(True)
+
+    def warp_latent(self, zoom=1.0, shift_x=0, shift_y=0, rotation=0.0):
+        """Move the current image by warping the latent vector z directly with VF.warp_latent(), instead of transforming output_tensor and encoding
+        it again with convert_tensor_to_init_image(). The optimizer state is warped in the same way and kept, so configure_optimizer() does not need
+        to be called afterwards. Motion is applied on the latent grid, so it is smoother but less sharp than transforming the image.
+
+        Args:
+            zoom (float, optional): Zoom ratio around the center of the image. Values above 1 zoom in. Defaults to 1.0.
+            shift_x (float, optional): Number of pixels to shift the image to the right. May be a fraction of a latent vector. Defaults to 0.
+            shift_y (float, optional): Number of pixels to shift the image down. May be a fraction of a latent vector. Defaults to 0.
+            rotation (float, optional): Angle in degrees to rotate the image counterclockwise around its center. Defaults to 0.0.
+        """
+        f = 2**(self._model.decoder.num_resolutions - 1)
+        warp = lambda tensor: VF.warp_latent(tensor, zoom, shift_x / f, shift_y / f, rotation)
+        with torch.no_grad():
+            self._z.copy_(warp(self._z))
+            self._z_orig = self._z.detach().clone()
+            # e.g. the moment estimates of Adam, which are per element of z
+            for state in self._optimizer.state[self._z].values():
+                if torch.is_tensor(state) and state.shape == self._z.shape:
+                    state.copy_(warp(state))
+
     def pil_image_to_latent_vector(self, pil_image):
         output_image_size_X, output_image_size_Y = self.calculate_output_image_size()
         pil_image = pil_image.convert('RGB')
         pil_image = pil_image.resize((output_image_size_X, output_image_size_Y), Image.LANCZOS)
         pil_tensor = TF.to_tensor(pil_image)
-        latent_vector, *_ = self._model.encode(pil_tensor.to(self._device).unsqueeze(0) * 2 - 1)
+        return self.tensor_to_latent_vector(pil_tensor.unsqueeze(0))
+
+    def tensor_to_latent_vector(self, image_tensor):
+        latent_vector, *_ = self._model.encode(image_tensor.to(self._device) * 2 - 1)
         return latent_vector
 
     def set_alternate_image_target(self, pil_image):
@@ -346,6 +577,10 @@ class Engine:
         """Clear all encoded prompts. You might use this during video generation to reset the prompts so that you can cause the video to steer in a new direction.
         """
         self.pMs = []
+        self._prompt_stack = None
+        self._prompt_stack_source = None
+        self._prompt_batch_index = {}
+        self._prompt_mask = None
 
     def encode_and_append_image_prompt(self, prompt):
         """Encodes a list of image prompts using CLIP and appends those to the set of prompts being used by this model instance.
@@ -358,8 +593,9 @@ class Engine:
         """
         # given an image prompt that is a filename followed by a weight e.g. 'prompt_image.png:0.5', load the image, encode it with CLIP, and append it to the list of prompts used for image generation
         path, weight, stop = VF.split_prompt(prompt)
-        pil_image = Image.open(path).convert('RGB')
-        self.encode_and_append_pil_image(pil_image, weight, stop)
+        # the image is only opened if its embedding is not already cached
+        embed = self._encode_image_prompt(embedding_cache.file_content_hash(path), lambda: Image.open(path).convert('RGB'))
+        self.pMs.append(VF.Prompt(embed, weight, stop).to(self._device))
 
 
     def encode_and_append_pil_image(self, pil_image, weight=1.0, stop=float('-inf') ):
@@ -370,12 +606,27 @@ class Engine:
             weight (float, optional): Weight to use in CLIP loss calculation. Defaults to 1.0.
             stop ([type], optional): Unknown. From original code. Defaults to float('-inf').
         """
-        output_image_size_X, output_image_size_Y = self.calculate_output_image_size()
-        output_image = VF.resize_image(pil_image, (output_image_size_X, output_image_size_Y))
-        batch = self._make_cutouts(TF.to_tensor(output_image).unsqueeze(0).to(self._device))
-        embed = self._perceptor.encode_image(VF.normalize(batch)).float()
+        embed = self._encode_image_prompt(embedding_cache.pil_image_content_hash(pil_image), lambda: pil_image)
         self.pMs.append(VF.Prompt(embed, weight, stop).to(self._device))
 
+    def _encode_image_prompt(self, content_hash, load_image):
+        # CLIP encode the cutouts of an image prompt, or return them from the image embedding cache. The cutouts are drawn from a
+        # random number generator seeded with conf.seed, so that cached and newly encoded embeddings are identical, and so that
+        # a cache hit leaves the global random state exactly as a miss would.
+        output_image_size = self.calculate_output_image_size()
+        key = (content_hash, output_image_size, self.conf.cut_method, self.conf.num_cuts, self.conf.cut_power,
+               self.conf.batched_cutouts, self.conf.seed, self.conf.clip_model, self._models.perceptor_fingerprint())
+        image_cache = embedding_cache.image_embedding_cache()
+        embed = image_cache.get(key)
+        if embed is None:
+            output_image = VF.resize_image(load_image(), output_image_size)
+            with torch.random.fork_rng(devices=[self._device] if self._device.type == 'cuda' else []):
+                torch.manual_seed(self.conf.seed)
+                batch = self._make_cutouts(TF.to_tensor(output_image).unsqueeze(0).to(self._device))
+            embed = self._perceptor.encode_image(VF.normalize(batch)).float()
+            image_cache.put(key, embed)
+        return embed
+
 
     def encode_and_append_text_prompt(self, prompt):
         """Encodes a list of text prompts using CLIP and appends those to the set of prompts being used by this model instance.
@@ -387,17 +638,26 @@ class Engine:
         """
         # given a text prompt like 'a field of red flowers:0.5' parse that into text and weights, encode it with CLIP, and add it to the encoded prompts used for image generation
         txt, weight, stop = VF.split_prompt(prompt)
-        embed = self._perceptor.encode_text(clip.tokenize(txt).to(self._device)).float()
+        text_cache = embedding_cache.text_embedding_cache(self.conf.embedding_cache_dir)
+        # the weights are part of the key, so that a different CLIP model registered under the same clip_model name doesn't reuse the embeddings
+        cache_model = f'{self.conf.clip_model}@{self._models.perceptor_fingerprint()}'
+        embed = text_cache.get(cache_model, txt)
+        if embed is None:
+            import clip
+            embed = self._perceptor.encode_text(clip.tokenize(txt).to(self._device)).float()
+            text_cache.put(cache_model, txt, embed)
         self.pMs.append(VF.Prompt(embed, weight, stop).to(self._device))
 
     def load_model(self):
-        # This step is slow, and does not need to be done each time an image is generated.
-        model_yaml_path = load_file_from_url(self.conf.vqgan_model_yaml_url, model_dir=self.conf.model_dir, progress=True, file_name=self.conf.vqgan_model_name+'.yaml')
-        model_ckpt_path = load_file_from_url(self.conf.vqgan_model_ckpt_url, model_dir=self.conf.model_dir, progress=True, file_name=self.conf.vqgan_model_name+'.ckpt')
-        self._model = VF.load_vqgan_model(model_yaml_path, model_ckpt_path).to(self._device)
+        """Get the VQGAN and CLIP models selected in self.conf from the process-wide model_registry. They are only loaded from disk the first time they are used,
+        and are shared with every other Engine that uses them, so they must not be modified.
+        """
+        self._models = model_registry.get(self.conf)
+        self._model = self._models.vqgan
+        self._perceptor = self._models.perceptor
 
       
-    def encode_and_append_prompts(self, prompt_number, text_prompts=[], image_prompts=[], noise_prompts=[]):
+    def encode_and_append_prompts(self, prompt_number, text_prompts=[], image_prompts=[], noise_prompts=[], batch_index=None):
         """CLIP tokenize/encode the selected prompts from text, input images, and noise parameters
         Apply self.encode_and_append_text_prompt() to each of 
         text_prompts[prompt_number], 
@@ -411,8 +671,10 @@ class Engine:
             text_prompts (list of lists): List of lists text prompts that should all be applied in parallel
             image_prompts (list of lists): List of lists of text prompts that should all be applied in parallel
             noise_prompts (list of lists): List of lists of text prompts that should all be applied in parallel
-            
+            batch_index (int, optional): When several seeds are optimized together, apply these prompts only to the image at this index of the batch. This lets
+                images with different prompts share a batch. If None, the prompts apply to every image. Defaults to None.
         """
+        first_prompt_position = len(self.pMs)
         if len(text_prompts) > 0:
             current_index = min(prompt_number, len(text_prompts)-1)
             for prompt in text_prompts[current_index]:
@@ -433,3 +695,7 @@ class Engine:
             for prompt in noise_prompts[current_index]:
                 # tqdm.write(f'Noise prompt: {prompt_number} {prompt}')
                 self.encode_and_append_noise_prompt(prompt)
+
+        if batch_index is not None:
+            for prompt_position in range(first_prompt_position, len(self.pMs)):
+                self._prompt_batch_index[prompt_position] = batch_index
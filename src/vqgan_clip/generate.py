@@ -10,10 +10,18 @@
 
 from vqgan_clip.engine import Engine, VQGAN_CLIP_Config
 from vqgan_clip.z_smoother import Z_Smoother
+from vqgan_clip.early_stopping import EarlyStopping
+from vqgan_clip.image_writer import AsyncImageWriter
+from vqgan_clip import checkpoint
+from vqgan_clip import model_registry
+from vqgan_clip.video_tools import VideoFrameSource
 from tqdm.auto import tqdm
 import os
 import contextlib
+import itertools
+import shutil
 import torch
+import torch.multiprocessing
 import warnings
 from PIL import ImageFile, Image, ImageChops, PngImagePlugin
 ImageFile.LOAD_TRUNCATED_IMAGES = True
@@ -29,6 +37,7 @@ def image(output_filename,
         init_weight = 0.0,
         iterations = 100,
         save_every = None,
+        early_stopping = None,
         verbose = False,
         leave_progress_bar = True):
     """Generate a single image using VQGAN+CLIP. The configuration of the algorithms is done via a VQGAN_CLIP_Config instance.
@@ -43,6 +52,7 @@ def image(output_filename,
         * init_weight (float, optional) : Relative weight to assign to keeping the init_image content.
         * iterations (int, optional) : Number of iterations of train() to perform before stopping. Default = 100 
         * save_every (int, optional) : An interim image will be saved as the final image is being generated. It's saved to the output location every save_every iterations, and training stats will be displayed. Default = None  
+        * early_stopping (EarlyStopping, optional) : Stop before iterations once the loss stops improving, as decided by this EarlyStopping instance. The number of iterations used is saved in the image metadata and in the returned string. Default = None
         * verbose (boolean, optional) : When true, prints diagnostic data every time a video frame is saved. Defaults to False.
         * leave_progress_bar (boolean, optional) : When False, the tqdm progress bar will disappear when the work is completed. Useful for nested loops.
     """
@@ -56,6 +66,8 @@ def image(output_filename,
         raise ValueError(f'init_image does not exist.')
     if save_every not in [[], None] and not isinstance(save_every, int):
         raise ValueError(f'save_every must be an int.')
+    if early_stopping is not None and not isinstance(early_stopping, EarlyStopping):
+        raise ValueError('early_stopping must be an EarlyStopping instance.')
     if text_prompts in [[], None] and image_prompts in [[], None] and noise_prompts in [[], None]:
         raise ValueError('No valid prompts were provided')
 
@@ -89,6 +101,9 @@ def image(output_filename,
             ('seed',eng.conf.seed)]
 
     # generate the image
+    iterations_used = 0
+    if early_stopping:
+        early_stopping.reset(iterations)
     try:
         for iteration_num in tqdm(range(1,iterations+1),unit='iteration',desc='single image',leave=leave_progress_bar):
             #perform iterations of train()
@@ -98,16 +113,26 @@ def image(output_filename,
                 if verbose:
                     # display some statistics about how the GAN training is going whever we save an interim image
                     losses_str = ', '.join(f'{loss.item():7.3f}' for loss in lossAll)
-                    tqdm.write(f'iteration:{iteration_num:6d}\tloss sum: {sum(lossAll).item():7.3f}\tloss for each prompt:{losses_str}')
+                    tqdm.write(f'iteration:{iteration_num:6d}\tloss sum: {sum(lossAll).item():7.3f}\tloss for each prompt:{losses_str}{_quantizer_stats(eng)}')
                 # save an interim copy of the image so you can look at it as it changes if you like
                 eng.save_current_output(output_filename,img_info) 
 
+            iterations_used = iteration_num
+            if early_stopping and early_stopping.update(lossAll):
+                if verbose:
+                    tqdm.write(f'loss stopped improving after {iterations_used} iterations')
+                break
+
         # Always save the output at the end
+        img_info.append(('iterations_used',iterations_used))
         eng.save_current_output(output_filename,img_info) 
     except KeyboardInterrupt:
         pass
 
+    if verbose and eng.stage_timings:
+        tqdm.write(eng.stage_timings.summary())
     config_info=f'iterations: {iterations}, '\
+            f'iterations used: {iterations_used}, '\
             f'image_prompts: {image_prompts}, '\
             f'noise_prompts: {noise_prompts}, '\
             f'init_weight_method: {eng_config.init_image_method}, '\
@@ -117,6 +142,136 @@ def image(output_filename,
             f'seed {eng.conf.seed}'
     return config_info
 
+def images(output_filenames,
+        seeds,
+        eng_config = VQGAN_CLIP_Config(),
+        text_prompts = [],
+        image_prompts = [],
+        noise_prompts = [],
+        init_image = None,
+        init_weight = 0.0,
+        iterations = 100,
+        save_every = None,
+        early_stopping = None,
+        verbose = False,
+        leave_progress_bar = True):
+    """Generate several images using VQGAN+CLIP, one per random number generator seed. All of the images are optimized together in a single batch,
+    which keeps the device busier than calling image() once per seed. Each seed sets the starting latent vector of its image. The random cutouts
+    evaluated by CLIP are shared by the whole batch, so an image will not be pixel-identical to the output of image() with the same seed.
+
+    Args:
+        * output_filenames (list of str) : Locations to save the output images, one per seed.
+        * seeds (list of int) : Random number generator seeds. One image is generated for each seed.
+        * eng_config (VQGAN_CLIP_Config, optional): An instance of VQGAN_CLIP_Config with attributes customized for your use. See the documentation for VQGAN_CLIP_Config().
+        * text_prompts (str, optional) : Text that will be turned into a prompt via CLIP. Default = []
+        * image_prompts (str, optional) : Path to image that will be turned into a prompt via CLIP (analyzed for content). Default = []
+        * noise_prompts (str, optional) : Random number seeds can be used as prompts using the same format as a text prompt. E.g. \'123:0.1|234:0.2|345:0.3\' Stories (^) are supported. Default = []
+        * init_image (str, optional) : Path to an image file that will be used as the seed to generate output (analyzed for pixels). Every image starts from the same init_image.
+        * init_weight (float, optional) : Relative weight to assign to keeping the init_image content.
+        * iterations (int, optional) : Number of iterations of train() to perform before stopping. Default = 100
+        * save_every (int, optional) : Interim images will be saved as the final images are being generated. They are saved to the output locations every save_every iterations, and training stats will be displayed. Default = None
+        * early_stopping (EarlyStopping, optional) : Stop before iterations once the total loss of the batch stops improving, as decided by this EarlyStopping instance. The number of iterations used is saved in the image metadata and in the returned string. Default = None
+        * verbose (boolean, optional) : When true, prints diagnostic data every time interim images are saved. Defaults to False.
+        * leave_progress_bar (boolean, optional) : When False, the tqdm progress bar will disappear when the work is completed. Useful for nested loops.
+    """
+    if text_prompts not in [[], None] and not isinstance(text_prompts, str):
+        raise ValueError('text_prompts must be a string')
+    if image_prompts not in [[], None] and not isinstance(image_prompts, str):
+        raise ValueError('image_prompts must be a string')
+    if noise_prompts not in [[], None] and not isinstance(noise_prompts, str):
+        raise ValueError('noise_prompts must be a string')
+    if init_image not in [[], None] and not os.path.isfile(init_image):
+        raise ValueError(f'init_image does not exist.')
+    if save_every not in [[], None] and not isinstance(save_every, int):
+        raise ValueError(f'save_every must be an int.')
+    if early_stopping is not None and not isinstance(early_stopping, EarlyStopping):
+        raise ValueError('early_stopping must be an EarlyStopping instance.')
+    if text_prompts in [[], None] and image_prompts in [[], None] and noise_prompts in [[], None]:
+        raise ValueError('No valid prompts were provided')
+    if not isinstance(seeds, list) or not seeds or not all(isinstance(seed, int) for seed in seeds):
+        raise ValueError('seeds must be a list of int.')
+    if not isinstance(output_filenames, list) or len(output_filenames) != len(seeds):
+        raise ValueError('output_filenames must be a list with one filename per seed.')
+
+    for output_filename in output_filenames:
+        output_folder_name = os.path.dirname(output_filename)
+        if output_folder_name:
+            os.makedirs(output_folder_name, exist_ok=True)
+
+    if init_image:
+        eng_config.init_image = init_image
+        output_size_X, output_size_Y = VF.filesize_matching_aspect_ratio(init_image, eng_config.output_image_size[0], eng_config.output_image_size[1])
+        eng_config.output_image_size = [output_size_X, output_size_Y]
+        eng_config.init_weight = init_weight
+    # the first seed also drives the random cutouts, so a batch of one seed matches image() with that seed.
+    eng_config.seed = seeds[0]
+
+    # suppress stdout to keep the progress bar clear
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            eng = Engine(eng_config)
+            eng.initialize_VQGAN_CLIP(seeds=seeds)
+    parsed_text_prompts, parsed_image_prompts, parsed_noise_prompts = VF.parse_all_prompts(text_prompts, image_prompts, noise_prompts)
+    eng.encode_and_append_prompts(0, parsed_text_prompts, parsed_image_prompts, parsed_noise_prompts)
+    eng.configure_optimizer()
+    # metadata to save to jpge file as data chunks
+    img_infos = [[('text_prompts',text_prompts),
+            ('image_prompts',image_prompts),
+            ('noise_prompts',noise_prompts),
+            ('iterations',iterations),
+            ('init_image',init_image),
+            ('save_every',save_every),
+            ('cut_method',eng_config.cut_method),
+            ('seed',seed)] for seed in seeds]
+
+    # generate the images
+    iterations_used = 0
+    if early_stopping:
+        early_stopping.reset(iterations)
+    try:
+        for iteration_num in tqdm(range(1,iterations+1),unit='iteration',desc='batched images',leave=leave_progress_bar):
+            #perform iterations of train()
+            lossAll = eng.train(iteration_num)
+
+            if save_every and iteration_num % save_every == 0:
+                if verbose:
+                    # display some statistics about how the GAN training is going whever we save interim images
+                    for batch_index, seed in enumerate(seeds):
+                        losses_str = ', '.join(f'{loss[batch_index].item():7.3f}' for loss in lossAll)
+                        tqdm.write(f'iteration:{iteration_num:6d}\tseed: {seed}\tloss sum: {sum(lossAll)[batch_index].item():7.3f}\tloss for each prompt:{losses_str}')
+                    if eng.conf.quantize_approximate:
+                        tqdm.write(f'iteration:{iteration_num:6d}{_quantizer_stats(eng)}')
+                # save interim copies of the images so you can look at them as they change if you like
+                for batch_index, output_filename in enumerate(output_filenames):
+                    eng.save_current_output(output_filename,img_infos[batch_index],batch_index=batch_index)
+
+            iterations_used = iteration_num
+            if early_stopping and early_stopping.update(lossAll):
+                if verbose:
+                    tqdm.write(f'loss stopped improving after {iterations_used} iterations')
+                break
+
+        # Always save the output at the end
+        for img_info in img_infos:
+            img_info.append(('iterations_used',iterations_used))
+        for batch_index, output_filename in enumerate(output_filenames):
+            eng.save_current_output(output_filename,img_infos[batch_index],batch_index=batch_index)
+    except KeyboardInterrupt:
+        pass
+
+    if verbose and eng.stage_timings:
+        tqdm.write(eng.stage_timings.summary())
+    config_info=f'iterations: {iterations}, '\
+            f'iterations used: {iterations_used}, '\
+            f'image_prompts: {image_prompts}, '\
+            f'noise_prompts: {noise_prompts}, '\
+            f'init_weight_method: {eng_config.init_image_method}, '\
+            f'init_weight {eng_config.init_weight:1.2f}, '\
+            f'init_image {init_image}, '\
+            f'cut_method {eng_config.cut_method}, '\
+            f'seeds {seeds}'
+    return config_info
+
 def restyle_video_frames(video_frames,
     eng_config=VQGAN_CLIP_Config(),
     text_prompts = 'Covered in spiders | Surreal:0.5',
@@ -257,7 +412,8 @@ def restyle_video_frames(video_frames,
             # if making a video, save a frame named for the video step
             if z_smoother:
                 smoothed_z.append(eng._z.clone())
-                output_tensor = eng.synth(smoothed_z._mid_ewma())
+                with torch.no_grad():
+                    output_tensor = eng.synth(smoothed_z._mid_ewma())
                 Engine.save_tensor_as_image(output_tensor,filepath_to_save,img_info)
             else:
                 eng.save_current_output(filepath_to_save,img_info)
@@ -291,9 +447,15 @@ def video_frames(num_video_frames,
         zoom_scale=1.0,
         shift_x=0, 
         shift_y=0,
+        rotation=0.0,
+        latent_motion=False,
         z_smoother=False,
         z_smoother_buffer_len=5,
         z_smoother_alpha=0.9,
+        early_stopping=None,
+        checkpoint_every=None,
+        resume=False,
+        video_writer=None,
         verbose=False,
         leave_progress_bar = True):
     """Generate a series of PNG-formatted images using VQGAN+CLIP where each image is related to the previous image so they can be combined into a video. 
@@ -310,12 +472,18 @@ def video_frames(num_video_frames,
         * change_prompts_on_frame (list(int)) : All prompts (separated by "^") will be cycled forward on the video frames provided here. Defaults to None.
         * init_image (str, optional) : Path to an image file that will be used as the seed to generate output (analyzed for pixels).
         * video_frames_path (str, optional) : Path where still images should be saved as they are generated before being combined into a video. Defaults to './video_frames'.
-        * zoom_scale (float) : Every save_every iterations, a video frame is saved. That frame is shifted scaled by a factor of zoom_scale, and used as the initial image to generate the next frame. Default = 1.0
-        * shift_x (int, optional) : Every save_every iterations, a video frame is saved. That frame is shifted shift_x pixels in the x direction, and used as the initial image to generate the next frame. Default = 0
-        * shift_y (int, optional) : Every save_every iterations, a video frame is saved. That frame is shifted shift_y pixels in the y direction, and used as the initial image to generate the next frame. Default = 0
+        * zoom_scale (float or function, optional) : Every save_every iterations, a video frame is saved. That frame is shifted scaled by a factor of zoom_scale, and used as the initial image to generate the next frame. May also be a function that takes the video frame number and returns the zoom_scale for that frame. Default = 1.0
+        * shift_x (float or function, optional) : Every save_every iterations, a video frame is saved. That frame is shifted shift_x pixels in the x direction, and used as the initial image to generate the next frame. May also be a function of the video frame number. Default = 0
+        * shift_y (float or function, optional) : Every save_every iterations, a video frame is saved. That frame is shifted shift_y pixels in the y direction, and used as the initial image to generate the next frame. May also be a function of the video frame number. Default = 0
+        * rotation (float or function, optional) : Every save_every iterations, a video frame is saved. That frame is rotated counterclockwise by this many degrees, and used as the initial image to generate the next frame. May also be a function of the video frame number. Default = 0.0
+        * latent_motion (boolean, optional) : If true, zoom_scale, shift_x, shift_y and rotation are applied to the latent vector of the image instead of to the image, and the optimizer state is kept. This skips encoding each frame again with VQGAN, which is faster, but motion is less sharp. Default = False
         * z_smoother (boolean, optional) : If true, smooth the latent vectors (z) used for image generation by combining multiple z vectors through an exponentially weighted moving average (EWMA). Defaults to False.
         * z_smoother_buffer_len (int, optional) : How many images' latent vectors should be combined in the smoothing algorithm. Bigger numbers will be smoother, and have more blurred motion. Must be an odd number. Defaults to 3.
         * z_smoother_alpha (float, optional) : When combining multiple latent vectors for smoothing, this sets how important the "keyframe" z is. As frames move further from the keyframe, their weight drops by (1-z_smoother_alpha) each frame. Bigger numbers apply more smoothing. Defaults to 0.7.
+        * early_stopping (EarlyStopping, optional) : Stop training each frame before iterations_per_frame once the loss stops improving, as decided by this EarlyStopping instance. Its min_iterations, window and check_every are scaled down for each frame if they don't fit in iterations_per_frame (see EarlyStopping.reset()). The number of iterations used is saved in the metadata of each frame. Defaults to None.
+        * checkpoint_every (int, optional) : If set, the state of the run is saved to checkpoint.pt in generated_video_frames_path every checkpoint_every video frames, so that the run can be resumed if it is interrupted. Defaults to None.
+        * resume (boolean, optional) : If true, and generated_video_frames_path has a checkpoint saved by an earlier run with checkpoint_every, continue that run after the last frame it checkpointed. The frames are the same as if the run had not been interrupted. The prompts and other settings must be the same as the earlier run. If there is no checkpoint, a new run is started. Defaults to False.
+        * video_writer (video_tools.FFmpegVideoWriter, optional) : Encode the frames to a video as they are generated, instead of saving them as images to generated_video_frames_path (unless the writer was created with save_stills=True). The writer is closed, finishing the video, when the last frame has been generated. Can't be used with resume. Defaults to None.
         * verbose (boolean, optional) : When true, prints diagnostic data every time a video frame is saved. Defaults to False.
         * leave_progress_bar (boolean, optional) : When False, the tqdm progress bar will disappear when the work is completed. Useful for nested loops.
     """
@@ -329,12 +497,35 @@ def video_frames(num_video_frames,
         raise ValueError(f'init_image does not exist.')
     if num_video_frames not in [[], None] and not isinstance(num_video_frames, int):
         raise ValueError(f'num_video_frames must be an int.')
+    if early_stopping is not None and not isinstance(early_stopping, EarlyStopping):
+        raise ValueError('early_stopping must be an EarlyStopping instance.')
+    if checkpoint_every not in [[], None] and (not isinstance(checkpoint_every, int) or checkpoint_every < 1):
+        raise ValueError('checkpoint_every must be a positive int.')
+    if video_writer is not None and resume:
+        raise ValueError('A video_writer can\'t be used with resume, because the frames before the checkpoint would be missing from the video.')
     if text_prompts in [[], None] and image_prompts in [[], None] and noise_prompts in [[], None]:
         raise ValueError('No valid prompts were provided')
 
-    if zoom_scale != 1.0 or shift_x or shift_y:
+    checkpoint_path = os.path.join(generated_video_frames_path, 'checkpoint.pt')
+    run_settings = {'function': 'video_frames',
+        'text_prompts': text_prompts,
+        'image_prompts': image_prompts,
+        'noise_prompts': noise_prompts,
+        'change_prompts_on_frame': change_prompts_on_frame,
+        'init_image': init_image,
+        'iterations_per_frame': iterations_per_frame,
+        'latent_motion': latent_motion,
+        'z_smoother': z_smoother,
+        'z_smoother_buffer_len': z_smoother_buffer_len,
+        'z_smoother_alpha': z_smoother_alpha}
+    saved = checkpoint.load_checkpoint(checkpoint_path) if resume else None
+    if saved:
+        checkpoint.check_settings(saved, run_settings)
+        eng_config.seed = saved['seed']
+
+    if zoom_scale != 1.0 or shift_x or shift_y or rotation:
         if iterations_per_frame < 10:
-            warnings.warn('When using zoom_scale or shift_x/shift_y, iterations_per_frame should be above 10')
+            warnings.warn('When using zoom_scale, shift_x/shift_y or rotation, iterations_per_frame should be above 10')
     if init_image:
         eng_config.init_image = init_image
     parsed_text_prompts, parsed_image_prompts, parsed_noise_prompts = VF.parse_all_prompts(text_prompts, image_prompts, noise_prompts)
@@ -343,30 +534,44 @@ def video_frames(num_video_frames,
         with contextlib.redirect_stdout(devnull):
             eng = Engine(eng_config)
             eng.initialize_VQGAN_CLIP()
-    current_prompt_number = 0
+    current_prompt_number = saved['prompt_number'] if saved else 0
     eng.encode_and_append_prompts(current_prompt_number, parsed_text_prompts, parsed_image_prompts, parsed_noise_prompts)
     eng.configure_optimizer()
+    if saved:
+        eng.load_state_dict(saved['engine'])
 
     # if the location for the interim video frames doesn't exist, create it
     if not os.path.exists(generated_video_frames_path):
         os.mkdir(generated_video_frames_path)
-    else:
+    elif not saved:
         VF.delete_files(generated_video_frames_path)
 
     # Smooth the latent vector z with recent results. Maintain a list of recent latent vectors.
     smoothed_z = Z_Smoother(buffer_len=z_smoother_buffer_len, alpha=z_smoother_alpha)
-    output_image_size_x, output_image_size_y = eng.calculate_output_image_size()
+    if saved and saved['z_smoother']:
+        smoothed_z.load_state_dict({'data': [z.to(eng._device) for z in saved['z_smoother']['data']]})
+    # frames are encoded and written to disk, or to the video, in the background while the next frame is trained
+    writer = video_writer if video_writer is not None else AsyncImageWriter()
     # generate images
+    frame_iterations = saved['frame_iterations'] if saved else []
+    first_video_frame_num = saved['video_frame_num'] + 1 if saved else 1
     try:
         # without an initial image, the first frame usually takes more iterations to converge away from a gray field.
-        if not init_image and iterations_for_first_frame:
+        if not init_image and iterations_for_first_frame and not saved:
             for iteration_num in tqdm(range(iterations_for_first_frame),unit='iteration',desc='first frame',leave=False):
                 lossAll = eng.train(iteration_num)
 
         # generate the video frames
-        for video_frame_num in tqdm(range(1,num_video_frames+1),unit='frame',desc='video frames',leave=leave_progress_bar):
+        for video_frame_num in tqdm(range(first_video_frame_num,num_video_frames+1),unit='frame',desc='video frames',initial=first_video_frame_num-1,total=num_video_frames,leave=leave_progress_bar):
+            iterations_used = 0
+            if early_stopping:
+                early_stopping.reset(iterations_per_frame)
             for iteration_num in tqdm(range(iterations_per_frame),unit='iteration',desc='generating frame',leave=False):
                 lossAll = eng.train(iteration_num)
+                iterations_used = iteration_num + 1
+                if early_stopping and early_stopping.update(lossAll):
+                    break
+            frame_iterations.append(iterations_used)
 
             if change_prompts_on_frame is not None:
                 if video_frame_num in change_prompts_on_frame:
@@ -375,37 +580,36 @@ def video_frames(num_video_frames,
                     eng.clear_all_prompts()
                     eng.encode_and_append_prompts(current_prompt_number, parsed_text_prompts, parsed_image_prompts, parsed_noise_prompts)
 
-            # Zoom / shift the generated image
-            if zoom_scale != 1.0 or shift_x or shift_y:
-                pil_image = TF.to_pil_image(eng.output_tensor[0].cpu())
-                if zoom_scale != 1.0:
-                    new_pil_image = VF.zoom_at(pil_image, output_image_size_x/2, output_image_size_y/2, zoom_scale)
-                else:
-                    new_pil_image = pil_image
-
-                if shift_x or shift_y:
-                    new_pil_image = ImageChops.offset(new_pil_image, shift_x, shift_y)
-                
-                # Re-encode and use this as the new initial image for the next iteration
-                eng.convert_image_to_init_image(new_pil_image)
+            # Zoom / shift / rotate the generated image
+            frame_zoom_scale, frame_shift_x, frame_shift_y, frame_rotation = (_frame_value(value, video_frame_num) for value in (zoom_scale, shift_x, shift_y, rotation))
+            if latent_motion:
+                eng.warp_latent(frame_zoom_scale, frame_shift_x, frame_shift_y, frame_rotation)
+            elif frame_zoom_scale != 1.0 or frame_shift_x or frame_shift_y or frame_rotation:
+                with torch.no_grad():
+                    new_image = VF.affine_transform(eng.output_tensor, frame_zoom_scale, frame_shift_x, frame_shift_y, frame_rotation)
+                    # Re-encode and use this as the new initial image for the next iteration
+                    eng.convert_tensor_to_init_image(new_image)
                 eng.configure_optimizer()
 
             if verbose:
                 # display some statistics about how the GAN training is going whever we save an interim image
                 losses_str = ', '.join(f'{loss.item():7.3f}' for loss in lossAll)
-                tqdm.write(f'iteration:{iteration_num:6d}\tvideo frame: {video_frame_num:6d}\tloss sum: {sum(lossAll).item():7.3f}\tloss for each prompt:{losses_str}')
+                tqdm.write(f'iteration:{iteration_num:6d}\tvideo frame: {video_frame_num:6d}\tloss sum: {sum(lossAll).item():7.3f}\tloss for each prompt:{losses_str}{_quantizer_stats(eng)}')
 
             # metadata to save to PNG file as data chunks
             img_info =  [('text_prompts',text_prompts),
                 ('image_prompts',image_prompts),
                 ('noise_prompts',noise_prompts),
                 ('iterations',iterations_per_frame),
+                ('iterations_used',iterations_used),
                 ('init_image',video_frame_num),
                 ('cut_method',eng_config.cut_method),
                 ('seed',eng.conf.seed),
-                ('zoom_scale',zoom_scale),
-                ('shift_x',shift_x),
-                ('shift_y',shift_y),
+                ('zoom_scale',frame_zoom_scale),
+                ('shift_x',frame_shift_x),
+                ('shift_y',frame_shift_y),
+                ('rotation',frame_rotation),
+                ('latent_motion',latent_motion),
                 ('z_smoother',z_smoother),
                 ('z_smoother_buffer_len',z_smoother_buffer_len),
                 ('z_smoother_alpha',z_smoother_alpha)]
@@ -413,15 +617,32 @@ def video_frames(num_video_frames,
             filepath_to_save = os.path.join(generated_video_frames_path,f'frame_{video_frame_num:012d}.jpg')
             if z_smoother:
                 smoothed_z.append(eng._z.clone())
-                output_tensor = eng.synth(smoothed_z._mean())
-                Engine.save_tensor_as_image(output_tensor,filepath_to_save,img_info)
+                with torch.no_grad():
+                    output_tensor = eng.synth(smoothed_z._mean())
+                Engine.save_tensor_as_image(output_tensor,filepath_to_save,img_info,writer)
             else:
-                eng.save_current_output(filepath_to_save,img_info)
+                eng.save_current_output(filepath_to_save,img_info,writer=writer)
+
+            if checkpoint_every and video_frame_num % checkpoint_every == 0:
+                # the checkpoint marks this frame as complete, so it must be on disk first
+                writer.flush()
+                checkpoint.save_checkpoint(checkpoint_path, {'settings': run_settings,
+                    'seed': eng.conf.seed,
+                    'video_frame_num': video_frame_num,
+                    'prompt_number': current_prompt_number,
+                    'frame_iterations': frame_iterations,
+                    'engine': eng.state_dict(),
+                    'z_smoother': smoothed_z.state_dict() if z_smoother else None})
 
     except KeyboardInterrupt:
         pass
+    finally:
+        writer.close()
+    if verbose and eng.stage_timings:
+        tqdm.write(eng.stage_timings.summary())
     # metadata to return so that it can be saved to the video file using e.g. ffmpeg.
     config_info=f'iterations: {iterations_per_frame}, '\
+            f'average iterations used per frame: {_average(frame_iterations):.1f}, '\
             f'image_prompts: {image_prompts}, '\
             f'noise_prompts: {noise_prompts}, '\
             f'init_weight_method: {eng_config.init_image_method}, '\
@@ -432,12 +653,28 @@ def video_frames(num_video_frames,
             f'zoom_scale {zoom_scale}, '\
             f'shift_x {shift_x}, '\
             f'shift_y {shift_y}, '\
+            f'rotation {rotation}, '\
+            f'latent_motion {latent_motion}, '\
             f'z_smoother {z_smoother}, '\
             f'z_smoother_buffer_len {z_smoother_buffer_len}, '\
             f'z_smoother_alpha {z_smoother_alpha}'
     return config_info
 
 
+def _frame_value(value, video_frame_num):
+    # video_frames parameters may be a constant, or a function of the video frame number
+    return value(video_frame_num) if callable(value) else value
+
+
+def _average(values):
+    return sum(values) / len(values) if values else 0.0
+
+def _quantizer_stats(eng):
+    # verbose diagnostics for approximate vector quantization, empty when the exact search is used
+    if not eng.conf.quantize_approximate:
+        return ''
+    return f'\tcode disagreement with exact search: {eng.quantizer_disagreement_rate():6.1%}'
+
 def _filename_to_jpg(file_path):
     dir = os.path.dirname(file_path)
     filename_without_path = os.path.basename(file_path)
@@ -461,6 +698,11 @@ def style_transfer(video_frames,
     z_smoother=False,
     z_smoother_buffer_len=3,
     z_smoother_alpha=0.7,
+    early_stopping=None,
+    checkpoint_every=None,
+    resume=False,
+    init_image_filename='init_image.jpg',
+    video_writer=None,
     verbose=False,
     leave_progress_bar = True):
     """Apply a style to existing video frames using VQGAN+CLIP.
@@ -470,7 +712,7 @@ def style_transfer(video_frames,
     Set current_source_frame_prompt_weight >0 to have the generated content CLIP-match the source image.
 
     Args:
-    * video_frames (list of str) : List of paths to the video frames that will be restyled.
+    * video_frames (list of str or video_tools.VideoFrameSource) : List of paths to the video frames that will be restyled, or a VideoFrameSource that decodes the frames from a video as they are needed, without extracting them to disk first. Frames from a VideoFrameSource are saved as frame_000000000001.jpg, frame_000000000002.jpg, etc.
     * eng_config (VQGAN_CLIP_Config, optional): An instance of VQGAN_CLIP_Config with attributes customized for your use. See the documentation for VQGAN_CLIP_Config().
     * text_prompts (str, optional) : Text that will be turned into a prompt via CLIP. Default = []  
     * image_prompts (str, optional) : Path to image that will be turned into a prompt via CLIP. Default = []
@@ -484,6 +726,11 @@ def style_transfer(video_frames,
     * z_smoother (boolean, optional) : If true, smooth the latent vectors (z) used for image generation by combining multiple z vectors through an exponentially weighted moving average (EWMA). Defaults to False.
     * z_smoother_buffer_len (int, optional) : How many images' latent vectors should be combined in the smoothing algorithm. Bigger numbers will be smoother, and have more blurred motion. Must be an odd number. Defaults to 3.
     * z_smoother_alpha (float, optional) : When combining multiple latent vectors for smoothing, this sets how important the "keyframe" z is. As frames move further from the keyframe, their weight drops by (1-z_smoother_alpha) each frame. Bigger numbers apply more smoothing. Defaults to 0.6.
+    * early_stopping (EarlyStopping, optional) : Stop training each frame before iterations_per_frame once the loss stops improving, as decided by this EarlyStopping instance. Its min_iterations, window and check_every are scaled down for each frame if they don't fit in iterations_per_frame (see EarlyStopping.reset()). The number of iterations used is saved in the metadata of each frame. Defaults to None.
+    * checkpoint_every (int, optional) : If set, the state of the run is saved to checkpoint.pt in generated_video_frames_path every checkpoint_every video frames, so that the run can be resumed if it is interrupted. Defaults to None.
+    * resume (boolean, optional) : If true, and generated_video_frames_path has a checkpoint saved by an earlier run with checkpoint_every, continue that run after the last frame it checkpointed, without generating the init image again. The frames are the same as if the run had not been interrupted. The prompts and other settings must be the same as the earlier run. If there is no checkpoint, a new run is started. Defaults to False.
+    * init_image_filename (str, optional) : Location to save the image generated from the first source frame, which is used to start the video. When video_frames is a VideoFrameSource, the first source frame is also saved next to it, as init_image_source_frame.png for the default init_image_filename. Default = 'init_image.jpg'
+    * video_writer (video_tools.FFmpegVideoWriter, optional) : Encode the frames to a video as they are generated, instead of saving them as images to generated_video_frames_path (unless the writer was created with save_stills=True). The writer is closed, finishing the video, when the last frame has been generated. Can't be used with resume. Default = None
     * leave_progress_bar (boolean, optional) : When False, the tqdm progress bar will disappear when the work is completed. Useful for nested loops.
 """
     if text_prompts not in [[], None] and not isinstance(text_prompts, str):
@@ -494,8 +741,31 @@ def style_transfer(video_frames,
         raise ValueError('noise_prompts must be a string')
     if text_prompts in [[], None] and image_prompts in [[], None] and noise_prompts in [[], None]:
         raise ValueError('No valid prompts were provided')
-    if not isinstance(video_frames,list) or not os.path.isfile(f'{video_frames[0]}'):
-        raise ValueError(f'video_frames must be a list of paths to files.')
+    if not isinstance(video_frames, VideoFrameSource) and (not isinstance(video_frames,list) or not os.path.isfile(f'{video_frames[0]}')):
+        raise ValueError(f'video_frames must be a list of paths to files, or a VideoFrameSource.')
+    if early_stopping is not None and not isinstance(early_stopping, EarlyStopping):
+        raise ValueError('early_stopping must be an EarlyStopping instance.')
+    if checkpoint_every not in [[], None] and (not isinstance(checkpoint_every, int) or checkpoint_every < 1):
+        raise ValueError('checkpoint_every must be a positive int.')
+    if video_writer is not None and resume:
+        raise ValueError('A video_writer can\'t be used with resume, because the frames before the checkpoint would be missing from the video.')
+
+    checkpoint_path = os.path.join(generated_video_frames_path, 'checkpoint.pt')
+    run_settings = {'function': 'style_transfer',
+        'text_prompts': text_prompts,
+        'image_prompts': image_prompts,
+        'noise_prompts': noise_prompts,
+        'change_prompts_on_frame': change_prompts_on_frame,
+        'iterations_per_frame': iterations_per_frame,
+        'iterations_for_first_frame': iterations_for_first_frame,
+        'current_source_frame_image_weight': current_source_frame_image_weight,
+        'current_source_frame_prompt_weight': current_source_frame_prompt_weight,
+        'z_smoother': z_smoother,
+        'z_smoother_buffer_len': z_smoother_buffer_len,
+        'z_smoother_alpha': z_smoother_alpha}
+    saved = checkpoint.load_checkpoint(checkpoint_path) if resume else None
+    if saved:
+        checkpoint.check_settings(saved, run_settings)
 
     eng_config.init_weight = current_source_frame_image_weight
 
@@ -503,24 +773,35 @@ def style_transfer(video_frames,
     if not iterations_for_first_frame:
         iterations_for_first_frame = iterations_per_frame
 
-    output_size_X, output_size_Y = VF.filesize_matching_aspect_ratio(video_frames[0], eng_config.output_image_size[0], eng_config.output_image_size[1])
+    if isinstance(video_frames, VideoFrameSource):
+        # the init image is generated from the first source frame, so it is the only frame that needs to be saved as a file
+        first_video_frame = os.path.splitext(init_image_filename)[0] + '_source_frame.png'
+        video_frames.first_frame().save(first_video_frame)
+    else:
+        first_video_frame = video_frames[0]
+    output_size_X, output_size_Y = VF.filesize_matching_aspect_ratio(first_video_frame, eng_config.output_image_size[0], eng_config.output_image_size[1])
     eng_config.output_image_size = [output_size_X, output_size_Y]
 
     # Let's generate a single image to initialize the video. Otherwise it takes a few frames for the new video to stabilize on the generated imagery.
-    init_image = 'init_image.jpg'
+    init_image = init_image_filename
     eng_config_init_img = eng_config
     eng_config_init_img.init_image_method = 'original'
-    image(output_filename=init_image,
-        eng_config=eng_config_init_img,
-        text_prompts=text_prompts,
-        image_prompts = image_prompts,
-        noise_prompts = noise_prompts,
-        init_image = video_frames[0],
-        init_weight=current_source_frame_image_weight,
-        iterations = iterations_for_first_frame,
-        save_every = None,
-        verbose = False,
-        leave_progress_bar = False)
+    if saved:
+        # the run being resumed already generated the init image. Configure the engine the same way image() would have.
+        eng_config.init_image = first_video_frame
+        eng_config.seed = saved['seed']
+    else:
+        image(output_filename=init_image,
+            eng_config=eng_config_init_img,
+            text_prompts=text_prompts,
+            image_prompts = image_prompts,
+            noise_prompts = noise_prompts,
+            init_image = first_video_frame,
+            init_weight=current_source_frame_image_weight,
+            iterations = iterations_for_first_frame,
+            save_every = None,
+            verbose = False,
+            leave_progress_bar = False)
 
     parsed_text_prompts, parsed_image_prompts, parsed_noise_prompts = VF.parse_all_prompts(text_prompts, image_prompts, noise_prompts)
 
@@ -532,10 +813,10 @@ def style_transfer(video_frames,
     # if the location for the generated video frames doesn't exist, create it
     if not os.path.exists(generated_video_frames_path):
         os.mkdir(generated_video_frames_path)
-    else:
+    elif not saved:
         VF.delete_files(generated_video_frames_path)
 
-    output_size_X, output_size_Y = VF.filesize_matching_aspect_ratio(video_frames[0], eng_config.output_image_size[0], eng_config.output_image_size[1])
+    output_size_X, output_size_Y = VF.filesize_matching_aspect_ratio(first_video_frame, eng_config.output_image_size[0], eng_config.output_image_size[1])
     eng_config.output_image_size = [output_size_X, output_size_Y]
     # alternate_img_target is required for restyling video. alternate_img_target_decay is experimental.
     if eng_config.init_image_method not in ['alternate_img_target_decay', 'alternate_img_target']:
@@ -548,29 +829,36 @@ def style_transfer(video_frames,
             eng.initialize_VQGAN_CLIP()
 
     if z_smoother:
-        # Populate the z smoother with the initial image
-        init_image_pil = Image.open(init_image).convert('RGB').resize([output_size_X,output_size_Y], resample=Image.LANCZOS)
-        # init_img_z = eng.pil_image_to_latent_vector(init_image_pil)
         smoothed_z = Z_Smoother(buffer_len=z_smoother_buffer_len, alpha=z_smoother_alpha)
+        if saved:
+            smoothed_z.load_state_dict({'data': [z.to(eng._device) for z in saved['z_smoother']['data']]})
 
+    # frames are encoded and written to disk, or to the video, in the background while the next frame is trained
+    writer = video_writer if video_writer is not None else AsyncImageWriter()
     # generate images
-    video_frame_num = 1
-    current_prompt_number = 0
+    video_frame_num = saved['video_frame_num'] + 1 if saved else 1
+    current_prompt_number = saved['prompt_number'] if saved else 0
+    frame_iterations = saved['frame_iterations'] if saved else []
+    source_frames = _source_frames(video_frames, [output_size_X, output_size_Y])
     try:
-        # To generate the first frame of video, either use the init_image argument, or the first frame of source video.
-        pil_image_previous_generated_frame = Image.open(init_image).convert('RGB').resize([output_size_X,output_size_Y], resample=Image.LANCZOS)
-        eng.convert_image_to_init_image(pil_image_previous_generated_frame)
-        eng.configure_optimizer()
-        video_frames_loop = tqdm(video_frames,unit='image',desc='style transfer',leave=leave_progress_bar)
-        for video_frame in video_frames_loop:
-            filename_to_save = os.path.basename(os.path.splitext(video_frame)[0]) + '.jpg'
+        if saved:
+            eng.configure_optimizer()
+            eng.load_state_dict(saved['engine'])
+        else:
+            # To generate the first frame of video, either use the init_image argument, or the first frame of source video.
+            pil_image_previous_generated_frame = Image.open(init_image).convert('RGB').resize([output_size_X,output_size_Y], resample=Image.LANCZOS)
+            eng.convert_image_to_init_image(pil_image_previous_generated_frame)
+            eng.configure_optimizer()
+        total_frames = len(video_frames) if not isinstance(video_frames, VideoFrameSource) or video_frames.end_frame is not None else None
+        video_frames_loop = tqdm(itertools.islice(source_frames, video_frame_num-1, None),unit='image',desc='style transfer',initial=video_frame_num-1,total=total_frames,leave=leave_progress_bar)
+        for frame_name, video_frame, pil_image_new_frame in video_frames_loop:
+            filename_to_save = frame_name + '.jpg'
             filepath_to_save = os.path.join(generated_video_frames_path,filename_to_save)
 
             # INIT IMAGE
             # Alternate aglorithm - init image is unchanged from the previous output. We are not resetting the tensor gradient.
             # alternate_image_target is the new source frame of video. Apply a loss in Engine using conf.init_image_method == 'alternate_img_target'
             # The previous output will be trained to change toward the new source frame.
-            pil_image_new_frame = Image.open(video_frame).convert('RGB').resize([output_size_X,output_size_Y], resample=Image.LANCZOS)
             eng.set_alternate_image_target(pil_image_new_frame)
 
             # Optionally use the current source video frame, and the previous generate frames, as input prompts
@@ -584,14 +872,21 @@ def style_transfer(video_frames,
                 eng.encode_and_append_pil_image(pil_image_new_frame, weight=current_source_frame_prompt_weight)
 
             # Generate a new image
+            iterations_used = 0
+            if early_stopping:
+                early_stopping.reset(iterations_per_frame)
             for iteration_num in tqdm(range(1,iterations_per_frame+1),unit='iteration',desc='generating frame',leave=False):
                 #perform iterations of train()
                 lossAll = eng.train(iteration_num)          
+                iterations_used = iteration_num
+                if early_stopping and early_stopping.update(lossAll):
+                    break
+            frame_iterations.append(iterations_used)
 
             if verbose:
                 # display some statistics about how the GAN training is going whever we save an image
                 losses_str = ', '.join(f'{loss.item():7.3f}' for loss in lossAll)
-                tqdm.write(f'iteration:{iteration_num:6d}\tvideo frame: {video_frame_num:6d}\tloss sum: {sum(lossAll).item():7.3f}\tloss for each prompt:{losses_str}')
+                tqdm.write(f'iteration:{iteration_num:6d}\tvideo frame: {video_frame_num:6d}\tloss sum: {sum(lossAll).item():7.3f}\tloss for each prompt:{losses_str}{_quantizer_stats(eng)}')
 
             # save a frame of video
             # metadata to save to PNG file as data chunks
@@ -600,6 +895,7 @@ def style_transfer(video_frames,
                 ('noise_prompts',noise_prompts),
                 ('iterations_per_frame',iterations_per_frame),
                 ('iterations_for_first_frame',iterations_for_first_frame),
+                ('iterations_used',iterations_used),
                 ('cut_method',eng_config.cut_method),
                 ('init_image',video_frame),
                 ('seed',eng.conf.seed),
@@ -610,16 +906,35 @@ def style_transfer(video_frames,
                 ('current_source_frame_image_weight',f'{current_source_frame_image_weight:2.2f}')]
             if z_smoother:
                 smoothed_z.append(eng._z.clone())
-                output_tensor = eng.synth(smoothed_z._mid_ewma())
-                Engine.save_tensor_as_image(output_tensor,filepath_to_save,img_info)
+                with torch.no_grad():
+                    output_tensor = eng.synth(smoothed_z._mid_ewma())
+                Engine.save_tensor_as_image(output_tensor,filepath_to_save,img_info,writer)
             else:
-                eng.save_current_output(filepath_to_save,img_info)
+                eng.save_current_output(filepath_to_save,img_info,writer=writer)
             last_video_frame_generated = filepath_to_save
+
+            if checkpoint_every and video_frame_num % checkpoint_every == 0:
+                # the checkpoint marks this frame as complete, so it must be on disk first
+                writer.flush()
+                checkpoint.save_checkpoint(checkpoint_path, {'settings': run_settings,
+                    'seed': eng.conf.seed,
+                    'video_frame_num': video_frame_num,
+                    'prompt_number': current_prompt_number,
+                    'frame_iterations': frame_iterations,
+                    'engine': eng.state_dict(),
+                    'z_smoother': smoothed_z.state_dict() if z_smoother else None})
             video_frame_num += 1
     except KeyboardInterrupt:
         pass
+    finally:
+        # stops the ffmpeg process of a VideoFrameSource that wasn't read to the end
+        source_frames.close()
+        writer.close()
 
+    if verbose and eng.stage_timings:
+        tqdm.write(eng.stage_timings.summary())
     config_info=f'iterations_per_frame: {iterations_per_frame}, '\
+            f'average iterations used per frame: {_average(frame_iterations):.1f}, '\
             f'image_prompts: {image_prompts}, '\
             f'noise_prompts: {noise_prompts}, '\
             f'init_weight {eng_config.init_weight:1.2f}, '\
@@ -633,3 +948,179 @@ def style_transfer(video_frames,
             f'seed {eng.conf.seed}'
 
     return config_info
+
+
+def _source_frames(video_frames, size):
+    # yields the name to save each frame's output under, a description of the source frame for the metadata, and the source frame resized to size
+    if isinstance(video_frames, VideoFrameSource):
+        # scale the frames while ffmpeg decodes them
+        frames = iter(video_frames.resized(size))
+        try:
+            for frame_num, frame in enumerate(frames, start=1):
+                # describe the frame by its index in the video, at the source's extraction_framerate
+                source_frame_index = video_frames.start_frame + (frame_num - 1) * video_frames.stride
+                yield f'frame_{frame_num:012d}', f'{video_frames.input_video_path} frame {source_frame_index}', frame
+        finally:
+            # stop ffmpeg as soon as this generator is closed, rather than when the frames are garbage collected
+            frames.close()
+    else:
+        for video_frame in video_frames:
+            yield os.path.basename(os.path.splitext(video_frame)[0]), video_frame, Image.open(video_frame).convert('RGB').resize(size, resample=Image.LANCZOS)
+
+
+def segmented_style_transfer(video_frames,
+    eng_config=VQGAN_CLIP_Config(),
+    text_prompts = 'Covered in spiders | Surreal:0.5',
+    image_prompts = [],
+    noise_prompts = [],
+    iterations_per_frame = 15,
+    iterations_for_first_frame = 15,
+    current_source_frame_image_weight = 2.0,
+    change_prompts_on_frame = None,
+    generated_video_frames_path='./video_frames',
+    current_source_frame_prompt_weight=0.0,
+    z_smoother=False,
+    z_smoother_buffer_len=3,
+    z_smoother_alpha=0.7,
+    early_stopping=None,
+    num_workers=2,
+    segment_length=None,
+    overlap=4,
+    scene_cut_threshold=0.25,
+    leave_progress_bar = True):
+    """Apply a style to existing video frames using VQGAN+CLIP, like style_transfer(), with several worker processes generating parts of the video at once.
+    The video is split into segments at scene cuts, and scenes longer than segment_length are split again. Each segment is restyled by style_transfer() in a worker process.
+    Within a scene, each segment also restyles the last overlap frames of the segment before it, and the two are cross-faded over those frames to hide the seam.
+    The models are loaded once, and shared by every worker process.
+
+    Args:
+    * video_frames (list of str) : List of paths to the video frames that will be restyled.
+    * eng_config (VQGAN_CLIP_Config, optional): An instance of VQGAN_CLIP_Config with attributes customized for your use. See the documentation for VQGAN_CLIP_Config().
+    * text_prompts, image_prompts, noise_prompts, iterations_per_frame, iterations_for_first_frame, current_source_frame_image_weight, change_prompts_on_frame, current_source_frame_prompt_weight, z_smoother, z_smoother_buffer_len, z_smoother_alpha, early_stopping : As for style_transfer().
+    * generated_video_frames_path (str, optional) : Path where still images should be saved as they are generated before being combined into a video. Defaults to './video_frames'.
+    * num_workers (int, optional) : Number of worker processes. On the CPU, the threads used by torch are divided between them. Default = 2
+    * segment_length (int, optional) : Maximum number of frames in a segment, not counting the overlap. If None, the frames are divided evenly between the workers. Default = None
+    * overlap (int, optional) : Number of frames restyled by both of two consecutive segments within a scene, and cross-faded. Default = 4
+    * scene_cut_threshold (float, optional) : Mean difference between consecutive source frames, from 0 to 1, above which a scene cut is detected. Segments always end at a scene cut, and are not cross-faded across it. If None, scene cuts are not detected. Default = 0.25
+    * leave_progress_bar (boolean, optional) : When False, the tqdm progress bar will disappear when the work is completed. Useful for nested loops.
+    """
+    if text_prompts not in [[], None] and not isinstance(text_prompts, str):
+        raise ValueError('text_prompts must be a string')
+    if image_prompts not in [[], None] and not isinstance(image_prompts, str):
+        raise ValueError('image_prompts must be a string')
+    if noise_prompts not in [[], None] and not isinstance(noise_prompts, str):
+        raise ValueError('noise_prompts must be a string')
+    if text_prompts in [[], None] and image_prompts in [[], None] and noise_prompts in [[], None]:
+        raise ValueError('No valid prompts were provided')
+    if not isinstance(video_frames,list) or not os.path.isfile(f'{video_frames[0]}'):
+        raise ValueError(f'video_frames must be a list of paths to files.')
+    if not isinstance(num_workers, int) or num_workers < 1:
+        raise ValueError('num_workers must be a positive int.')
+    if not isinstance(overlap, int) or overlap < 0:
+        raise ValueError('overlap must be an int of 0 or more.')
+
+    # every segment uses the same seed
+    if not eng_config.seed:
+        eng_config.seed = torch.seed()
+
+    cuts = VF.detect_scene_cuts(video_frames, scene_cut_threshold) if scene_cut_threshold is not None else []
+    if not segment_length:
+        segment_length = -(-len(video_frames) // num_workers)
+    segments = VF.split_segments(len(video_frames), segment_length, overlap, cuts)
+
+    # if the location for the generated video frames doesn't exist, create it
+    if not os.path.exists(generated_video_frames_path):
+        os.mkdir(generated_video_frames_path)
+    else:
+        VF.delete_files(generated_video_frames_path)
+    work_path = os.path.join(generated_video_frames_path, '.segments')
+    os.makedirs(work_path, exist_ok=True)
+
+    # Load the models once. They are passed to the worker processes through shared memory, instead of each worker loading its own copy.
+    models = model_registry.get(eng_config)
+    if torch.device(eng_config.cuda_device).type == 'cpu':
+        models.vqgan.share_memory()
+        models.perceptor.share_memory()
+    num_threads = max(1, torch.get_num_threads() // num_workers)
+
+    tasks = []
+    for segment_num, (start, end, shared) in enumerate(segments):
+        # each segment starts with the prompts that an uninterrupted style_transfer() would be using at its first frame
+        changes_before = sum(1 for frame_num in change_prompts_on_frame or [] if frame_num <= start)
+        segment_changes = [frame_num - start for frame_num in change_prompts_on_frame or [] if frame_num > start]
+        segment_path = os.path.join(work_path, f'segment_{segment_num:05d}')
+        tasks.append((video_frames[start:end], segment_path, eng_config, dict(
+            text_prompts=_advance_story(text_prompts, changes_before),
+            image_prompts=_advance_story(image_prompts, changes_before),
+            noise_prompts=_advance_story(noise_prompts, changes_before),
+            change_prompts_on_frame=segment_changes or None,
+            iterations_per_frame=iterations_per_frame,
+            iterations_for_first_frame=iterations_for_first_frame,
+            current_source_frame_image_weight=current_source_frame_image_weight,
+            current_source_frame_prompt_weight=current_source_frame_prompt_weight,
+            z_smoother=z_smoother,
+            z_smoother_buffer_len=z_smoother_buffer_len,
+            z_smoother_alpha=z_smoother_alpha,
+            early_stopping=early_stopping,
+            generated_video_frames_path=segment_path,
+            init_image_filename=segment_path + '_init.jpg')))
+
+    context = torch.multiprocessing.get_context('spawn')
+    try:
+        with context.Pool(min(num_workers, len(tasks)), initializer=_init_segment_worker, initargs=(eng_config, models.vqgan, models.perceptor, num_threads)) as pool:
+            # start the longest segments first, so that no worker is left restyling a long segment on its own at the end
+            longest_first = sorted(tasks, key=lambda task: -len(task[0]))
+            for _ in tqdm(pool.imap_unordered(_restyle_segment, longest_first),total=len(tasks),unit='segment',desc='style transfer segments',leave=leave_progress_bar):
+                pass
+        _join_segments(video_frames, segments, [task[1] for task in tasks], generated_video_frames_path)
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+
+    config_info=f'iterations_per_frame: {iterations_per_frame}, '\
+            f'segments: {len(segments)}, '\
+            f'scene cuts: {len(cuts)}, '\
+            f'overlap: {overlap}, '\
+            f'image_prompts: {image_prompts}, '\
+            f'noise_prompts: {noise_prompts}, '\
+            f'init_weight {eng_config.init_weight:1.2f}, '\
+            f'current_source_frame_prompt_weight {current_source_frame_prompt_weight:2.2f}, '\
+            f'current_source_frame_image_weight {current_source_frame_image_weight:2.2f}, '\
+            f'cut_method {eng_config.cut_method}, '\
+            f'z_smoother {z_smoother:2.2f}, '\
+            f'z_smoother_buffer_len {z_smoother_buffer_len:2.2f}, '\
+            f'z_smoother_alpha {z_smoother_alpha:2.2f}, '\
+            f'seed {eng_config.seed}'
+    return config_info
+
+
+def _advance_story(prompts, changes):
+    # the story prompts (separated by ^) that are current after changes prompt changes. The last prompt is kept once the story runs out.
+    if prompts in [[], None]:
+        return prompts
+    story = prompts.split('^')
+    return '^'.join(story[min(changes, len(story) - 1):])
+
+def _init_segment_worker(eng_config, vqgan, perceptor, num_threads):
+    # runs once in each segmented_style_transfer worker process. The models arrive in shared memory, and are registered so that every Engine in the process uses them.
+    torch.set_num_threads(num_threads)
+    model_registry.put(eng_config, vqgan, perceptor)
+
+def _restyle_segment(task):
+    segment_frames, segment_path, eng_config, kwargs = task
+    style_transfer(segment_frames, eng_config=eng_config, leave_progress_bar=False, **kwargs)
+
+def _join_segments(video_frames, segments, segment_paths, generated_video_frames_path):
+    # move the restyled frames of each segment to generated_video_frames_path, cross-fading the frames shared with the previous segment
+    for (start, end, shared), segment_path in zip(segments, segment_paths):
+        for frame_index in range(start, end):
+            filename = os.path.basename(os.path.splitext(video_frames[frame_index])[0]) + '.jpg'
+            segment_file = os.path.join(segment_path, filename)
+            output_file = os.path.join(generated_video_frames_path, filename)
+            if frame_index - start < shared:
+                weight = (frame_index - start + 1) / (shared + 1)
+                with Image.open(output_file) as previous, Image.open(segment_file) as current:
+                    blended = Image.blend(previous.convert('RGB'), current.convert('RGB'), weight)
+                    exif = current.info.get('exif')
+                blended.save(output_file, quality=75, **({'exif': exif} if exif else {}))
+            else:
+                os.replace(segment_file, output_file)
@@ -0,0 +1,144 @@
+# Saves generated images on background threads. Converting an output tensor to an image, encoding it as PNG or JPEG, and writing it
+# to disk takes long enough to stall training when it is done once per video frame, so video generation hands each frame to an
+# AsyncImageWriter and carries on training the next frame.
+
+from . import _functional as VF
+import atexit
+import concurrent.futures
+import os
+import threading
+import warnings
+import weakref
+import torch
+from torchvision.transforms import functional as TF
+
+__all__ = ["write_image", "AsyncImageWriter"]
+
+
+def write_image(image_tensor, save_filename, img_metadata=None):
+    """Save an image tensor to save_filename. The format is chosen from the file extension. Metadata is saved as PNG data chunks, or as JPEG EXIF data.
+
+    Args:
+        image_tensor (tensor): Image with values between 0 and 1, [1, 3, H, W].
+        save_filename (str): Path of the file to write. e.g. 'output.png' or 'outputs/my_file.jpg'
+        img_metadata (list of tuple, optional): (name, value) pairs to save as metadata. Defaults to None.
+    """
+    with torch.inference_mode():
+        try:
+            if os.path.splitext(save_filename)[1].lower() == '.png':
+                TF.to_pil_image(image_tensor[0].cpu()).save(save_filename, pnginfo=VF.png_info_chunks(img_metadata))
+            elif os.path.splitext(save_filename)[1].lower() == '.jpg':
+                TF.to_pil_image(image_tensor[0].cpu()).save(save_filename, quality=75, exif=VF.info_to_jpg_exif(img_metadata))
+            else:
+                # unknown file extension so we can't include metadata, but if torch supports it try to save in that format.
+                TF.to_pil_image(image_tensor[0].cpu()).save(save_filename)
+        except:
+            raise NameError('Unable to save image. Unknown file format?')
+
+
+class AsyncImageWriter:
+    """Write images with write_image() on a pool of background threads.
+
+    submit() takes a CPU copy of the image tensor and returns immediately, unless max_pending images are already waiting to be written, in which case
+    it waits for one of them to finish. This bounds the memory held by queued images. If a write fails, the error is raised by the next call to
+    submit(), flush() or close(). Writes that are still pending when the Python process exits are completed before it exits.
+
+    Args:
+        max_pending (int, optional): Maximum number of images queued or being written at once. Defaults to 8.
+        num_threads (int, optional): Number of writer threads. Defaults to 2.
+    """
+    def __init__(self, max_pending=8, num_threads=2):
+        if not isinstance(max_pending, int) or max_pending < 1:
+            raise ValueError('max_pending must be a positive int.')
+        if not isinstance(num_threads, int) or num_threads < 1:
+            raise ValueError('num_threads must be a positive int.')
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='image_writer')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending = set()
+        self._errors = []
+        self._lock = threading.Lock()
+        self._closed = False
+        _open_writers.add(self)
+
+    def submit(self, image_tensor, save_filename, img_metadata=None):
+        """Queue an image to be saved to save_filename, as write_image() would.
+
+        Args:
+            image_tensor (tensor): Image with values between 0 and 1, [1, 3, H, W]. It may be on any device, and may be changed as soon as submit() returns.
+            save_filename (str): Path of the file to write.
+            img_metadata (list of tuple, optional): (name, value) pairs to save as metadata. Defaults to None.
+
+        Returns:
+            concurrent.futures.Future: Completes when the file has been written.
+        """
+        if self._closed:
+            raise ValueError('AsyncImageWriter is closed.')
+        self._raise_errors()
+        snapshot = image_tensor.detach().to('cpu', copy=True)
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(write_image, snapshot, save_filename, img_metadata)
+        except:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+            if future.exception() is not None:
+                self._errors.append(future.exception())
+        self._slots.release()
+
+    def _raise_errors(self):
+        with self._lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            raise errors[0]
+
+    def flush(self):
+        """Wait until every submitted image has been written. Raises the first error from any write that failed.
+        """
+        with self._lock:
+            pending = list(self._pending)
+        concurrent.futures.wait(pending)
+        self._raise_errors()
+
+    def close(self):
+        """Flush the writer and stop its threads. Raises the first error from any write that failed.
+        """
+        if self._closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self._closed = True
+            self._executor.shutdown(wait=True)
+            _open_writers.discard(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # don't hide the exception that is already being raised behind a failed write
+            try:
+                self.close()
+            except Exception:
+                pass
+
+
+_open_writers = weakref.WeakSet()
+
+@atexit.register
+def _close_open_writers():
+    for writer in list(_open_writers):
+        try:
+            writer.close()
+        except Exception as error:
+            warnings.warn(f'An image could not be saved: {error}')
@@ -0,0 +1,208 @@
+# A process-wide registry of loaded VQGAN and CLIP models. Loading model weights is slow, and every call to a
+# generate.* function creates a new Engine, so engines get their models from here instead of reloading them.
+# Models are shared between every Engine that uses them, and must be treated as read-only.
+
+from . import _functional as VF
+from .download import load_file_from_url
+import torch
+import collections
+import hashlib
+import threading
+
+__all__ = ["LoadedModels", "ModelRegistry", "get", "preload", "evict", "put", "set_max_entries"]
+
+
+class LoadedModels:
+    """A VQGAN model and a CLIP perceptor that have been loaded onto a device, and the vector quantizers built from the VQGAN codebook.
+
+    Args:
+        vqgan (torch.nn.Module): VQGAN model, in eval mode with requires_grad disabled.
+        perceptor (torch.nn.Module): CLIP model, in eval mode with requires_grad disabled.
+    """
+    def __init__(self, vqgan, perceptor):
+        self.vqgan = vqgan
+        self.perceptor = perceptor
+        self._quantizers = {}
+        self._decode_memory_per_latent = None
+        self._perceptor_fingerprint = None
+        self._lock = threading.Lock()
+
+    def quantizer(self, gumbel=False, chunk_size=None, approximate=False, num_probes=8):
+        """Return a VF.VectorQuantizer for the VQGAN codebook. Quantizers are built once per set of options, so the coarse index of the
+        approximate search is only built once per model.
+
+        Args:
+            gumbel (bool, optional): True if the VQGAN model is a GumbelVQ model. Defaults to False.
+            chunk_size (int, optional): See VF.VectorQuantizer. Defaults to None.
+            approximate (bool, optional): See VF.VectorQuantizer. Defaults to False.
+            num_probes (int, optional): See VF.VectorQuantizer. Defaults to 8.
+        """
+        key = (gumbel, chunk_size, approximate, num_probes)
+        with self._lock:
+            if key not in self._quantizers:
+                codebook = self.vqgan.quantize.embed.weight if gumbel else self.vqgan.quantize.embedding.weight
+                self._quantizers[key] = VF.VectorQuantizer(codebook, chunk_size=chunk_size, approximate=approximate, num_probes=num_probes)
+            return self._quantizers[key]
+
+    def decode_memory_per_latent(self):
+        """Return VF.decode_memory_per_latent() for the VQGAN model. It is only measured once per model.
+        """
+        with self._lock:
+            if self._decode_memory_per_latent is None:
+                self._decode_memory_per_latent = VF.decode_memory_per_latent(self.vqgan)
+            return self._decode_memory_per_latent
+
+    def perceptor_fingerprint(self):
+        """Return a hash of the weights of the CLIP perceptor. Cached CLIP embeddings are keyed by it, so that embeddings made by one
+        model are not returned for a different model registered under the same clip_model name. It is only computed once per model.
+
+        Returns:
+            str: Hex digest of the names, dtypes, shapes and values of the perceptor's parameters and buffers.
+        """
+        with self._lock:
+            if self._perceptor_fingerprint is None:
+                sha = hashlib.sha256()
+                for name, tensor in sorted(self.perceptor.state_dict().items()):
+                    sha.update(f'{name}{tensor.dtype}{tuple(tensor.shape)}'.encode('utf-8'))
+                    sha.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+                self._perceptor_fingerprint = sha.hexdigest()[:16]
+            return self._perceptor_fingerprint
+
+
+class ModelRegistry:
+    """Least recently used cache of loaded models, keyed by (vqgan_model_name, clip_model, device).
+
+    Args:
+        max_entries (int, optional): Maximum number of model pairs to keep loaded. When a new pair is loaded, the least recently used pair is
+            evicted. At least one pair is always kept. Engines that are still using an evicted pair keep working, and its memory is released
+            once they are deleted. Defaults to 1.
+    """
+    def __init__(self, max_entries=1):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def key(config):
+        """Registry key for the models used by a VQGAN_CLIP_Config.
+        """
+        return (config.vqgan_model_name, config.clip_model, str(torch.device(config.cuda_device)))
+
+    def get(self, config):
+        """Return the LoadedModels for a VQGAN_CLIP_Config, loading them if they are not already in the registry.
+
+        Args:
+            config (VQGAN_CLIP_Config): Configuration that selects the VQGAN model, CLIP model, and device.
+
+        Returns:
+            LoadedModels: The loaded models.
+        """
+        key = self.key(config)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            models = self._load(config)
+            self._insert(key, models)
+            return models
+
+    def preload(self, config):
+        """Load the models for a VQGAN_CLIP_Config ahead of time, so that the first Engine that uses them starts quickly.
+
+        Args:
+            config (VQGAN_CLIP_Config): Configuration that selects the VQGAN model, CLIP model, and device.
+        """
+        self.get(config)
+
+    def put(self, config, vqgan, perceptor):
+        """Register models that were loaded some other way, such as a fine-tuned VQGAN, under the key of a VQGAN_CLIP_Config.
+
+        Args:
+            config (VQGAN_CLIP_Config): Configuration whose vqgan_model_name, clip_model and cuda_device are used as the key.
+            vqgan (torch.nn.Module): VQGAN model. It is moved to the configured device and put in eval mode with requires_grad disabled.
+            perceptor (torch.nn.Module): CLIP model. It is moved to the configured device and put in eval mode with requires_grad disabled.
+        """
+        device = torch.device(config.cuda_device)
+        models = LoadedModels(vqgan.eval().requires_grad_(False).to(device), perceptor.eval().requires_grad_(False).to(device))
+        with self._lock:
+            self._entries.pop(self.key(config), None)
+            self._insert(self.key(config), models)
+
+    def evict(self, config=None):
+        """Remove models from the registry.
+
+        Args:
+            config (VQGAN_CLIP_Config, optional): Evict the models used by this configuration. If None, all models are evicted. Defaults to None.
+        """
+        with self._lock:
+            if config is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(self.key(config), None)
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def set_max_entries(self, max_entries):
+        """Change how many pairs of models are kept loaded, evicting the least recently used pairs if there are now too many.
+
+        Args:
+            max_entries (int): Maximum number of model pairs. At least one pair is always kept.
+        """
+        with self._lock:
+            self.max_entries = max_entries
+            self._trim()
+
+    def __contains__(self, config):
+        return self.key(config) in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _insert(self, key, models):
+        self._entries[key] = models
+        self._trim()
+
+    def _trim(self):
+        while len(self._entries) > max(self.max_entries, 1):
+            self._entries.popitem(last=False)
+
+    @staticmethod
+    def _load(config):
+        # This step is slow, and does not need to be done each time an image is generated.
+        device = torch.device(config.cuda_device)
+        model_yaml_path = load_file_from_url(config.vqgan_model_yaml_url, model_dir=config.model_dir, progress=True, file_name=config.vqgan_model_name+'.yaml')
+        model_ckpt_path = load_file_from_url(config.vqgan_model_ckpt_url, model_dir=config.model_dir, progress=True, file_name=config.vqgan_model_name+'.ckpt')
+        vqgan = VF.load_vqgan_model(model_yaml_path, model_ckpt_path).to(device)
+        jit = True if float(torch.__version__[:3]) < 1.8 else False
+        import clip
+        perceptor = clip.load(config.clip_model, jit=jit)[0].eval().requires_grad_(False).to(device)
+        return LoadedModels(vqgan, perceptor)
+
+
+# The registry shared by every Engine in this process
+default_registry = ModelRegistry()
+
+def get(config):
+    """Return the LoadedModels for a VQGAN_CLIP_Config from the default registry, loading them if needed. See ModelRegistry.get().
+    """
+    return default_registry.get(config)
+
+def preload(config):
+    """Load the models for a VQGAN_CLIP_Config into the default registry ahead of time. See ModelRegistry.preload().
+    """
+    default_registry.preload(config)
+
+def put(config, vqgan, perceptor):
+    """Register already-loaded models in the default registry. See ModelRegistry.put().
+    """
+    default_registry.put(config, vqgan, perceptor)
+
+def evict(config=None):
+    """Remove the models used by config from the default registry, or all models if config is None. See ModelRegistry.evict().
+    """
+    default_registry.evict(config)
+
+def set_max_entries(max_entries):
+    """Set how many pairs of VQGAN and CLIP models the default registry keeps loaded. See ModelRegistry.set_max_entries().
+    """
+    default_registry.set_max_entries(max_entries)
@@ -0,0 +1,130 @@
+# Measures where the time goes in Engine.train(). StageTimings accumulates the wall time of each stage of a training iteration, so a slow
+# run can be traced to the decoder, the cutouts, CLIP or the optimizer. ProfilerWindow records a torch.profiler trace of a range of
+# iterations, which can be opened in chrome://tracing or https://ui.perfetto.dev for the detail of every operation.
+
+import contextlib
+import time
+import torch
+
+__all__ = ["StageTimings", "ProfilerWindow"]
+
+
+class StageTimings:
+    """Wall time spent in each stage of Engine.train(), accumulated over iterations.
+
+    The stages are 'synth', 'cutouts', 'encode_image', 'prompt_losses', 'backward', 'optimizer_step' and 'clamp'. When config.compile is True,
+    the forward pass is a single compiled graph, and is timed as one 'forward' stage in place of the first four.
+
+    On CUDA devices the device is synchronized at the end of each stage, so that work queued on the GPU is counted against the stage that
+    queued it. This makes training a little slower while timing is enabled.
+
+    Args:
+        device (torch.device, optional): Device the stages run on. Defaults to None, which is treated as the CPU.
+    """
+    def __init__(self, device=None):
+        self._device = torch.device(device) if device is not None else None
+        self._synchronize = self._device is not None and self._device.type == 'cuda'
+        self.reset()
+
+    def reset(self):
+        """Forget all of the times recorded so far.
+        """
+        self.totals = {}
+        self.counts = {}
+        self.iterations = 0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager that adds the time spent inside it to stage name. The stage is also labelled in torch.profiler traces.
+
+        Args:
+            name (str): Name of the stage.
+        """
+        with torch.profiler.record_function(name):
+            start = time.perf_counter()
+            yield
+            if self._synchronize:
+                torch.cuda.synchronize(self._device)
+            self.totals[name] = self.totals.get(name, 0.0) + time.perf_counter() - start
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def mean(self, name):
+        """Average time spent in stage name per call, in seconds.
+
+        Args:
+            name (str): Name of the stage.
+
+        Returns:
+            float: Mean time in seconds, or 0.0 if the stage has not been timed.
+        """
+        return self.totals[name] / self.counts[name] if self.counts.get(name) else 0.0
+
+    def as_dict(self):
+        """Return the recorded times.
+
+        Returns:
+            dict: Maps each stage name to a dict with its 'total' and 'mean' time in seconds, and its 'count' of calls.
+        """
+        return {name: {'total': total, 'mean': self.mean(name), 'count': self.counts[name]} for name, total in self.totals.items()}
+
+    def summary(self):
+        """Return a table of the time spent in each stage, as a string for display.
+        """
+        total = sum(self.totals.values())
+        lines = [f'stage timings over {self.iterations} iterations:']
+        for name, seconds in self.totals.items():
+            share = seconds / total if total else 0.0
+            lines.append(f'{name:>15}: {seconds:8.3f} s total {1000 * self.mean(name):9.2f} ms mean {share:6.1%}')
+        return '\n'.join(lines)
+
+
+class ProfilerWindow:
+    """Record a torch.profiler trace of the training iterations numbered from start up to, but not including, stop, and save it as a
+    Chrome trace file. The trace is recorded once, the first time Engine.train() is called with iteration_number equal to start.
+
+    Args:
+        filename (str): Path of the trace file to write. e.g. 'trace.json'
+        start (int): Iteration number of the first iteration recorded.
+        stop (int): Iteration number after the last iteration recorded.
+    """
+    def __init__(self, filename, start, stop):
+        if not isinstance(start, int) or not isinstance(stop, int) or stop <= start:
+            raise ValueError('The profiled iterations must be two ints, start and stop, with stop greater than start.')
+        self.filename = filename
+        self.start = start
+        self.stop = stop
+        self.saved = False
+        self._profiler = None
+
+    @property
+    def active(self):
+        """True while iterations are being recorded.
+        """
+        return self._profiler is not None
+
+    def begin_iteration(self, iteration_number):
+        """Start recording if iteration_number is the first iteration of the window.
+
+        Args:
+            iteration_number (int): Number of the iteration about to run.
+        """
+        if self.saved or self._profiler is not None or iteration_number != self.start:
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+        self._profiler.start()
+
+    def end_iteration(self, iteration_number):
+        """Stop recording and save the trace if iteration_number is the last iteration of the window.
+
+        Args:
+            iteration_number (int): Number of the iteration that has just run.
+        """
+        if self._profiler is None or iteration_number < self.stop - 1:
+            return
+        profiler, self._profiler = self._profiler, None
+        profiler.stop()
+        profiler.export_chrome_trace(self.filename)
+        self.saved = True
@@ -0,0 +1,435 @@
+# A local HTTP service that keeps the VQGAN and CLIP models loaded, and generates images for other programs such as a web front-end.
+# Requests that can be optimized together (the same output size and number of iterations) are merged into one batch, in which each
+# image is optimized for its own prompts and seed. Progress and the finished image are streamed back to the caller as JSON lines.
+#
+# Start the service with: python -m vqgan_clip.serve --port 8000
+#
+# POST /generate    Generate an image. The body is a JSON object, e.g.
+#                   {"text_prompts": "A red sailboat", "seed": 1, "iterations": 100, "output_image_size": [256, 256], "progress_every": 10}
+#                   Only text_prompts or noise_prompts is required. The response is a stream of JSON objects, one per line:
+#                   {"event": "queued", ...}, {"event": "started", ...}, {"event": "progress", ...}, and finally
+#                   {"event": "done", "image": <base64 encoded PNG>, ...} or {"event": "error", "message": ...}.
+# GET /health       Service status and queue depth, as JSON.
+# GET /metrics      Request, batch and timing counters, in the Prometheus text format.
+
+from vqgan_clip.engine import Engine, VQGAN_CLIP_Config
+from vqgan_clip import model_registry
+from vqgan_clip import _functional as VF
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from torchvision.transforms import functional as TF
+import argparse
+import base64
+import contextlib
+import copy
+import io
+import json
+import os
+import queue
+import random
+import threading
+import time
+import torch
+
+__all__ = ["GenerationRequest", "GenerationService", "QueueFullError", "make_server", "main"]
+
+
+class QueueFullError(RuntimeError):
+    """Raised by GenerationService.submit() when max_queue requests are already waiting."""
+
+
+class GenerationRequest:
+    """One image to generate, and the stream of events reporting its progress.
+
+    Args:
+        text_prompts (str, optional): Text prompts, in the format used by generate.image(). Defaults to None.
+        noise_prompts (str, optional): Noise prompts, in the format used by generate.image(). Defaults to None.
+        seed (int, optional): Positive random number generator seed for the image. If None, a random seed is chosen. Defaults to None.
+        iterations (int, optional): Number of iterations of train(). Defaults to 100.
+        output_image_size (list of int, optional): [width, height] of the image. Defaults to [256, 256].
+        progress_every (int, optional): Report progress every progress_every iterations. If None, progress isn't reported. Defaults to 10.
+    """
+    def __init__(self, text_prompts=None, noise_prompts=None, seed=None, iterations=100, output_image_size=[256, 256], progress_every=10):
+        if text_prompts is not None and not isinstance(text_prompts, str):
+            raise ValueError('text_prompts must be a string')
+        if noise_prompts is not None and not isinstance(noise_prompts, str):
+            raise ValueError('noise_prompts must be a string')
+        if not text_prompts and not noise_prompts:
+            raise ValueError('No valid prompts were provided')
+        if seed is not None and (not isinstance(seed, int) or seed < 1):
+            raise ValueError('seed must be a positive int.')
+        if not isinstance(iterations, int) or iterations < 1:
+            raise ValueError('iterations must be a positive int.')
+        if not isinstance(output_image_size, (list, tuple)) or len(output_image_size) != 2 or not all(isinstance(size, int) and size > 0 for size in output_image_size):
+            raise ValueError('output_image_size must be a list of two positive ints.')
+        if progress_every is not None and (not isinstance(progress_every, int) or progress_every < 1):
+            raise ValueError('progress_every must be a positive int.')
+        self.text_prompts = text_prompts
+        self.noise_prompts = noise_prompts
+        # the seed is drawn without touching torch's random number generator, which batches that are being generated are using
+        self.seed = seed if seed is not None else random.SystemRandom().randrange(1, 2**32)
+        self.iterations = iterations
+        self.output_image_size = list(output_image_size)
+        self.progress_every = progress_every
+        self.submitted = time.monotonic()
+        self.events = queue.Queue()
+
+    @classmethod
+    def from_json(cls, body):
+        """Create a request from the decoded JSON body of a POST /generate.
+
+        Args:
+            body (dict): Request arguments.
+        """
+        if not isinstance(body, dict):
+            raise ValueError('The request body must be a JSON object.')
+        unknown = sorted(set(body) - {'text_prompts', 'noise_prompts', 'seed', 'iterations', 'output_image_size', 'progress_every'})
+        if unknown:
+            raise ValueError(f'Unknown request arguments: {", ".join(unknown)}')
+        return cls(**body)
+
+    @property
+    def batch_key(self):
+        """Requests with the same batch_key can be optimized together in one batch."""
+        return (tuple(self.output_image_size), self.iterations)
+
+    def stream(self):
+        """Yield the events reported for this request, until it is done or has failed."""
+        while True:
+            event = self.events.get()
+            yield event
+            if event['event'] in ['done', 'error']:
+                return
+
+
+class GenerationService:
+    """Generate images for GenerationRequests on background threads, merging compatible requests into batches.
+
+    The models selected by eng_config are loaded by start(), and stay loaded until the process exits. A new Engine is created for each
+    batch, since batches have different sizes, but it uses the loaded models from the model registry.
+
+    Args:
+        eng_config (VQGAN_CLIP_Config, optional): Selects the models and device, and the training settings used for every request. Defaults to VQGAN_CLIP_Config().
+        max_batch_size (int, optional): Maximum number of requests optimized together. Defaults to 4.
+        batch_wait (float, optional): How long, in seconds, the oldest waiting request waits for compatible requests to arrive before its batch is started. Defaults to 0.5.
+        max_queue (int, optional): Maximum number of requests waiting to start. Further requests are rejected. Defaults to 32.
+        max_concurrent_batches (int, optional): Number of batches generated at the same time. Results are only reproducible from their seed when this is 1. Defaults to 1.
+        max_iterations (int, optional): Maximum iterations a request may ask for. Defaults to 1000.
+        max_pixels (int, optional): Maximum width * height of a requested image. Defaults to 512*512.
+    """
+    def __init__(self, eng_config=VQGAN_CLIP_Config(), max_batch_size=4, batch_wait=0.5, max_queue=32, max_concurrent_batches=1, max_iterations=1000, max_pixels=512*512):
+        for name, value in [('max_batch_size', max_batch_size), ('max_queue', max_queue), ('max_concurrent_batches', max_concurrent_batches),
+                            ('max_iterations', max_iterations), ('max_pixels', max_pixels)]:
+            if not isinstance(value, int) or value < 1:
+                raise ValueError(f'{name} must be a positive int.')
+        if batch_wait < 0:
+            raise ValueError('batch_wait must be 0 or more.')
+        self.eng_config = eng_config
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait
+        self.max_queue = max_queue
+        self.max_concurrent_batches = max_concurrent_batches
+        self.max_iterations = max_iterations
+        self.max_pixels = max_pixels
+        self._pending = []
+        self._condition = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        self._running_batches = 0
+        self._started = time.monotonic()
+        self._counters = dict.fromkeys(['requests_accepted', 'requests_rejected', 'requests_completed', 'requests_failed', 'batches',
+                                        'batch_images', 'iterations', 'queue_wait_seconds', 'generation_seconds'], 0)
+
+    def start(self):
+        """Load the models, and start the threads that generate batches.
+        """
+        with open(os.devnull, 'w') as devnull:
+            with contextlib.redirect_stdout(devnull):
+                model_registry.preload(self.eng_config)
+        self._stopping = False
+        self._threads = [threading.Thread(target=self._run_batches, name=f'vqgan_clip_batch_{thread_num}', daemon=True)
+                         for thread_num in range(self.max_concurrent_batches)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """Stop the batch threads once the batches being generated have finished. Requests that haven't started are failed.
+        """
+        with self._condition:
+            self._stopping = True
+            pending, self._pending = self._pending, []
+            self._condition.notify_all()
+        for request in pending:
+            self._fail([request], 'The service is stopping.')
+        for thread in self._threads:
+            thread.join()
+
+    def submit(self, request):
+        """Queue a request. Its progress is reported through request.events.
+
+        Args:
+            request (GenerationRequest): The image to generate.
+
+        Raises:
+            ValueError: If the request is larger than the service allows.
+            QueueFullError: If max_queue requests are already waiting.
+        """
+        if request.iterations > self.max_iterations:
+            raise ValueError(f'iterations must be at most {self.max_iterations}.')
+        if request.output_image_size[0] * request.output_image_size[1] > self.max_pixels:
+            raise ValueError(f'output_image_size must be at most {self.max_pixels} pixels.')
+        with self._condition:
+            if len(self._pending) >= self.max_queue:
+                self._count('requests_rejected')
+                raise QueueFullError('The queue is full.')
+            self._pending.append(request)
+            self._count('requests_accepted')
+            request.events.put({'event': 'queued', 'queue_depth': len(self._pending)})
+            self._condition.notify_all()
+
+    def health(self):
+        """Status of the service, as reported by GET /health.
+
+        Returns:
+            dict: Status, device, models, queue depth and the number of batches being generated.
+        """
+        with self._condition:
+            alive = bool(self._threads) and all(thread.is_alive() for thread in self._threads)
+            return {'status': 'ok' if alive and not self._stopping else 'unavailable',
+                    'device': str(self.eng_config.cuda_device),
+                    'vqgan_model_name': self.eng_config.vqgan_model_name,
+                    'clip_model': self.eng_config.clip_model,
+                    'queue_depth': len(self._pending),
+                    'max_queue': self.max_queue,
+                    'running_batches': self._running_batches,
+                    'uptime_seconds': time.monotonic() - self._started}
+
+    def metrics(self):
+        """Counters and gauges of the service in the Prometheus text format, as reported by GET /metrics.
+
+        Returns:
+            str: One line per metric.
+        """
+        with self._condition:
+            counters = dict(self._counters)
+            gauges = {'queue_depth': len(self._pending), 'running_batches': self._running_batches}
+        lines = []
+        for status in ['accepted', 'rejected', 'completed', 'failed']:
+            lines.append(f'vqgan_clip_requests_total{{status="{status}"}} {counters[f"requests_{status}"]}')
+        for name in ['batches', 'batch_images', 'iterations']:
+            lines.append(f'vqgan_clip_{name}_total {counters[name]}')
+        for name in ['queue_wait_seconds', 'generation_seconds']:
+            lines.append(f'vqgan_clip_{name}_total {counters[name]:.3f}')
+        for name, value in gauges.items():
+            lines.append(f'vqgan_clip_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def _count(self, name, amount=1):
+        with self._condition:
+            self._counters[name] += amount
+
+    def _next_batch(self):
+        # Wait for the oldest request, then for up to batch_wait seconds for compatible requests to join it. Returns None when stopping.
+        with self._condition:
+            while True:
+                while not self._pending and not self._stopping:
+                    self._condition.wait()
+                if self._stopping:
+                    return None
+                oldest = self._pending[0]
+                deadline = oldest.submitted + self.batch_wait
+                batch = [request for request in self._pending if request.batch_key == oldest.batch_key][:self.max_batch_size]
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.max_batch_size or remaining <= 0:
+                    for request in batch:
+                        self._pending.remove(request)
+                    self._running_batches += 1
+                    return batch
+                # another thread may take the oldest request while this one waits, so the batch is chosen again afterwards
+                self._condition.wait(remaining)
+
+    def _run_batches(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                self._generate(batch)
+            except Exception as e:
+                self._fail(batch, f'{type(e).__name__}: {e}')
+            finally:
+                with self._condition:
+                    self._running_batches -= 1
+
+    def _generate(self, batch):
+        start = time.monotonic()
+        self._count('batches')
+        self._count('batch_images', len(batch))
+        self._count('queue_wait_seconds', sum(start - request.submitted for request in batch))
+        seeds = [request.seed for request in batch]
+        config = copy.copy(self.eng_config)
+        config.output_image_size = list(batch[0].output_image_size)
+        config.init_image = None
+        config.seed = seeds[0]
+        with open(os.devnull, 'w') as devnull:
+            with contextlib.redirect_stdout(devnull):
+                eng = Engine(config)
+                eng.initialize_VQGAN_CLIP(seeds=seeds)
+        for batch_index, request in enumerate(batch):
+            parsed_text_prompts, parsed_image_prompts, parsed_noise_prompts = VF.parse_all_prompts(request.text_prompts, [], request.noise_prompts)
+            eng.encode_and_append_prompts(0, parsed_text_prompts, parsed_image_prompts, parsed_noise_prompts, batch_index=batch_index)
+            request.events.put({'event': 'started', 'batch_size': len(batch), 'seed': request.seed})
+        eng.configure_optimizer()
+
+        iterations = batch[0].iterations
+        for iteration_num in range(1, iterations + 1):
+            lossAll = eng.train(iteration_num)
+            reporting = [request.progress_every and iteration_num % request.progress_every == 0 for request in batch]
+            if any(reporting):
+                # each image's loss only includes its own prompts
+                losses = sum(lossAll).tolist()
+                for batch_index, request in enumerate(batch):
+                    if reporting[batch_index]:
+                        request.events.put({'event': 'progress', 'iteration': iteration_num, 'iterations': iterations, 'loss': losses[batch_index]})
+        self._count('iterations', iterations * len(batch))
+
+        for batch_index, request in enumerate(batch):
+            img_info = [('text_prompts', request.text_prompts),
+                        ('noise_prompts', request.noise_prompts),
+                        ('iterations', iterations),
+                        ('cut_method', config.cut_method),
+                        ('seed', request.seed)]
+            request.events.put({'event': 'done', 'seed': request.seed, 'iterations': iterations, 'batch_size': len(batch),
+                                'image': _png_base64(eng.output_tensor[batch_index:batch_index+1], img_info)})
+        self._count('requests_completed', len(batch))
+        self._count('generation_seconds', time.monotonic() - start)
+
+    def _fail(self, batch, message):
+        self._count('requests_failed', len(batch))
+        for request in batch:
+            request.events.put({'event': 'error', 'message': message})
+
+
+def _png_base64(image_tensor, img_info):
+    # encode a [1, 3, H, W] image tensor as a base64 PNG, with the generation settings saved as PNG data chunks
+    with torch.inference_mode():
+        image = TF.to_pil_image(image_tensor[0].cpu())
+    buffer = io.BytesIO()
+    image.save(buffer, format='png', pnginfo=VF.png_info_chunks(img_info))
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    # self.server.service is the GenerationService handling the requests
+
+    def do_GET(self):
+        if self.path == '/health':
+            health = self.server.service.health()
+            self._send_json(200 if health['status'] == 'ok' else 503, health)
+        elif self.path == '/metrics':
+            self._send(200, 'text/plain; version=0.0.4', self.server.service.metrics().encode('utf-8'))
+        else:
+            self._send_json(404, {'error': f'Unknown path {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/generate':
+            self._send_json(404, {'error': f'Unknown path {self.path}'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = GenerationRequest.from_json(json.loads(self.rfile.read(length) or b'{}'))
+            self.server.service.submit(request)
+        except (ValueError, TypeError) as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        except QueueFullError as e:
+            self._send_json(503, {'error': str(e)})
+            return
+        # the events are streamed as they happen, so the length isn't known. The connection is closed after the last one.
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        try:
+            for event in request.stream():
+                self.wfile.write(json.dumps(event).encode('utf-8') + b'\n')
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # the client went away. The image is still generated with the rest of its batch.
+            pass
+
+    def _send_json(self, status, body):
+        self._send(status, 'application/json', json.dumps(body).encode('utf-8'))
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def make_server(service, host='127.0.0.1', port=8000, verbose=False):
+    """Create an HTTP server for a GenerationService. Call serve_forever() on the result to handle requests.
+
+    Args:
+        service (GenerationService): The started service that generates images for the requests.
+        host (str, optional): Address to listen on. Defaults to '127.0.0.1', which only accepts connections from this computer.
+        port (int, optional): Port to listen on. Use 0 to choose a free port, which is then server.server_address[1]. Defaults to 8000.
+        verbose (bool, optional): If True, log each HTTP request to stderr. Defaults to False.
+
+    Returns:
+        http.server.ThreadingHTTPServer: The server.
+    """
+    server = ThreadingHTTPServer((host, port), _RequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    server.verbose = verbose
+    return server
+
+
+def main(argv=None):
+    """Run the service from the command line. See python -m vqgan_clip.serve --help.
+    """
+    default_config = VQGAN_CLIP_Config()
+    parser = argparse.ArgumentParser(description='Serve VQGAN+CLIP image generation over HTTP, keeping the models loaded between requests.')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on.')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--vqgan_model_name', default=default_config.vqgan_model_name)
+    parser.add_argument('--vqgan_model_yaml_url', default=default_config.vqgan_model_yaml_url)
+    parser.add_argument('--vqgan_model_ckpt_url', default=default_config.vqgan_model_ckpt_url)
+    parser.add_argument('--clip_model', default=default_config.clip_model)
+    parser.add_argument('--cuda_device', default=default_config.cuda_device)
+    parser.add_argument('--cut_method', default=default_config.cut_method)
+    parser.add_argument('--num_cuts', type=int, default=default_config.num_cuts)
+    parser.add_argument('--max_batch_size', type=int, default=4, help='Maximum number of requests optimized together.')
+    parser.add_argument('--batch_wait', type=float, default=0.5, help='Seconds a request waits for compatible requests to batch with.')
+    parser.add_argument('--max_queue', type=int, default=32, help='Maximum number of waiting requests. Further requests get HTTP 503.')
+    parser.add_argument('--max_concurrent_batches', type=int, default=1, help='Number of batches generated at the same time.')
+    parser.add_argument('--max_iterations', type=int, default=1000)
+    parser.add_argument('--max_pixels', type=int, default=512*512)
+    parser.add_argument('--verbose', action='store_true', help='Log each HTTP request.')
+    args = parser.parse_args(argv)
+
+    config = VQGAN_CLIP_Config()
+    for name in ['vqgan_model_name', 'vqgan_model_yaml_url', 'vqgan_model_ckpt_url', 'clip_model', 'cuda_device', 'cut_method', 'num_cuts']:
+        setattr(config, name, getattr(args, name))
+    service = GenerationService(config, max_batch_size=args.max_batch_size, batch_wait=args.batch_wait, max_queue=args.max_queue,
+                                max_concurrent_batches=args.max_concurrent_batches, max_iterations=args.max_iterations, max_pixels=args.max_pixels)
+    print('Loading models...')
+    service.start()
+    server = make_server(service, args.host, args.port, args.verbose)
+    print(f'Serving on http://{server.server_address[0]}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,11 @@
 import os
 import subprocess
 import glob
-import cv2
+import queue
+import threading
+
+# options of the ffmpeg minterpolate filter, used to interpolate frames when the output framerate is higher than the input framerate
+_MINTERPOLATE_OPTIONS = 'mi_mode=mci:me=hexbs:me_mode=bidir:mc_mode=aobmc:vsbmc=1:mb_size=8:search_param=32'
 
 
 def extract_video_frames(input_video_path, extraction_framerate, extracted_video_frames_path='./extracted_video_frames'):
@@ -50,6 +54,141 @@ def extract_video_frames(input_video_path, extraction_framerate, extracted_video
     return video_frames
 
 
+class VideoFrameSource:
+    """Decode the frames of a video on demand, by reading them from an ffmpeg pipe, instead of extracting them all to image files first.
+
+    Iterating over a VideoFrameSource yields each selected frame as an RGB PIL image. Frames are decoded on a background thread that
+    keeps up to prefetch frames ready ahead of the one being used, and decoding stops once end_frame is reached. Each iteration starts
+    a new ffmpeg process, so a source can be iterated more than once. generate.style_transfer() accepts a VideoFrameSource in place
+    of a list of extracted frames.
+
+    Args:
+        input_video_path (str): Location of video file to decode.
+        extraction_framerate (int, optional): Number of frames per second to decode from the video. Interpolation is used if the video's native framerate differs. If None, the native framerate is used. Defaults to None.
+        start_frame (int, optional): Index of the first frame to use, counting from 0 at extraction_framerate. Defaults to 0.
+        end_frame (int, optional): Index of the frame to stop before. If None, frames are used until the end of the video. Defaults to None.
+        stride (int, optional): Use every stride-th frame from start_frame. Defaults to 1.
+        size (list of int, optional): [width, height] to scale the frames to while decoding. If None, frames keep the size of the video. Defaults to None.
+        prefetch (int, optional): Maximum number of decoded frames waiting to be used. Defaults to 8.
+    """
+    def __init__(self, input_video_path, extraction_framerate=None, start_frame=0, end_frame=None, stride=1, size=None, prefetch=8):
+        if not os.path.isfile(input_video_path):
+            raise ValueError(f'input_video_path must be a file')
+        if not isinstance(start_frame, int) or start_frame < 0:
+            raise ValueError('start_frame must be an int of 0 or more.')
+        if end_frame is not None and (not isinstance(end_frame, int) or end_frame <= start_frame):
+            raise ValueError('end_frame must be an int greater than start_frame.')
+        if not isinstance(stride, int) or stride < 1:
+            raise ValueError('stride must be a positive int.')
+        if size is not None and (len(size) != 2 or not all(isinstance(value, int) and value > 0 for value in size)):
+            raise ValueError('size must be a list of two positive ints.')
+        if not isinstance(prefetch, int) or prefetch < 1:
+            raise ValueError('prefetch must be a positive int.')
+        self.input_video_path = input_video_path
+        self.extraction_framerate = extraction_framerate
+        self.start_frame = start_frame
+        self.end_frame = end_frame
+        self.stride = stride
+        self.size = list(size) if size is not None else None
+        self.prefetch = prefetch
+
+    def __len__(self):
+        if self.end_frame is None:
+            raise TypeError('The number of frames of a VideoFrameSource without an end_frame is not known until it has been decoded.')
+        return -(-(self.end_frame - self.start_frame) // self.stride)
+
+    def resized(self, size):
+        """Return a copy of this source that scales frames to size while decoding.
+
+        Args:
+            size (list of int): [width, height] of the frames.
+        """
+        return VideoFrameSource(self.input_video_path, self.extraction_framerate, self.start_frame, self.end_frame, self.stride, size, self.prefetch)
+
+    def first_frame(self):
+        """Decode only the first selected frame.
+
+        Returns:
+            PIL.Image: The frame.
+        """
+        frames = iter(self)
+        try:
+            return next(frames)
+        finally:
+            frames.close()
+
+    def ffmpeg_command(self):
+        """The ffmpeg command used to decode the selected frames as a stream of PPM images on stdout.
+
+        Returns:
+            list of str: ffmpeg and its arguments.
+        """
+        filters = []
+        if self.extraction_framerate:
+            filters.append(f'fps={self.extraction_framerate}')
+        if self.start_frame or self.end_frame is not None or self.stride > 1:
+            end_frame = self.end_frame - 1 if self.end_frame is not None else 'inf'
+            filters.append(f"select='between(n\\,{self.start_frame}\\,{end_frame})*not(mod(n-{self.start_frame}\\,{self.stride}))'")
+        if self.size:
+            filters.append(f'scale={self.size[0]}:{self.size[1]}:flags=lanczos')
+        filter_option = ['-filter:v', ','.join(filters)] if filters else []
+        # -vsync 0 passes the selected frames through, rather than duplicating them to fill the gaps at a constant framerate
+        return (['ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', self.input_video_path] + filter_option
+                + ['-vsync', '0', '-f', 'image2pipe', '-vcodec', 'ppm', '-'])
+
+    def __iter__(self):
+        frames = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        process = subprocess.Popen(self.ffmpeg_command(), stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        max_frames = len(self) if self.end_frame is not None else None
+        reader = threading.Thread(target=self._read_frames, args=(process, frames, stop, max_frames), name='video_frame_source', daemon=True)
+        reader.start()
+        try:
+            while True:
+                frame = frames.get()
+                if frame is None:
+                    break
+                if isinstance(frame, Exception):
+                    raise frame
+                yield frame
+        finally:
+            stop.set()
+            process.kill()
+            # unblock the reader if it is waiting for room in the queue
+            while reader.is_alive():
+                try:
+                    frames.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            process.wait()
+            process.stdout.close()
+
+    @staticmethod
+    def _read_frames(process, frames, stop, max_frames):
+        # Read PPM images from ffmpeg's stdout and queue them as PIL images, followed by None. Each image is a "P6\n<width> <height>\n255\n" header and RGB pixels.
+        from PIL import Image
+        frame_count = 0
+        try:
+            while not stop.is_set() and (max_frames is None or frame_count < max_frames):
+                header = process.stdout.readline()
+                if not header:
+                    break
+                width, height = (int(value) for value in process.stdout.readline().split())
+                process.stdout.readline()
+                pixels = process.stdout.read(width * height * 3)
+                if len(pixels) < width * height * 3:
+                    break
+                frames.put(Image.frombytes('RGB', (width, height), pixels))
+                frame_count += 1
+            if not stop.is_set() and max_frames is None and process.wait() != 0:
+                frames.put(NameError('ffmpeg failed to decode the video'))
+            elif frame_count == 0 and not stop.is_set():
+                frames.put(NameError('No video frames were decoded'))
+        except Exception as error:
+            frames.put(error)
+        frames.put(None)
+
+
 def copy_video_audio(original_video, destination_file_without_audio, output_file, verbose = False):
     if not os.path.isfile(original_video):
         raise NameError(f'{original_video} does not exist')
@@ -110,7 +249,7 @@ def encode_video(output_file, input_framerate, path_to_stills=f'video_frames', o
     
     if input_framerate and output_framerate and input_framerate != output_framerate:
         # a different input and output framerate are specified. Use interpolation
-        output_framerate_option = f"-filter:v minterpolate='mi_mode=mci:me=hexbs:me_mode=bidir:mc_mode=aobmc:vsbmc=1:mb_size=8:search_param=32:fps={str(output_framerate)}'"
+        output_framerate_option = f"-filter:v minterpolate='{_MINTERPOLATE_OPTIONS}:fps={str(output_framerate)}'"
     else:
         # no interpolation
         output_framerate_to_use = output_framerate if output_framerate else input_framerate
@@ -130,6 +269,155 @@ def encode_video(output_file, input_framerate, path_to_stills=f'video_frames', o
         raise NameError('encode_video failed to generate an output file')
 
 
+class FFmpegVideoWriter:
+    """Encode a video as its frames are generated, by piping raw RGB frames to ffmpeg over stdin. This replaces saving each frame as a JPEG
+    and then encoding the folder with encode_video(): there is no lossy JPEG step, and the video is finished as soon as the last frame is.
+
+    It has the same submit(), flush() and close() methods as image_writer.AsyncImageWriter, so it can be passed as the video_writer argument
+    of generate.video_frames() and generate.style_transfer(). submit() copies each frame to the CPU as 8 bit pixels, and a background thread
+    writes it to ffmpeg. submit() returns immediately, unless max_pending frames are already waiting for ffmpeg, in which case it waits for ffmpeg to catch up. If ffmpeg
+    fails, the error is raised by the next call to submit(), flush() or close(). ffmpeg is started when the first frame is submitted, with
+    the size of that frame. Every frame must have the same size, with an even width and height.
+
+    Args:
+        output_file (str): Location to save the video file.
+        input_framerate (int): Framerate of the generated frames.
+        output_framerate (int, optional): Framerate of the video. If it differs from input_framerate, ffmpeg interpolates frames as in encode_video(). Defaults to None.
+        vcodec (str, optional): The video codec (-vcodec) to pass to ffmpeg. Defaults to 'libx264'.
+        crf (int, optional): The -crf parameter value to pass to ffmpeg. Defaults to 23.
+        metadata_title (str, optional): String to store in the title metadata field. Defaults to ''.
+        metadata_comment (str, optional): String to store in the comment metadata field. Defaults to ''.
+        save_stills (bool, optional): If True, also save each frame as an image file, to the filename it is submitted with. Defaults to False.
+        max_pending (int, optional): Maximum number of frames waiting to be written to ffmpeg. Defaults to 8.
+        verbose (bool, optional): If True, show ffmpeg's output. Defaults to False.
+    """
+    def __init__(self, output_file, input_framerate, output_framerate=None, vcodec='libx264', crf=23, metadata_title='', metadata_comment='', save_stills=False, max_pending=8, verbose=False):
+        if not isinstance(max_pending, int) or max_pending < 1:
+            raise ValueError('max_pending must be a positive int.')
+        self.output_file = output_file
+        self.input_framerate = input_framerate
+        self.output_framerate = output_framerate
+        self.vcodec = vcodec
+        self.crf = crf
+        self.metadata_title = metadata_title
+        self.metadata_comment = metadata_comment
+        self.verbose = verbose
+        self.frames_written = 0
+        self.frame_size = None
+        self._stills_writer = None
+        if save_stills:
+            from .image_writer import AsyncImageWriter
+            self._stills_writer = AsyncImageWriter()
+        self._process = None
+        self._frames = queue.Queue(maxsize=max_pending)
+        self._errors = []
+        self._closed = False
+        self._thread = threading.Thread(target=self._write_frames, name='ffmpeg_video_writer', daemon=True)
+        self._thread.start()
+
+    def ffmpeg_command(self, width, height):
+        """The ffmpeg command used to encode frames of width x height pixels.
+
+        Returns:
+            list of str: ffmpeg and its arguments.
+        """
+        if self.input_framerate and self.output_framerate and self.input_framerate != self.output_framerate:
+            output_framerate_option = ['-filter:v', f'minterpolate={_MINTERPOLATE_OPTIONS}:fps={str(self.output_framerate)}']
+        else:
+            output_framerate_option = ['-r', str(self.output_framerate or self.input_framerate)]
+        log_level_option = [] if self.verbose else ['-hide_banner', '-loglevel', 'error']
+        metadata_option = ['-metadata', f'title={self.metadata_title}', '-metadata', f'comment={self.metadata_comment}',
+                           '-metadata', 'description=Generated with https://github.com/rkhamilton/vqgan-clip-generator']
+        return (['ffmpeg', '-y', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}', '-r', str(self.input_framerate), '-i', '-']
+                + output_framerate_option + ['-vcodec', self.vcodec, '-crf', str(self.crf), '-pix_fmt', 'yuv420p']
+                + log_level_option + metadata_option + [self.output_file])
+
+    def submit(self, image_tensor, save_filename=None, img_metadata=None):
+        """Queue a frame to be added to the video.
+
+        Args:
+            image_tensor (tensor): Image with values between 0 and 1, [1, 3, H, W]. It may be on any device, and may be changed as soon as submit() returns.
+            save_filename (str, optional): Where to save the frame as an image, if save_stills is True. Defaults to None.
+            img_metadata (list of tuple, optional): (name, value) pairs to save as metadata of the still image. Defaults to None.
+        """
+        if self._closed:
+            raise ValueError('FFmpegVideoWriter is closed.')
+        self._raise_errors()
+        if self._stills_writer is not None and save_filename:
+            self._stills_writer.submit(image_tensor, save_filename, img_metadata)
+        # the same conversion to 8 bit pixels as saving the frame as an image
+        frame = image_tensor[0].detach().mul(255).byte().permute(1, 2, 0).to('cpu', copy=True)
+        self._frames.put(frame)
+
+    def _write_frames(self):
+        while True:
+            frame = self._frames.get()
+            try:
+                if frame is None:
+                    return
+                if self._errors:
+                    continue
+                height, width = frame.shape[:2]
+                if self._process is None:
+                    self.frame_size = (width, height)
+                    self._process = subprocess.Popen(self.ffmpeg_command(width, height), stdin=subprocess.PIPE)
+                elif (width, height) != self.frame_size:
+                    raise ValueError(f'Every frame must be {self.frame_size[0]}x{self.frame_size[1]}. Received {width}x{height}')
+                # blocks while ffmpeg's input pipe is full, which holds back submit() once max_pending frames are waiting
+                self._process.stdin.write(frame.contiguous().numpy().data)
+                self.frames_written += 1
+            except Exception as error:
+                self._errors.append(error)
+            finally:
+                self._frames.task_done()
+
+    def _raise_errors(self):
+        if self._errors:
+            raise self._errors[0]
+
+    def flush(self):
+        """Wait until every submitted frame has been written to ffmpeg, and every still image saved. Raises the first error from ffmpeg, or from saving a still.
+        """
+        self._frames.join()
+        if self._stills_writer is not None:
+            self._stills_writer.flush()
+        self._raise_errors()
+
+    def close(self):
+        """Write the remaining frames, and wait for ffmpeg to finish the video. Raises the first error from ffmpeg, or from saving a still.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._frames.put(None)
+            self._thread.join()
+            if self._process is not None:
+                try:
+                    self._process.stdin.close()
+                except OSError as error:
+                    self._errors.append(error)
+                if self._process.wait() != 0:
+                    self._errors.insert(0, NameError(f'ffmpeg failed to encode {self.output_file}'))
+            if self._stills_writer is not None:
+                self._stills_writer.close()
+        finally:
+            self._raise_errors()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # don't hide the exception that is already being raised behind a failed encode
+            try:
+                self.close()
+            except Exception:
+                pass
+
+
 def RIFE_interpolation(input, output, interpolation_factor=4, metadata_title='', metadata_comment='', verbose=False):
     """Perform optical flow interpolation with arXiv2020-RIFE.
 
@@ -154,6 +442,7 @@ def RIFE_interpolation(input, output, interpolation_factor=4, metadata_title='',
         os.remove(output)
 
     # we need the framerate of the source video to know what name RIFE will use in the output
+    import cv2
     input_framerate = cv2.VideoCapture(input).get(cv2.CAP_PROP_FPS)
 
     of_cmnd = f'python arXiv2020-RIFE{os.sep}inference_video.py --exp={2 if interpolation_factor==4 else 4} --model=arXiv2020-RIFE{os.sep}train_log --video={enquote_paths_with_spaces(input)}'
@@ -0,0 +1,120 @@
+# A pool of worker processes that generate independent images at the same time, such as one image per prompt or per seed.
+# The VQGAN and CLIP models are loaded once, by the process that creates the pool, and the workers use them through shared
+# memory, so memory use doesn't grow with the number of workers.
+
+from vqgan_clip.engine import VQGAN_CLIP_Config
+from vqgan_clip import model_registry
+from vqgan_clip import generate
+import concurrent.futures
+import copy
+import threading
+import torch
+import torch.multiprocessing
+
+__all__ = ["ImageWorkerPool"]
+
+
+class ImageWorkerPool:
+    """Generate images with generate.image() in several worker processes at once, with each job running in one worker.
+
+    The models selected by eng_config are loaded (or taken from the model registry) when the pool is created, and shared with the
+    workers. On the CPU they are moved to shared memory. On a CUDA device the workers use the parent's copy on that device.
+    Workers are started with the spawn method, because workers forked from a process that has used torch's thread pool can hang.
+    A script that creates a pool must do so inside an `if __name__ == '__main__':` block.
+
+    Args:
+        eng_config (VQGAN_CLIP_Config, optional): Selects the models and device. Jobs use it as their configuration, unless they are
+            submitted with their own. Defaults to VQGAN_CLIP_Config().
+        num_workers (int, optional): Number of worker processes. Defaults to 2.
+        threads_per_worker (int, optional): Number of threads each worker uses for torch operations on the CPU. If None, the threads
+            available to this process are divided between the workers. Defaults to None.
+    """
+    def __init__(self, eng_config=VQGAN_CLIP_Config(), num_workers=2, threads_per_worker=None):
+        if not isinstance(num_workers, int) or num_workers < 1:
+            raise ValueError('num_workers must be a positive int.')
+        if threads_per_worker is not None and (not isinstance(threads_per_worker, int) or threads_per_worker < 1):
+            raise ValueError('threads_per_worker must be a positive int.')
+        self.eng_config = eng_config
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker or max(1, torch.get_num_threads() // num_workers)
+        models = model_registry.get(eng_config)
+        if torch.device(eng_config.cuda_device).type == 'cpu':
+            models.vqgan.share_memory()
+            models.perceptor.share_memory()
+        # futures that haven't finished, so that close() can cancel them. shutdown(cancel_futures=True) needs Python 3.9.
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self._executor = concurrent.futures.ProcessPoolExecutor(num_workers, mp_context=torch.multiprocessing.get_context('spawn'),
+            initializer=_init_worker, initargs=(eng_config, models.vqgan, models.perceptor, self.threads_per_worker))
+
+    def submit(self, output_filename, seed=None, eng_config=None, **kwargs):
+        """Queue a call to generate.image() to run in a worker process.
+
+        Args:
+            output_filename (str): Location to save the output image.
+            seed (int, optional): Random number generator seed for this image. If None, the seed of the job's configuration is used,
+                and if that is also None a random seed is chosen. Defaults to None.
+            eng_config (VQGAN_CLIP_Config, optional): Configuration for this image. It must select the same models and device as the
+                pool's configuration. If None, the pool's configuration is used. Defaults to None.
+            **kwargs: Other arguments of generate.image(), such as text_prompts and iterations. leave_progress_bar defaults to False.
+
+        Returns:
+            concurrent.futures.Future: Future whose result is the string returned by generate.image(). If the job fails, the exception
+                is raised by Future.result().
+        """
+        eng_config = copy.copy(eng_config or self.eng_config)
+        if model_registry.ModelRegistry.key(eng_config) != model_registry.ModelRegistry.key(self.eng_config):
+            raise ValueError('eng_config must use the same vqgan_model_name, clip_model and cuda_device as the pool.')
+        if seed is not None:
+            eng_config.seed = seed
+        kwargs.setdefault('leave_progress_bar', False)
+        future = self._executor.submit(_generate_image, output_filename, eng_config, kwargs)
+        with self._pending_lock:
+            self._pending.add(future)
+        future.add_done_callback(self._forget)
+        return future
+
+    def _forget(self, future):
+        with self._pending_lock:
+            self._pending.discard(future)
+
+    def map(self, jobs):
+        """Queue a list of jobs, and return their results in the order of the jobs as they finish.
+
+        Args:
+            jobs (iterable of dict): Arguments of submit() for each job, e.g. {'output_filename': 'a.jpg', 'text_prompts': 'A red sailboat', 'seed': 1}.
+
+        Returns:
+            generator: The result of each job. If a job failed, its exception is raised when its result is reached.
+        """
+        futures = [self.submit(**job) for job in jobs]
+        return (future.result() for future in futures)
+
+    def close(self, cancel_pending=False):
+        """Shut down the worker processes, after the queued jobs have finished.
+
+        Args:
+            cancel_pending (bool, optional): If True, jobs that haven't started yet are cancelled instead. Defaults to False.
+        """
+        if cancel_pending:
+            with self._pending_lock:
+                pending = list(self._pending)
+            # jobs that have already been sent to a worker can't be cancelled, and are finished
+            for future in pending:
+                future.cancel()
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(cancel_pending=exc_type is not None)
+
+
+def _init_worker(eng_config, vqgan, perceptor, num_threads):
+    # runs once in each worker process. The models arrive in shared memory, and are registered so that every Engine in the process uses them.
+    torch.set_num_threads(num_threads)
+    model_registry.put(eng_config, vqgan, perceptor)
+
+def _generate_image(output_filename, eng_config, kwargs):
+    return generate.image(output_filename, eng_config=eng_config, **kwargs)
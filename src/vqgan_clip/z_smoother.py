@@ -36,6 +36,19 @@ class Z_Smoother:
             self._data.pop()
         self._data.appendleft(new_tensor.clone())
 
+    def state_dict(self):
+        """Return the tensors in the buffer, newest first, so that the buffer can be restored with load_state_dict().
+        """
+        return {'data': list(self._data)}
+
+    def load_state_dict(self, state):
+        """Replace the tensors in the buffer with those returned by state_dict().
+
+        Args:
+            state (dict): Buffer contents returned by state_dict().
+        """
+        self._data = collections.deque(state['data'])
+
     def smooth(self, method):
         """Returns the tensor data in the buffer with the selected smoothing method applied.
 
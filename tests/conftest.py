@@ -0,0 +1,33 @@
+import pytest
+import torch
+from vqgan_clip.engine import VQGAN_CLIP_Config
+
+class FakeQuantize(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.embedding = torch.nn.Embedding(16, 4)
+
+class FakeVQGAN(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.quantize = FakeQuantize()
+
+@pytest.fixture
+def cpu_config():
+    '''Returns a function that makes a configuration for the CPU, selecting models by name
+    '''
+    def make_config(vqgan_model_name='vqgan_imagenet_f16_16384', clip_model='ViT-B/32'):
+        config = VQGAN_CLIP_Config()
+        config.cuda_device = 'cpu'
+        config.vqgan_model_name = vqgan_model_name
+        config.clip_model = clip_model
+        return config
+    return make_config
+
+@pytest.fixture
+def fake_models():
+    '''Returns a function that makes a tiny VQGAN model and CLIP perceptor, for tests that share models without running them
+    '''
+    def make_models():
+        return FakeVQGAN(), torch.nn.Linear(2, 2)
+    return make_models
@@ -0,0 +1,48 @@
+import os
+import pytest
+import torch
+from vqgan_clip import checkpoint
+from vqgan_clip.z_smoother import Z_Smoother
+
+def test_save_and_load_checkpoint(tmpdir):
+    '''A saved checkpoint is loaded unchanged, replaces the previous checkpoint, and leaves no temporary files
+    '''
+    path = str(tmpdir.join('checkpoint.pt'))
+    assert checkpoint.load_checkpoint(path) is None
+    checkpoint.save_checkpoint(path, {'video_frame_num': 1, 'rng_state': torch.get_rng_state()})
+    state = {'video_frame_num': 2, 'z': torch.randn(1, 4, 3, 3), 'rng_state': torch.get_rng_state()}
+    checkpoint.save_checkpoint(path, state)
+    loaded = checkpoint.load_checkpoint(path)
+    assert loaded['video_frame_num'] == 2
+    assert torch.equal(loaded['z'], state['z'])
+    assert torch.equal(loaded['rng_state'], state['rng_state'])
+    assert os.listdir(str(tmpdir)) == ['checkpoint.pt']
+
+def test_failed_save_keeps_previous_checkpoint(tmpdir):
+    '''A checkpoint that can't be saved doesn't damage the checkpoint that is already there
+    '''
+    path = str(tmpdir.join('checkpoint.pt'))
+    checkpoint.save_checkpoint(path, {'video_frame_num': 1})
+    with pytest.raises(Exception):
+        checkpoint.save_checkpoint(path, {'video_frame_num': 2, 'unpicklable': lambda: None})
+    assert checkpoint.load_checkpoint(path)['video_frame_num'] == 1
+    assert os.listdir(str(tmpdir)) == ['checkpoint.pt']
+
+def test_check_settings():
+    '''Resuming with different settings is an error
+    '''
+    saved = {'settings': {'text_prompts': 'a cat', 'iterations_per_frame': 30}}
+    checkpoint.check_settings(saved, {'text_prompts': 'a cat', 'iterations_per_frame': 30})
+    with pytest.raises(ValueError, match='iterations_per_frame'):
+        checkpoint.check_settings(saved, {'text_prompts': 'a cat', 'iterations_per_frame': 20})
+
+def test_z_smoother_state_dict():
+    '''A Z_Smoother restored from its state_dict gives the same smoothed output
+    '''
+    smoother = Z_Smoother(buffer_len=3, alpha=0.7)
+    for _ in range(4):
+        smoother.append(torch.randn(1, 4, 3, 3))
+    restored = Z_Smoother(buffer_len=3, alpha=0.7)
+    restored.load_state_dict(smoother.state_dict())
+    assert torch.equal(restored._mid_ewma(), smoother._mid_ewma())
+    assert torch.equal(restored._mean(), smoother._mean())
@@ -0,0 +1,56 @@
+import pytest
+import torch
+from vqgan_clip.early_stopping import EarlyStopping
+
+def run(early_stopping, losses):
+    # returns the number of iterations run before early_stopping asked to stop
+    early_stopping.reset()
+    for iteration, loss in enumerate(losses, start=1):
+        if early_stopping.update([torch.tensor(loss)]):
+            return iteration
+    return len(losses)
+
+def test_early_stopping_stops_on_plateau():
+    '''Training stops once the loss stops improving, but not while it is still decreasing
+    '''
+    early_stopping = EarlyStopping(window=10, min_relative_improvement=0.01, min_iterations=20, check_every=5)
+    improving = [1.0 - 0.005 * i for i in range(100)]
+    plateau = [1.0 - 0.005 * min(i, 30) for i in range(100)]
+    assert run(early_stopping, improving) == 100
+    assert early_stopping.iterations == 100 and not early_stopping.stopped
+    assert run(early_stopping, plateau) == 45
+    assert early_stopping.stopped
+
+def test_early_stopping_min_iterations_and_check_every():
+    '''Training never stops before min_iterations, and is only checked every check_every iterations
+    '''
+    early_stopping = EarlyStopping(window=5, min_iterations=30, check_every=7)
+    assert run(early_stopping, [1.0] * 100) == 35
+
+def test_early_stopping_batched_losses():
+    '''Losses with one value per image in a batch are summed over the batch
+    '''
+    early_stopping = EarlyStopping(window=5, min_iterations=10, check_every=5)
+    early_stopping.reset()
+    stopped = [early_stopping.update([torch.tensor([1.0, 2.0]), torch.tensor([0.5, 0.5])]) for _ in range(10)]
+    assert stopped == [False] * 9 + [True]
+
+def test_early_stopping_scaled_to_max_iterations():
+    '''Settings that don't fit in the number of iterations of a short run, such as a video frame, are scaled down for that run only
+    '''
+    early_stopping = EarlyStopping()
+    plateau = [1.0] * 30
+    assert run(early_stopping, plateau) == 30 and not early_stopping.stopped
+    early_stopping.reset(30)
+    stopped = [early_stopping.update([torch.tensor(loss)]) for loss in plateau]
+    assert stopped.index(True) + 1 == 21
+    # long runs keep the configured settings
+    early_stopping.reset(1000)
+    stopped = [early_stopping.update([torch.tensor(loss)]) for loss in [1.0] * 100]
+    assert stopped.index(True) + 1 == 50
+
+def test_early_stopping_invalid_input():
+    with pytest.raises(ValueError):
+        EarlyStopping(window=0)
+    with pytest.raises(ValueError):
+        EarlyStopping(check_every=0)
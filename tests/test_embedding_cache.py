@@ -0,0 +1,63 @@
+import threading
+import torch
+from PIL import Image
+from vqgan_clip.embedding_cache import TextEmbeddingCache, ImageEmbeddingCache, pil_image_content_hash
+
+def test_text_embedding_cache_memory_lru():
+    '''Embeddings are returned from memory, and the least recently used ones are evicted
+    '''
+    cache = TextEmbeddingCache(max_memory_entries=2)
+    embeds = [torch.randn([1, 8]) for _ in range(3)]
+    for i, embed in enumerate(embeds):
+        cache.put('ViT-B/32', f'prompt {i}', embed)
+    assert cache.get('ViT-B/32', 'prompt 0') is None
+    assert torch.equal(cache.get('ViT-B/32', 'prompt 2'), embeds[2])
+    assert cache.get('ViT-B/16', 'prompt 2') is None
+    assert len(cache) == 2
+
+def test_text_embedding_cache_on_disk(tmp_path):
+    '''Embeddings written by one cache are read by another cache using the same folder, as they would be by another process
+    '''
+    writer = TextEmbeddingCache(str(tmp_path))
+    reader = TextEmbeddingCache(str(tmp_path))
+    embed = torch.randn([1, 8])
+    writer.put('ViT-B/32', 'A red sailboat', embed)
+    assert torch.equal(reader.get('ViT-B/32', 'A red sailboat'), embed)
+    assert reader.get('ViT-B/32', 'A cup of water') is None
+    writer.put('ViT-B/32', 'A cup of water', 2 * embed)
+    assert torch.equal(reader.get('ViT-B/32', 'A cup of water'), 2 * embed)
+
+def test_text_embedding_cache_concurrent_writers(tmp_path):
+    '''Several writers appending to the same folder at once do not lose or corrupt embeddings
+    '''
+    def write(worker):
+        cache = TextEmbeddingCache(str(tmp_path))
+        for i in range(20):
+            cache.put('ViT-B/32', f'{worker} {i}', torch.full([1, 8], float(i)))
+    threads = [threading.Thread(target=write, args=(worker,)) for worker in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    reader = TextEmbeddingCache(str(tmp_path))
+    for worker in range(4):
+        for i in range(20):
+            assert torch.equal(reader.get('ViT-B/32', f'{worker} {i}'), torch.full([1, 8], float(i)))
+
+def test_image_embedding_cache_bounded():
+    '''Image prompt embeddings are evicted least recently used first once the cache exceeds max_bytes
+    '''
+    embed = torch.randn([32, 8])
+    cache = ImageEmbeddingCache(max_bytes=2 * embed.nbytes)
+    for i in range(3):
+        cache.put(('hash', i), embed + i)
+    assert cache.get(('hash', 0)) is None
+    assert torch.equal(cache.get(('hash', 2)), embed + 2)
+    assert len(cache) == 2
+
+def test_pil_image_content_hash():
+    '''Identical images have the same content hash, and different images do not
+    '''
+    image = Image.new('RGB', (16, 8), (10, 20, 30))
+    assert pil_image_content_hash(image) == pil_image_content_hash(image.copy())
+    assert pil_image_content_hash(image) != pil_image_content_hash(Image.new('RGB', (16, 8), (10, 20, 31)))
@@ -0,0 +1,232 @@
+import pytest
+import torch
+import warnings
+from torch.nn import functional as F
+import vqgan_clip._functional as VF
+
+@pytest.mark.parametrize('cutout_class', [VF.MakeCutoutsOrig, VF.MakeCutoutsKornia, VF.MakeCutoutsSG3])
+def test_batched_cutouts_shape(cutout_class):
+    '''Batched and looped cutouts return the same shape, ordered cut-major for a batch of images
+    '''
+    input = torch.rand([2, 3, 96, 128])
+    for batched in [False, True]:
+        make_cutouts = cutout_class(32, 8, batched=batched)
+        assert make_cutouts(input).shape == (16, 3, 32, 32)
+
+def test_batched_pooled_cutouts_match_adaptive_avg_pool():
+    '''The batched SG3 cutouts are identical to pooling each cutout in a loop
+    '''
+    input = torch.rand([2, 3, 96, 128])
+    torch.manual_seed(1)
+    cutouts = VF.batched_pooled_cutouts(input, 32, 8)
+    torch.manual_seed(1)
+    offsetx, offsety, sizes = VF._sample_cutout_boxes(input, 32, 8, 1.)
+    expected = torch.cat([F.adaptive_avg_pool2d(input[:, :, y:y + size, x:x + size], 32) for x, y, size in zip(offsetx.tolist(), offsety.tolist(), sizes.tolist())])
+    assert torch.allclose(cutouts, expected, atol=1e-5)
+
+def test_batched_cutouts_sizes():
+    '''Cutout sizes stay between cut_size and the shortest side of the image
+    '''
+    input = torch.rand([1, 3, 96, 128])
+    offsetx, offsety, sizes = VF._sample_cutout_boxes(input, 32, 256, 1.)
+    assert sizes.min() >= 32 and sizes.max() <= 96
+    assert (offsetx + sizes).max() <= 128 and (offsety + sizes).max() <= 96
+
+def test_resample_cutouts_match_resample():
+    '''Resampling same-size cutouts together gives the same result as resampling each cutout
+    '''
+    input = torch.rand([1, 3, 96, 128])
+    offsets = [(0, 0), (10, 5), (40, 20), (3, 7)]
+    sizes = [64, 48, 64, 80]
+    cutouts = VF.resample_cutouts(input, offsets, sizes, 32)
+    expected = torch.cat([VF.resample(input[:, :, y:y + size, x:x + size], (32, 32)) for (x, y), size in zip(offsets, sizes)])
+    assert torch.allclose(cutouts, expected, atol=1e-6)
+
+def test_lanczos_kernel_cache_bounded():
+    '''The Lanczos kernel cache reuses kernels and evicts the least recently used entries
+    '''
+    cache = VF.LanczosKernelCache(max_entries=2)
+    kernel = cache.get(0.5, torch.device('cpu'), torch.float32)
+    assert cache.get(0.5, torch.device('cpu'), torch.float32) is kernel
+    cache.get(0.25, torch.device('cpu'), torch.float32)
+    cache.get(0.125, torch.device('cpu'), torch.float32)
+    assert len(cache) == 2
+    assert cache.get(0.5, torch.device('cpu'), torch.float32) is not kernel
+
+def test_vector_quantizer_matches_one_hot_lookup():
+    '''The precomputed quantizer picks the same codes as a full distance matrix and one-hot lookup, and passes gradients straight through
+    '''
+    codebook = torch.randn([64, 8])
+    x = torch.randn([2, 5, 4, 8], requires_grad=True)
+    d = x.pow(2).sum(dim=-1, keepdim=True) + codebook.pow(2).sum(dim=1) - 2 * x @ codebook.T
+    expected = F.one_hot(d.argmin(-1), codebook.shape[0]).to(d.dtype) @ codebook
+    x_q = VF.VectorQuantizer(codebook)(x)
+    assert torch.allclose(x_q, expected)
+    x_q.sum().backward()
+    assert torch.equal(x.grad, torch.ones_like(x))
+
+def test_vector_quantizer_chunked_and_approximate():
+    '''Chunked search matches the full search, and an approximate search that probes every cluster is exact
+    '''
+    torch.manual_seed(0)
+    codebook = torch.randn([256, 8])
+    x = torch.randn([1, 6, 7, 8])
+    exact = VF.VectorQuantizer(codebook).nearest_indices(x)
+    assert torch.equal(VF.VectorQuantizer(codebook, chunk_size=5).nearest_indices(x), exact)
+    quantizer = VF.VectorQuantizer(codebook, chunk_size=5, approximate=True, num_clusters=16, num_probes=16)
+    assert torch.equal(quantizer.nearest_indices(x), exact)
+    assert quantizer.disagreement_rate(x) == 0.
+    quantizer.num_probes = 1
+    assert 0. <= quantizer.disagreement_rate(x) <= 1.
+    with pytest.raises(ValueError):
+        VF.VectorQuantizer(codebook, chunk_size=0)
+
+def test_prompt_stack_matches_prompts():
+    '''A PromptStack returns the same loss for each prompt as evaluating every Prompt on its own, for single and batched input
+    '''
+    torch.manual_seed(0)
+    prompts = [VF.Prompt(torch.randn([1, 16]), 1.0), VF.Prompt(torch.randn([1, 16]), -0.5), VF.Prompt(torch.randn([4, 16]), 0.3, 0.2)]
+    stack = VF.PromptStack(prompts)
+    for input in [torch.randn([8, 16]), torch.randn([2, 8, 16])]:
+        expected = torch.stack([prompt(input) for prompt in prompts], dim=-1)
+        assert torch.allclose(stack(input), expected, atol=1e-6)
+
+class _Decoder(torch.nn.Module):
+    # the decode path of a taming VQModel, with a small decoder
+    def __init__(self):
+        super().__init__()
+        from taming.modules.diffusionmodules.model import Decoder
+        self.post_quant_conv = torch.nn.Conv2d(8, 8, 1)
+        self.decoder = Decoder(ch=32, out_ch=3, ch_mult=[1,2], num_res_blocks=1, attn_resolutions=[8], in_channels=3,
+                               resolution=16, z_channels=8, dropout=0.0)
+
+    def decode(self, quant):
+        return self.decoder(self.post_quant_conv(quant))
+
+def test_checkpointed_decode_matches_decode():
+    '''Checkpointed decoding returns the same image and gradient as model.decode
+    '''
+    torch.manual_seed(0)
+    model = _Decoder().requires_grad_(False)
+    quant = torch.randn([1, 8, 8, 8], requires_grad=True)
+    expected = model.decode(quant)
+    expected_grad, = torch.autograd.grad(expected.square().sum(), quant)
+    output = VF.checkpointed_decode(model, quant)
+    grad, = torch.autograd.grad(output.square().sum(), quant)
+    assert torch.allclose(output, expected, atol=1e-6)
+    assert torch.allclose(grad, expected_grad, atol=1e-5)
+
+class _LocalDecoder(torch.nn.Module):
+    # a decoder where each output pixel only depends on one latent vector, so tiling cannot change the result
+    def __init__(self):
+        super().__init__()
+        self.decoder = torch.nn.Module()
+        self.decoder.num_resolutions = 3
+        self.conv = torch.nn.Conv2d(8, 3, 1)
+
+    def decode(self, quant):
+        return F.interpolate(self.conv(quant), scale_factor=4, mode='nearest')
+
+def test_tiled_decode_blends_tiles():
+    '''Tiles are blended back into exactly the image and gradient of a single decode, and a single tile is decoded as a whole
+    '''
+    torch.manual_seed(0)
+    model = _LocalDecoder().requires_grad_(False)
+    quant = torch.randn([2, 8, 11, 17], requires_grad=True)
+    expected = model.decode(quant)
+    expected_grad, = torch.autograd.grad(expected.square().sum(), quant)
+    output = VF.tiled_decode(model, quant, 5, 2)
+    grad, = torch.autograd.grad(output.square().sum(), quant)
+    assert torch.allclose(output, expected, atol=1e-6)
+    assert torch.allclose(grad, expected_grad, atol=1e-5)
+    with torch.no_grad():
+        assert torch.allclose(VF.tiled_decode(model, quant, 4, 3), expected, atol=1e-6)
+        assert torch.equal(VF.tiled_decode(model, quant, 17, 2), expected)
+    with pytest.raises(ValueError):
+        VF.tiled_decode(model, quant, 2, 2)
+
+def test_affine_transform():
+    '''Shifts wrap around like ImageChops.offset, rotation by 90 degrees matches rot90, and zoom is close to zoom_at
+    '''
+    from PIL import ImageChops
+    from torchvision.transforms import functional as TF
+    torch.manual_seed(0)
+    image = F.interpolate(torch.rand([1, 3, 12, 16]), size=(48, 64), mode='bicubic', align_corners=False).clamp(0, 1)
+    assert torch.equal(VF.affine_transform(image, shift_x=3, shift_y=-2), torch.roll(image, (-2, 3), dims=(2, 3)))
+    assert torch.allclose(VF.affine_transform(image, shift_x=3, shift_y=1e-9), torch.roll(image, 3, dims=3), atol=1e-5)
+    pil_image = TF.to_pil_image(image[0])
+    expected = TF.to_tensor(ImageChops.offset(pil_image, 3, -2))
+    assert (VF.affine_transform(image, shift_x=3, shift_y=-2)[0] - expected).abs().max() < 1 / 255
+    expected = TF.to_tensor(ImageChops.offset(VF.zoom_at(pil_image, 32, 24, 1.1), 3, 2))
+    assert (VF.affine_transform(image, 1.1, 3, 2)[0] - expected).abs().mean() < 0.02
+    square = image[..., :48]
+    assert torch.allclose(VF.affine_transform(square, rotation=90), torch.rot90(square, 1, dims=(2, 3)), atol=1e-5)
+
+def test_warp_latent():
+    '''Whole shifts of a latent are exact rolls, and a half shift interpolates between neighbouring latent vectors
+    '''
+    torch.manual_seed(0)
+    z = torch.randn([2, 8, 6, 10])
+    assert torch.equal(VF.warp_latent(z, shift_x=-2, shift_y=1), torch.roll(z, (1, -2), dims=(2, 3)))
+    expected = (z + torch.roll(z, 1, dims=3)) / 2
+    assert torch.allclose(VF.warp_latent(z, shift_x=0.5), expected, atol=1e-5)
+    assert VF.warp_latent(z, zoom=1.1, rotation=5).shape == z.shape
+
+def test_normalize_matches_torchvision():
+    '''normalize gives the same result as the torchvision Normalize transform it replaces
+    '''
+    from torchvision import transforms
+    input = torch.rand([4, 3, 16, 16])
+    expected = transforms.Normalize(mean=[0.48145466, 0.4578275, 0.40821073], std=[0.26862954, 0.26130258, 0.27577711])(input)
+    assert torch.equal(VF.normalize(input), expected)
+
+def test_compile_function_falls_back_to_eager():
+    '''A function that fails to compile runs eagerly, with a warning
+    '''
+    def failing_backend(graph_module, example_inputs):
+        raise RuntimeError('no compiler')
+    function = VF.compile_function(lambda x: x.sin() * 2, backend=failing_backend)
+    input = torch.rand([8])
+    with pytest.warns(UserWarning):
+        assert torch.equal(function(input), input.sin() * 2)
+    assert torch.equal(function(input), input.sin() * 2)
+
+def test_compile_function_raises_errors_of_the_function():
+    '''An error raised by the compiled function itself is raised, without a warning, and the function stays compiled
+    '''
+    graph_runs = []
+    def counting_backend(graph_module, example_inputs):
+        def run(*args):
+            graph_runs.append(1)
+            return graph_module.forward(*args)
+        return run
+    function = VF.compile_function(lambda x: x.sin() * 2 + torch.ones(4), backend=counting_backend)
+    input = torch.rand([4])
+    assert torch.equal(function(input), input.sin() * 2 + 1)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        with pytest.raises(RuntimeError):
+            function(torch.rand([3]))
+    runs_before = len(graph_runs)
+    function(input)
+    assert len(graph_runs) == runs_before + 1
+
+def test_split_segments():
+    '''Segments end at scene cuts, and long scenes are split into overlapping segments
+    '''
+    assert VF.split_segments(10) == [(0, 10, 0)]
+    assert VF.split_segments(10, 4, 2) == [(0, 3, 0), (1, 6, 2), (4, 10, 2)]
+    assert VF.split_segments(20, 6, 2, cuts=[7]) == [(0, 3, 0), (1, 7, 2), (7, 11, 0), (9, 15, 2), (13, 20, 2)]
+    # the overlap never reaches back past the start of the previous segment
+    assert VF.split_segments(3, 1, 3) == [(0, 1, 0), (0, 2, 1), (1, 3, 1)]
+
+def test_detect_scene_cuts(tmpdir):
+    '''A change of scene is detected, but small changes between frames are not
+    '''
+    from PIL import Image
+    frames = []
+    for frame_num, color in enumerate([(200, 40, 40), (205, 45, 40), (210, 50, 40), (30, 60, 220), (35, 60, 220)]):
+        frames.append(str(tmpdir.join(f'{frame_num}.png')))
+        Image.new('RGB', (64, 48), color).save(frames[-1])
+    assert VF.detect_scene_cuts(frames) == [3]
+    assert VF.detect_scene_cuts(frames, threshold=1.0) == []
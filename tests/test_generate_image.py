@@ -267,6 +267,44 @@ def test_image_all_prompts_story(testing_config, tmpdir):
     assert os.path.exists(output_filename)
     os.remove(output_filename)
 
+def test_images_invalid_input(testing_config, tmpdir):
+    '''Confirm we get an exception when seeds and output filenames do not match
+    '''
+    config = testing_config
+    config.output_image_size = [128,128]
+    output_path = tmpdir.mkdir('output')
+    with pytest.raises(ValueError, match='seeds must be a list of int.'):
+        vqgan_clip.generate.images(eng_config=config,
+            text_prompts = 'A painting of flowers in the renaissance style',
+            seeds = 1,
+            iterations = 5,
+            output_filenames = [str(output_path.join('output_1.jpg'))])
+    with pytest.raises(ValueError, match='output_filenames must be a list with one filename per seed.'):
+        vqgan_clip.generate.images(eng_config=config,
+            text_prompts = 'A painting of flowers in the renaissance style',
+            seeds = [1,2],
+            iterations = 5,
+            output_filenames = [str(output_path.join('output_1.jpg'))])
+
+def test_images_multiple_seeds(testing_config, tmpdir):
+    '''Generate several images in one batch, one per seed
+    '''
+    config = testing_config
+    config.output_image_size = [128,128]
+    output_path = tmpdir.mkdir('output')
+    seeds = [1,2,3]
+    output_filenames = [str(output_path.join(f'output_{seed}.jpg')) for seed in seeds]
+    vqgan_clip.generate.images(eng_config=config,
+        text_prompts = 'A painting of flowers in the renaissance style:0.5|rembrandt:0.5',
+        seeds = seeds,
+        iterations = 5,
+        save_every = 2,
+        verbose = True,
+        output_filenames = output_filenames)
+    for output_filename in output_filenames:
+        assert os.path.exists(output_filename)
+        os.remove(output_filename)
+
 def test_image_no_folder(testing_config):
     '''Output filename specified without a folder
     '''
@@ -377,4 +415,4 @@ def test_image_vqgan_gumbel_f8(testing_config, tmpdir):
         iterations = 5,
         output_filename = output_filename)
     assert os.path.exists(output_filename)
-    os.remove(output_filename)
\ No newline at end of file
+    os.remove(output_filename)
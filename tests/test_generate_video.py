@@ -4,7 +4,12 @@ from vqgan_clip.engine import VQGAN_CLIP_Config
 import os
 import vqgan_clip._functional as VF
 import glob
+import copy
+import numpy as np
+from PIL import Image
 from vqgan_clip import video_tools
+from vqgan_clip import checkpoint
+from vqgan_clip.early_stopping import EarlyStopping
 
 @pytest.fixture
 def testing_config():
@@ -23,6 +28,34 @@ IMAGE_2 = os.path.join(TEST_DATA_DIR,'prompt2.jpg')
 IMAGE_PROMPTS = f'{IMAGE_1}:0.5|{IMAGE_2}:0.5'
 TEST_VIDEO = os.path.join(TEST_DATA_DIR,'small.mp4')
 
+class InterruptAfterFrames(EarlyStopping):
+    '''Never stops training early, but raises KeyboardInterrupt when the frame after num_frames starts, as if Ctrl+C was pressed
+    '''
+    def __init__(self, num_frames):
+        self.num_frames = num_frames
+        self.frames_started = -1 # EarlyStopping.__init__ calls reset() once before the first frame
+        super().__init__()
+
+    def reset(self, max_iterations=None):
+        super().reset(max_iterations)
+        self.frames_started += 1
+        if self.frames_started > self.num_frames:
+            raise KeyboardInterrupt
+
+    def update(self, lossAll):
+        return False
+
+def seeded_config(testing_config):
+    # a fresh copy for each run, because runs change their configuration, with the same seed so that runs can be compared
+    config = copy.copy(testing_config)
+    config.output_image_size = [128,128]
+    config.seed = 1
+    config.cudnn_determinism = True
+    return config
+
+def mean_difference(image_file_1, image_file_2):
+    return np.abs(np.asarray(Image.open(image_file_1), dtype=float) - np.asarray(Image.open(image_file_2), dtype=float)).mean()
+
 def test_video_invalid_input(testing_config, tmpdir):
     '''test invalid inputs
     '''
@@ -91,6 +124,15 @@ def test_video_invalid_input(testing_config, tmpdir):
             zoom_scale=1.0, 
             shift_x=0, 
             shift_y=0)
+    with video_tools.FFmpegVideoWriter(str(tmpdir.join('output.mp4')), 30) as video_writer:
+        with pytest.raises(ValueError, match='A video_writer can\'t be used with resume'):
+            vqgan_clip.generate.video_frames(eng_config=config,
+                text_prompts = 'test prompt',
+                num_video_frames=num_video_frames,
+                iterations_per_frame = iterations_per_frame,
+                generated_video_frames_path=steps_path,
+                resume=True,
+                video_writer=video_writer)
 
 @pytest.mark.slow
 def test_video(testing_config, tmpdir):
@@ -270,6 +312,137 @@ def test_video_all_prompts(testing_config, tmpdir):
         os.remove(f)
     os.remove(output_filename)
 
+@pytest.mark.slow
+def test_video_early_stopping(testing_config, tmpdir):
+    '''An EarlyStopping with its default settings, which are for longer runs, stops each frame of a video with the default iterations_per_frame
+    '''
+    config = testing_config
+    config.output_image_size = [128,128]
+    # a relative improvement of 1 always stops at the first check, which is at iteration 21 for 30 iterations_per_frame
+    early_stopping = EarlyStopping(min_relative_improvement=1.0)
+    assert early_stopping.min_iterations > 30
+    steps_path = str(tmpdir.mkdir('video_frames'))
+    config_info = vqgan_clip.generate.video_frames(eng_config=config,
+        text_prompts = 'A painting of flowers in the renaissance style',
+        num_video_frames=3,
+        iterations_per_frame = 30,
+        iterations_for_first_frame = 5,
+        generated_video_frames_path=steps_path,
+        early_stopping=early_stopping,
+        leave_progress_bar=False)
+    assert 'average iterations used per frame: 21.0' in config_info
+
+    original_video_frames = video_tools.extract_video_frames(TEST_VIDEO,
+        extraction_framerate = 2,
+        extracted_video_frames_path=str(tmpdir.mkdir('extracted_video_frames')))[:3]
+    config_info = vqgan_clip.generate.style_transfer(original_video_frames,
+        eng_config=testing_config,
+        text_prompts = 'a red rose|a fish^the last horse',
+        iterations_per_frame = 30,
+        iterations_for_first_frame = 5,
+        generated_video_frames_path = str(tmpdir.mkdir('generated_video_frames')),
+        init_image_filename=str(tmpdir.join('init_image.jpg')),
+        early_stopping=early_stopping,
+        leave_progress_bar=False)
+    assert 'average iterations used per frame: 21.0' in config_info
+
+@pytest.mark.slow
+def test_video_zero_iterations_per_frame(testing_config, tmpdir):
+    '''Frames trained for no iterations are saved, and reported as using none
+    '''
+    config = testing_config
+    config.output_image_size = [128,128]
+    steps_path = str(tmpdir.mkdir('video_frames'))
+    config_info = vqgan_clip.generate.video_frames(eng_config=config,
+        text_prompts = 'A painting of flowers in the renaissance style',
+        num_video_frames=3,
+        iterations_per_frame = 0,
+        iterations_for_first_frame = 5,
+        generated_video_frames_path=steps_path,
+        leave_progress_bar=False)
+    assert 'average iterations used per frame: 0.0' in config_info
+    assert len(glob.glob(steps_path + os.sep + '*.jpg')) == 3
+
+@pytest.mark.slow
+def test_video_writer(testing_config, tmpdir):
+    '''Frames of video_frames and style_transfer are encoded to a video by an FFmpegVideoWriter, which is closed when the last frame is done
+    '''
+    config = testing_config
+    config.output_image_size = [128,128]
+    steps_path = str(tmpdir.mkdir('video_frames'))
+    num_video_frames = 5
+    output_filename = str(tmpdir.join('video_frames.mp4'))
+    video_writer = video_tools.FFmpegVideoWriter(output_filename, 30)
+    vqgan_clip.generate.video_frames(eng_config=config,
+        text_prompts = 'A painting of flowers in the renaissance style',
+        num_video_frames=num_video_frames,
+        iterations_per_frame = 5,
+        iterations_for_first_frame = 5,
+        generated_video_frames_path=steps_path,
+        video_writer=video_writer,
+        leave_progress_bar=False)
+    assert os.path.getsize(output_filename) > 0
+    assert video_writer.frames_written == num_video_frames
+    assert glob.glob(steps_path + os.sep + '*.jpg') == []
+    with pytest.raises(ValueError, match='FFmpegVideoWriter is closed'):
+        video_writer.submit(None)
+
+    # style transfer, also saving the frames as images
+    original_video_frames = video_tools.extract_video_frames(TEST_VIDEO,
+        extraction_framerate = 2,
+        extracted_video_frames_path=str(tmpdir.mkdir('extracted_video_frames')))
+    generated_video_frames_path = str(tmpdir.mkdir('generated_video_frames'))
+    output_filename = str(tmpdir.join('style_transfer.mp4'))
+    video_writer = video_tools.FFmpegVideoWriter(output_filename, 30, save_stills=True)
+    vqgan_clip.generate.style_transfer(original_video_frames,
+        eng_config=testing_config,
+        text_prompts = 'a red rose|a fish^the last horse',
+        iterations_per_frame = 5,
+        generated_video_frames_path = generated_video_frames_path,
+        init_image_filename=str(tmpdir.join('init_image.jpg')),
+        video_writer=video_writer,
+        leave_progress_bar=False)
+    assert os.path.getsize(output_filename) > 0
+    assert video_writer.frames_written == len(original_video_frames)
+    assert len(glob.glob(generated_video_frames_path + os.sep + '*.jpg')) == len(original_video_frames)
+    with pytest.raises(ValueError, match='FFmpegVideoWriter is closed'):
+        video_writer.submit(None)
+
+@pytest.mark.slow
+def test_video_resume(testing_config, tmpdir):
+    '''A run interrupted after 3 frames, with a checkpoint every 2 frames, is resumed after frame 2 and makes the same frames as an uninterrupted run
+    '''
+    settings = dict(text_prompts = 'A painting of flowers in the renaissance style^A painting of fish',
+        change_prompts_on_frame = [2],
+        num_video_frames = 5,
+        iterations_per_frame = 5,
+        iterations_for_first_frame = 5,
+        zoom_scale=1.02,
+        z_smoother=True,
+        z_smoother_buffer_len=3,
+        leave_progress_bar=False)
+    uninterrupted_path = str(tmpdir.mkdir('uninterrupted'))
+    vqgan_clip.generate.video_frames(eng_config=seeded_config(testing_config), generated_video_frames_path=uninterrupted_path, **settings)
+    expected_files = [f'frame_{frame_num:012d}.jpg' for frame_num in range(1, 6)]
+    assert sorted(os.listdir(uninterrupted_path)) == expected_files
+
+    steps_path = str(tmpdir.mkdir('video_frames'))
+    vqgan_clip.generate.video_frames(eng_config=seeded_config(testing_config), generated_video_frames_path=steps_path, checkpoint_every=2, early_stopping=InterruptAfterFrames(3), **settings)
+    assert sorted(os.listdir(steps_path)) == ['checkpoint.pt'] + expected_files[:3]
+    saved = checkpoint.load_checkpoint(os.path.join(steps_path, 'checkpoint.pt'))
+    assert saved['video_frame_num'] == 2 and saved['prompt_number'] == 1
+    assert len(saved['z_smoother']['data']) == 2
+
+    with pytest.raises(ValueError, match='iterations_per_frame'):
+        vqgan_clip.generate.video_frames(eng_config=seeded_config(testing_config), generated_video_frames_path=steps_path, checkpoint_every=2, resume=True,
+            **dict(settings, iterations_per_frame=10))
+    assert sorted(os.listdir(steps_path)) == ['checkpoint.pt'] + expected_files[:3]
+
+    vqgan_clip.generate.video_frames(eng_config=seeded_config(testing_config), generated_video_frames_path=steps_path, checkpoint_every=2, resume=True, **settings)
+    assert sorted(os.listdir(steps_path)) == ['checkpoint.pt'] + expected_files
+    for filename in expected_files:
+        assert mean_difference(os.path.join(steps_path, filename), os.path.join(uninterrupted_path, filename)) < 1.0
+
 def test_style_transfer_invalid_input(testing_config, tmpdir):
     '''test invalid inputs
     '''
@@ -330,6 +503,15 @@ def test_style_transfer_invalid_input(testing_config, tmpdir):
                 generated_video_frames_path = generated_video_frames_path,
                 current_source_frame_prompt_weight=0.1,
                 current_source_frame_image_weight=0.1)
+    with video_tools.FFmpegVideoWriter(str(tmpdir.join('output.mp4')), 30) as video_writer:
+        with pytest.raises(ValueError, match='A video_writer can\'t be used with resume'):
+            vqgan_clip.generate.style_transfer(original_video_frames,
+                    eng_config=testing_config,
+                    text_prompts = 'a red rose|a fish^the last horse',
+                    iterations_per_frame = 5,
+                    generated_video_frames_path = generated_video_frames_path,
+                    resume=True,
+                    video_writer=video_writer)
 
 @pytest.mark.slow
 def test_style_transfer(testing_config, tmpdir):
@@ -381,3 +563,82 @@ def test_style_transfer_smoothed(testing_config, tmpdir):
         os.remove(f)
     for f in original_video_frames:
         os.remove(f)
+
+@pytest.mark.slow
+def test_style_transfer_resume(testing_config, tmpdir):
+    '''A style transfer interrupted after 3 frames, with a checkpoint every 2 frames, is resumed after frame 2 and makes the same frames as an uninterrupted run
+    '''
+    original_video_frames = video_tools.extract_video_frames(TEST_VIDEO,
+        extraction_framerate = 2,
+        extracted_video_frames_path=str(tmpdir.mkdir('video_frames')))[:5]
+    settings = dict(text_prompts = 'a red rose|a fish^the last horse',
+        change_prompts_on_frame = [2],
+        iterations_per_frame = 5,
+        iterations_for_first_frame = 5,
+        current_source_frame_prompt_weight=0.1,
+        current_source_frame_image_weight=0.1,
+        z_smoother=True,
+        leave_progress_bar=False)
+    uninterrupted_path = str(tmpdir.mkdir('uninterrupted'))
+    vqgan_clip.generate.style_transfer(original_video_frames, eng_config=seeded_config(testing_config), generated_video_frames_path=uninterrupted_path,
+        init_image_filename=str(tmpdir.join('uninterrupted_init_image.jpg')), **settings)
+    expected_files = [os.path.basename(f) for f in original_video_frames]
+    assert sorted(os.listdir(uninterrupted_path)) == expected_files
+
+    generated_video_frames_path = str(tmpdir.mkdir('generated_video_frames'))
+    init_image_filename = str(tmpdir.join('init_image.jpg'))
+    vqgan_clip.generate.style_transfer(original_video_frames, eng_config=seeded_config(testing_config), generated_video_frames_path=generated_video_frames_path,
+        init_image_filename=init_image_filename, checkpoint_every=2, early_stopping=InterruptAfterFrames(3), **settings)
+    assert sorted(os.listdir(generated_video_frames_path)) == ['checkpoint.pt'] + expected_files[:3]
+    saved = checkpoint.load_checkpoint(os.path.join(generated_video_frames_path, 'checkpoint.pt'))
+    assert saved['video_frame_num'] == 2 and saved['prompt_number'] == 1
+
+    with pytest.raises(ValueError, match='text_prompts'):
+        vqgan_clip.generate.style_transfer(original_video_frames, eng_config=seeded_config(testing_config), generated_video_frames_path=generated_video_frames_path,
+            init_image_filename=init_image_filename, checkpoint_every=2, resume=True, **dict(settings, text_prompts='a blue rose'))
+
+    vqgan_clip.generate.style_transfer(original_video_frames, eng_config=seeded_config(testing_config), generated_video_frames_path=generated_video_frames_path,
+        init_image_filename=init_image_filename, checkpoint_every=2, resume=True, **settings)
+    assert sorted(os.listdir(generated_video_frames_path)) == ['checkpoint.pt'] + expected_files
+    for filename in expected_files:
+        assert mean_difference(os.path.join(generated_video_frames_path, filename), os.path.join(uninterrupted_path, filename)) < 1.0
+
+@pytest.mark.slow
+def test_style_transfer_video_frame_source(testing_config, tmpdir):
+    '''Style transfer from frames decoded by a VideoFrameSource, interrupted and resumed, matches an uninterrupted run
+    '''
+    import threading
+    source = video_tools.VideoFrameSource(TEST_VIDEO, extraction_framerate=2, start_frame=1, end_frame=9, stride=2)
+    settings = dict(text_prompts = 'a red rose|a fish^the last horse',
+        iterations_per_frame = 5,
+        iterations_for_first_frame = 5,
+        current_source_frame_image_weight=0.1,
+        leave_progress_bar=False)
+    expected_files = [f'frame_{frame_num:012d}.jpg' for frame_num in range(1, 5)]
+
+    uninterrupted_path = str(tmpdir.mkdir('uninterrupted'))
+    vqgan_clip.generate.style_transfer(source, eng_config=seeded_config(testing_config), generated_video_frames_path=uninterrupted_path,
+        init_image_filename=str(tmpdir.join('uninterrupted_init_image.jpg')), **settings)
+    assert sorted(os.listdir(uninterrupted_path)) == expected_files
+    # only the first source frame is saved, next to the init image, and the output keeps its aspect ratio
+    first_source_frame = Image.open(str(tmpdir.join('uninterrupted_init_image_source_frame.png')))
+    assert np.array_equal(np.asarray(first_source_frame), np.asarray(source.first_frame()))
+    output_size = Image.open(os.path.join(uninterrupted_path, expected_files[0])).size
+    assert output_size[0] / output_size[1] == pytest.approx(first_source_frame.size[0] / first_source_frame.size[1], rel=0.1)
+    # the metadata identifies each frame by its index in the video
+    comment = Image.open(os.path.join(uninterrupted_path, expected_files[1])).getexif()[0x9C9C].decode('utf_16_le')
+    assert f'init_image: {TEST_VIDEO} frame 3,' in comment
+
+    generated_video_frames_path = str(tmpdir.mkdir('generated_video_frames'))
+    init_image_filename = str(tmpdir.join('init_image.jpg'))
+    vqgan_clip.generate.style_transfer(source, eng_config=seeded_config(testing_config), generated_video_frames_path=generated_video_frames_path,
+        init_image_filename=init_image_filename, checkpoint_every=2, early_stopping=InterruptAfterFrames(3), **settings)
+    assert sorted(os.listdir(generated_video_frames_path)) == ['checkpoint.pt'] + expected_files[:3]
+    # the source was closed when the run was interrupted, so its frames are no longer being decoded
+    assert 'video_frame_source' not in [thread.name for thread in threading.enumerate()]
+
+    vqgan_clip.generate.style_transfer(source, eng_config=seeded_config(testing_config), generated_video_frames_path=generated_video_frames_path,
+        init_image_filename=init_image_filename, checkpoint_every=2, resume=True, **settings)
+    assert sorted(os.listdir(generated_video_frames_path)) == ['checkpoint.pt'] + expected_files
+    for filename in expected_files:
+        assert mean_difference(os.path.join(generated_video_frames_path, filename), os.path.join(uninterrupted_path, filename)) < 1.0
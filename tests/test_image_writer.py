@@ -0,0 +1,34 @@
+import pytest
+import numpy as np
+import torch
+from PIL import Image
+from vqgan_clip.image_writer import AsyncImageWriter, write_image
+
+def test_async_image_writer_matches_write_image(tmp_path):
+    '''Images written in the background are identical to images written synchronously, and the tensor can be changed right after submit
+    '''
+    image = torch.rand([1, 3, 32, 48])
+    metadata = [('text_prompts', 'A red sailboat'), ('seed', 1)]
+    with AsyncImageWriter(max_pending=2) as writer:
+        for i in range(5):
+            writer.submit(image, str(tmp_path / f'async_{i}.jpg'), metadata)
+            write_image(image, str(tmp_path / f'sync_{i}.jpg'), metadata)
+        writer.submit(image, str(tmp_path / 'async.png'), metadata)
+        image.zero_()
+    write_image(torch.zeros([1, 3, 32, 48]), str(tmp_path / 'zeros.png'), [])
+    for i in range(5):
+        assert (tmp_path / f'async_{i}.jpg').read_bytes() == (tmp_path / f'sync_{i}.jpg').read_bytes()
+    assert np.asarray(Image.open(tmp_path / 'async.png')).any()
+
+def test_async_image_writer_raises_errors(tmp_path):
+    '''A failed write is raised by the next flush, and later writes still succeed
+    '''
+    writer = AsyncImageWriter()
+    writer.submit(torch.rand([1, 3, 8, 8]), str(tmp_path / 'missing_folder' / 'frame.jpg'), [('text_prompts', 'A red sailboat')])
+    with pytest.raises(NameError):
+        writer.flush()
+    writer.submit(torch.rand([1, 3, 8, 8]), str(tmp_path / 'frame.jpg'), [('text_prompts', 'A red sailboat')])
+    writer.close()
+    assert (tmp_path / 'frame.jpg').exists()
+    with pytest.raises(ValueError):
+        writer.submit(torch.rand([1, 3, 8, 8]), str(tmp_path / 'frame.jpg'), [('text_prompts', 'A red sailboat')])
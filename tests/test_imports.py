@@ -0,0 +1,21 @@
+import json
+import subprocess
+import sys
+import pytest
+
+def loaded_modules(module, names):
+    # import module in a new process, and return which of names it loaded
+    script = f'import json, sys\nimport {module}\nprint(json.dumps([name for name in {names!r} if name in sys.modules]))'
+    output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+@pytest.mark.parametrize('module', ['vqgan_clip.engine', 'vqgan_clip.generate'])
+def test_slow_dependencies_are_imported_when_used(module):
+    '''Optional dependencies are only imported by the features that use them, not when vqgan_clip is imported
+    '''
+    assert loaded_modules(module, ['kornia', 'taming', 'clip', 'torch_optimizer', 'piexif', 'cv2', 'imageio']) == []
+
+def test_video_tools_does_not_import_torch():
+    '''Programs that only use the ffmpeg helpers don't wait for torch to import
+    '''
+    assert loaded_modules('vqgan_clip.video_tools', ['torch', 'cv2']) == []
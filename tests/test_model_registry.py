@@ -0,0 +1,45 @@
+import pytest
+import copy
+import torch
+from vqgan_clip.model_registry import ModelRegistry
+
+def test_registry_returns_shared_models(cpu_config, fake_models):
+    '''Models put in the registry are returned to every caller with the same configuration, without reloading
+    '''
+    registry = ModelRegistry()
+    config = cpu_config()
+    registry.put(config, *fake_models())
+    models = registry.get(config)
+    assert registry.get(cpu_config()) is models
+    assert not any(p.requires_grad for p in models.vqgan.parameters())
+    assert models.quantizer() is models.quantizer()
+
+def test_registry_lru_eviction(cpu_config, fake_models):
+    '''The least recently used models are evicted first, and evict() removes models explicitly
+    '''
+    registry = ModelRegistry(max_entries=2)
+    configs = [cpu_config(vqgan_model_name=name) for name in ['a', 'b', 'c']]
+    registry.put(configs[0], *fake_models())
+    registry.put(configs[1], *fake_models())
+    registry.get(configs[0])
+    registry.put(configs[2], *fake_models())
+    assert configs[0] in registry and configs[1] not in registry and configs[2] in registry
+    registry.evict(configs[0])
+    assert configs[0] not in registry and len(registry) == 1
+    registry.evict()
+    assert len(registry) == 0
+
+def test_registry_perceptor_fingerprint(cpu_config, fake_models):
+    '''A different perceptor registered under the same clip_model name has a different fingerprint, so cached embeddings are not shared
+    '''
+    registry = ModelRegistry()
+    config = cpu_config()
+    vqgan, perceptor = fake_models()
+    registry.put(config, vqgan, perceptor)
+    fingerprint = registry.get(config).perceptor_fingerprint()
+    registry.put(config, vqgan, copy.deepcopy(perceptor))
+    assert registry.get(config).perceptor_fingerprint() == fingerprint
+    with torch.no_grad():
+        perceptor.weight[0, 0] += 1
+    registry.put(config, vqgan, perceptor)
+    assert registry.get(config).perceptor_fingerprint() != fingerprint
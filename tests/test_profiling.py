@@ -0,0 +1,40 @@
+import json
+import pytest
+import torch
+from vqgan_clip.profiling import StageTimings, ProfilerWindow
+
+def test_stage_timings_accumulate():
+    '''Time spent in each stage is added up over calls, and reset() clears it
+    '''
+    timings = StageTimings()
+    for _ in range(3):
+        with timings.stage('synth'):
+            torch.ones(64, 64).matmul(torch.ones(64, 64))
+        with timings.stage('backward'):
+            pass
+    assert list(timings.totals) == ['synth', 'backward']
+    assert timings.counts == {'synth': 3, 'backward': 3}
+    assert timings.mean('synth') == pytest.approx(timings.totals['synth'] / 3)
+    assert timings.mean('clamp') == 0.0
+    assert timings.as_dict()['backward']['count'] == 3
+    assert 'synth' in timings.summary()
+    timings.reset()
+    assert timings.totals == {} and timings.iterations == 0
+
+def test_profiler_window_saves_trace(tmpdir):
+    '''A trace is recorded for the chosen iterations only, and saved once
+    '''
+    filename = str(tmpdir.join('trace.json'))
+    window = ProfilerWindow(filename, 2, 4)
+    for iteration_number in range(6):
+        window.begin_iteration(iteration_number)
+        assert window.active == (iteration_number in [2, 3])
+        with torch.profiler.record_function(f'iteration {iteration_number}'):
+            torch.ones(8).sum()
+        window.end_iteration(iteration_number)
+    assert window.saved
+    names = {event.get('name') for event in json.load(open(filename))['traceEvents']}
+    assert {'iteration 2', 'iteration 3'} <= names
+    assert not {'iteration 1', 'iteration 4'} & names
+    with pytest.raises(ValueError):
+        ProfilerWindow(filename, 4, 4)
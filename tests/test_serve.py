@@ -0,0 +1,91 @@
+import base64
+import io
+import json
+import threading
+import urllib.error
+import urllib.request
+import pytest
+from PIL import Image
+from vqgan_clip.engine import VQGAN_CLIP_Config
+from vqgan_clip.serve import GenerationRequest, GenerationService, QueueFullError, make_server
+
+@pytest.fixture
+def serving():
+    '''Serve a GenerationService on a free localhost port, and stop it afterwards
+    '''
+    servers = []
+    def serve(service):
+        server = make_server(service, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append((server, service))
+        return f'http://127.0.0.1:{server.server_address[1]}'
+    yield serve
+    for server, service in servers:
+        server.shutdown()
+        server.server_close()
+        service.stop()
+
+def post(url, body):
+    request = urllib.request.Request(url + '/generate', data=json.dumps(body).encode('utf-8'), headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, [json.loads(line) for line in response]
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+def test_generation_request_validation():
+    '''Invalid requests are rejected, and requests with the same size and iterations can share a batch
+    '''
+    with pytest.raises(ValueError, match='No valid prompts'):
+        GenerationRequest()
+    with pytest.raises(ValueError, match='output_image_size'):
+        GenerationRequest(text_prompts='A red sailboat', output_image_size=[256])
+    with pytest.raises(ValueError, match='Unknown request arguments: model'):
+        GenerationRequest.from_json({'text_prompts': 'A red sailboat', 'model': 'other'})
+    first = GenerationRequest.from_json({'text_prompts': 'A red sailboat', 'iterations': 50, 'output_image_size': [128, 128]})
+    second = GenerationRequest(noise_prompts='123', iterations=50, output_image_size=[128, 128], seed=7)
+    assert first.batch_key == second.batch_key
+    assert first.batch_key != GenerationRequest(text_prompts='A red sailboat', iterations=60, output_image_size=[128, 128]).batch_key
+    assert second.seed == 7 and first.seed > 0
+
+def test_service_queue_limit_health_and_metrics(serving):
+    '''Requests beyond max_queue get HTTP 503, bad requests get HTTP 400, and health and metrics report the queue. No models are loaded,
+    because the service isn't started, so queued requests wait.
+    '''
+    service = GenerationService(VQGAN_CLIP_Config(), max_queue=1, max_iterations=100)
+    service.submit(GenerationRequest(text_prompts='A red sailboat', iterations=10))
+    with pytest.raises(QueueFullError):
+        service.submit(GenerationRequest(text_prompts='A red sailboat', iterations=10))
+    url = serving(service)
+    assert post(url, {'text_prompts': 'A red sailboat', 'iterations': 10}) == (503, {'error': 'The queue is full.'})
+    assert post(url, {'text_prompts': 'A red sailboat', 'iterations': 1000}) == (400, {'error': 'iterations must be at most 100.'})
+    with pytest.raises(urllib.error.HTTPError) as e:
+        urllib.request.urlopen(url + '/health')
+    health = json.loads(e.value.read())
+    assert e.value.code == 503 and health['status'] == 'unavailable' and health['queue_depth'] == 1
+    metrics = urllib.request.urlopen(url + '/metrics').read().decode('utf-8')
+    assert 'vqgan_clip_requests_total{status="accepted"} 1' in metrics
+    assert 'vqgan_clip_requests_total{status="rejected"} 2' in metrics
+    assert 'vqgan_clip_queue_depth 1' in metrics
+
+def test_service_batches_requests(serving):
+    '''Compatible requests are generated together in one batch, each with its own prompts and seed, and stream progress and a PNG image
+    '''
+    config = VQGAN_CLIP_Config()
+    service = GenerationService(config, max_batch_size=2, batch_wait=30)
+    service.start()
+    url = serving(service)
+    assert json.loads(urllib.request.urlopen(url + '/health').read())['status'] == 'ok'
+    bodies = [{'text_prompts': 'A red sailboat', 'seed': 1, 'iterations': 4, 'output_image_size': [128, 128], 'progress_every': 2},
+              {'text_prompts': 'A blue house', 'seed': 2, 'iterations': 4, 'output_image_size': [128, 128], 'progress_every': 2}]
+    results = [None, None]
+    threads = [threading.Thread(target=lambda index=index: results.__setitem__(index, post(url, bodies[index]))) for index in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for (status, events), body in zip(results, bodies):
+        assert status == 200
+        assert [event['event'] for event in events] == ['queued', 'started', 'progress', 'progress', 'done']
+        assert events[-1]['batch_size'] == 2 and events[-1]['seed'] == body['seed']
+        assert Image.open(io.BytesIO(base64.b64decode(events[-1]['image']))).size == (128, 128)
@@ -61,4 +61,51 @@ def test_RIFE_wrapper(tmpdir):
                        metadata_comment='metadata_comment')
 
     assert os.path.exists(RIFE_output_filename)
-    os.remove(RIFE_output_filename)
\ No newline at end of file
+    os.remove(RIFE_output_filename)
+
+def test_ffmpeg_video_writer(tmpdir):
+    '''Frames piped to ffmpeg are encoded to a video as they are submitted, with optional still images, and a frame of the wrong size is an error
+    '''
+    import torch
+    output_path = tmpdir.mkdir('output')
+    output_video_filename = str(output_path.join('streamed.mp4'))
+    img_info = [('text_prompts', 'A red sailboat')]
+    with video_tools.FFmpegVideoWriter(output_video_filename, 30, save_stills=True, max_pending=2) as writer:
+        for frame_num in range(1, 11):
+            writer.submit(torch.rand(1, 3, 48, 64), str(output_path.join(f'frame_{frame_num:012d}.jpg')), img_info)
+    assert writer.frames_written == 10 and writer.frame_size == (64, 48)
+    assert len(glob.glob(str(output_path.join('*.jpg')))) == 10
+    extracted_frames = video_tools.extract_video_frames(output_video_filename, 30, str(tmpdir.mkdir('extracted')))
+    assert len(extracted_frames) == 10
+
+    writer = video_tools.FFmpegVideoWriter(str(output_path.join('mismatched.mp4')), 30)
+    writer.submit(torch.rand(1, 3, 48, 64))
+    writer.submit(torch.rand(1, 3, 32, 64))
+    with pytest.raises(ValueError, match='Every frame must be 64x48'):
+        writer.close()
+
+def test_video_frame_source(tmpdir):
+    '''Frames decoded from an ffmpeg pipe match the extracted frames, and can be selected and scaled while decoding
+    '''
+    from PIL import Image
+    extracted_frames = video_tools.extract_video_frames(TEST_VIDEO, 10, str(tmpdir.mkdir('extracted')))
+    source = video_tools.VideoFrameSource(TEST_VIDEO, extraction_framerate=10)
+    frames = list(source)
+    assert len(frames) == len(extracted_frames)
+    assert frames[0].mode == 'RGB' and frames[0].size == Image.open(extracted_frames[0]).size
+
+    # every other frame from the third, scaled, and a source can be iterated more than once
+    selected = video_tools.VideoFrameSource(TEST_VIDEO, extraction_framerate=10, start_frame=2, end_frame=9, stride=2, size=[64, 48], prefetch=2)
+    assert len(selected) == 4
+    for _ in range(2):
+        assert [frame.size for frame in selected] == [(64, 48)] * 4
+
+    # stopping early ends the decoding
+    frame_iterator = iter(source)
+    next(frame_iterator)
+    frame_iterator.close()
+
+    with pytest.raises(ValueError):
+        video_tools.VideoFrameSource(TEST_VIDEO, start_frame=5, end_frame=5)
+    with pytest.raises(ValueError):
+        video_tools.VideoFrameSource(os.path.join(TEST_DATA_DIR, 'missing.mp4'))
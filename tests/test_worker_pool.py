@@ -0,0 +1,51 @@
+import pytest
+import os
+from vqgan_clip import model_registry
+from vqgan_clip.engine import VQGAN_CLIP_Config
+from vqgan_clip.worker_pool import ImageWorkerPool
+
+def test_worker_pool_shares_models_and_checks_jobs(cpu_config, fake_models):
+    '''The pool moves the models to shared memory, and rejects jobs that would need different models or invalid pool sizes
+    '''
+    config = cpu_config(vqgan_model_name='fake_vqgan')
+    model_registry.put(config, *fake_models())
+    try:
+        with ImageWorkerPool(config, num_workers=2, threads_per_worker=1) as pool:
+            models = model_registry.get(config)
+            assert all(parameter.is_shared() for parameter in models.vqgan.parameters())
+            assert all(parameter.is_shared() for parameter in models.perceptor.parameters())
+            with pytest.raises(ValueError, match='same vqgan_model_name'):
+                pool.submit('output.jpg', eng_config=cpu_config(vqgan_model_name='fake_vqgan', clip_model='RN50'), text_prompts='A red sailboat')
+        with pytest.raises(ValueError, match='num_workers'):
+            ImageWorkerPool(config, num_workers=0)
+    finally:
+        model_registry.evict(config)
+
+def test_worker_pool_close_cancels_pending_jobs(cpu_config, fake_models):
+    '''close(cancel_pending=True) cancels the jobs that haven't been sent to a worker yet, and waits for the rest
+    '''
+    config = cpu_config(vqgan_model_name='fake_vqgan')
+    model_registry.put(config, *fake_models())
+    try:
+        pool = ImageWorkerPool(config, num_workers=1, threads_per_worker=1)
+        futures = [pool.submit(f'output_{job_num}.jpg', text_prompts='A red sailboat') for job_num in range(10)]
+        pool.close(cancel_pending=True)
+        assert all(future.done() for future in futures)
+        assert futures[-1].cancelled()
+    finally:
+        model_registry.evict(config)
+
+def test_image_worker_pool(tmpdir):
+    '''Generate images in a worker pool, with a different seed for each, and get errors back from the workers
+    '''
+    config = VQGAN_CLIP_Config()
+    config.output_image_size = [128,128]
+    output_path = tmpdir.mkdir('output')
+    with ImageWorkerPool(config, num_workers=2) as pool:
+        jobs = [dict(output_filename=str(output_path.join(f'output_{seed}.jpg')), seed=seed, text_prompts='A red sailboat', iterations=5) for seed in [1, 2, 3]]
+        results = list(pool.map(jobs))
+        with pytest.raises(ValueError, match='text_prompts must be a string'):
+            pool.submit(str(output_path.join('invalid.jpg')), text_prompts=3).result()
+    assert [f'seed {seed}' in result for result, seed in zip(results, [1, 2, 3])] == [True, True, True]
+    for seed in [1, 2, 3]:
+        assert os.path.exists(str(output_path.join(f'output_{seed}.jpg')))